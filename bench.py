@@ -0,0 +1,210 @@
+"""
+Benchmarks for the bot's hot paths. Run one with e.g.:
+
+  python bench.py payments --rows 1000000
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sqlite3
+import statistics
+import tempfile
+import time
+from datetime import datetime
+from html import escape
+
+import bulk
+import database
+import post_parser
+import sanitize
+
+def _timings(fn, calls):
+  timings = []
+  for args in calls:
+    start = time.perf_counter()
+    fn(*args)
+    timings.append((time.perf_counter() - start) * 1000)
+  timings.sort()
+  return f"avg {statistics.fmean(timings):.3f} ms, p50 {timings[len(timings) // 2]:.3f} ms, p99 {timings[int(len(timings) * 0.99)]:.3f} ms"
+
+# The events table as of migration 3, which bench_payments starts from
+INSERT_EVENT_V3 = """INSERT INTO events (title, description, price, image_path, start_location, end_location, transfer_price, transfer_time, date, active, image_file_id)
+       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+
+def bench_payments(args):
+  """
+  get_user_payments and get_all_events on a DB with args.rows payments, before and after the indexes migration.
+  """
+  rng = random.Random(0)
+  with tempfile.TemporaryDirectory() as tmp:
+    conn = sqlite3.connect(os.path.join(tmp, 'bench.db'))
+    for pragma in database.PRAGMAS:
+      conn.execute(pragma)
+    database.migrate(conn, target=3)
+    start = time.perf_counter()
+    now = int(time.time())
+    with conn:
+      conn.executemany(INSERT_EVENT_V3, (
+        (f"Evento {i}", "descrizione", 1500, None, None, "Locale", None, None, now + (i - args.events // 2) * 86400, i >= args.events - 20, None)
+        for i in range(args.events)))
+      batch = []
+      for i in range(args.rows):
+        batch.append((rng.randrange(args.events) + 1, rng.randrange(args.users), 1500, False, now - rng.randrange(365 * 86400), 1, None))
+        if len(batch) == 10_000:
+          conn.executemany(database.INSERT_PAYMENT, batch)
+          batch.clear()
+      conn.executemany(database.INSERT_PAYMENT, batch)
+    print(f"{args.rows} payments, {args.users} users, {args.events} events loaded in {time.perf_counter() - start:.1f} s")
+
+    lookups = [(conn, rng.randrange(args.users)) for _ in range(args.lookups)]
+    for label in ("without indexes", "with indexes"):
+      if label == "with indexes":
+        start = time.perf_counter()
+        database.migrate(conn)
+        conn.execute("ANALYZE")
+        print(f"indexes built in {time.perf_counter() - start:.1f} s")
+      plan = conn.execute("EXPLAIN QUERY PLAN " + database.SELECT_USER_PAYMENTS, (0,)).fetchall()
+      print(f"{label}:")
+      print(f"  get_user_payments  {_timings(database._get_user_payments, lookups)}  plan: {'; '.join(row[-1] for row in plan)}")
+      print(f"  get_all_events     {_timings(database._get_all_events, [(conn,)] * 50)}")
+    conn.close()
+
+def bench_render(args):
+  """
+  Caption and keyboard rendering for args.events events: cold (event_caption/catalog_keyboard)
+  against warm (RenderCache), per event and quantity.
+  """
+  os.environ.setdefault('TOKEN_1', '0:bench')
+  import bot
+  now = int(time.time())
+  events = [(i, f"Evento {i}", "Descrizione dell'evento " * 10, 1500, None, "Stazione", "Locale", 800 if i % 2 else None,
+             now if i % 2 else None, now + 86400, 1, None) for i in range(1, args.events + 1)]
+  calls = [(ev, q) for ev in events for q in range(1, 11)]
+
+  def cold():
+    for ev, q in calls:
+      bot.event_caption(ev)
+      bot.catalog_keyboard(ev, q)
+
+  def warm():
+    for ev, q in calls:
+      bot.render_cache.caption(ev)
+      bot.render_cache.keyboard(ev, q)
+
+  warm()
+  for label, fn in (("cold", cold), ("warm", warm)):
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+      fn()
+    per_call = (time.perf_counter() - start) / (args.repeat * len(calls)) * 1e6
+    print(f"{label}: {per_call:.2f} us per caption + keyboard")
+
+POST_FIELDS = ('date', 'end_location', 'price', 'start_location', 'transfer_time', 'transfer_price')
+# The corpus' years are relative to this day
+POST_CORPUS_NOW = datetime(2025, 3, 1)
+
+def _legacy_post(text, now):
+  """
+  What add_from_post understood before post_parser: a dd/mm/yyyy hh:mm first line, then the location.
+  """
+  caption = [line for line in text.split("\n") if len(line) > 1]
+  try:
+    date = datetime.strptime(caption[0].strip(), '%d/%m/%Y %H:%M')
+    location = caption[1][1:] if caption[1][0] == '📍' else caption[1]
+  except (ValueError, IndexError):
+    return {}
+  return {'date': date, 'end_location': location.strip()}
+
+def _post_fields(parsed):
+  return {field: value.strftime(bulk.DATE_FORMAT) if isinstance(value, datetime) else value
+          for field, value in parsed.items() if field in POST_FIELDS}
+
+def bench_posts(args):
+  """
+  Accuracy and speed of post_parser.parse_post on the posts in args.corpus against the old
+  first-line parser. A field counts as right when it equals the expected value, None included.
+  """
+  with open(args.corpus, encoding='utf-8') as corpus:
+    cases = [json.loads(line) for line in corpus if line.strip()]
+  for label, parse in (("legacy", _legacy_post), ("post_parser", post_parser.parse_post)):
+    right = {field: 0 for field in POST_FIELDS}
+    whole = 0
+    missed = []
+    for case in cases:
+      parsed = _post_fields(parse(case['post'], POST_CORPUS_NOW))
+      wrong = [field for field in POST_FIELDS if parsed.get(field) != case[field]]
+      for field in POST_FIELDS:
+        right[field] += field not in wrong
+      whole += not wrong
+      if wrong:
+        missed.append(f"  missed {', '.join(wrong)} in {case['post'].splitlines()[0]!r}")
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+      for case in cases:
+        parse(case['post'], POST_CORPUS_NOW)
+    per_post = (time.perf_counter() - start) / (args.repeat * len(cases)) * 1e6
+    print(f"{label}: {whole}/{len(cases)} posts fully parsed, {per_post:.1f} us per post")
+    print("  " + ", ".join(f"{field} {right[field]}/{len(cases)}" for field in POST_FIELDS))
+    if args.verbose and label == "post_parser":
+      print("\n".join(missed))
+
+def _legacy_sanitize_input(input_string):
+  """
+  sanitize_input before sanitize.py: the script regex ran on escaped text, so it never matched.
+  """
+  sanitized = escape(input_string)
+  return re.sub(r'<script.*?>.*?</script>', '', sanitized, flags=re.DOTALL | re.IGNORECASE)
+
+def _legacy_price(text):
+  if int(_legacy_sanitize_input(text)) >= 100:
+    return int(_legacy_sanitize_input(text))
+  raise ValueError
+
+def _legacy_date(text):
+  return datetime.strptime(_legacy_sanitize_input(text), '%d/%m/%Y %H:%M')
+
+def bench_sanitize(args):
+  """
+  The add-event fields through the old handlers' checks and through sanitize's schemas.
+  """
+  description = "Serata techno con ospiti internazionali, l'ingresso è gratuito fino all'una. " * 8
+  fields = [
+    ("title", sanitize.TITLE, _legacy_sanitize_input, "Festa di primavera & amici"),
+    ("location", sanitize.LOCATION, _legacy_sanitize_input, "Villa Ada, Roma"),
+    ("description", sanitize.DESCRIPTION, _legacy_sanitize_input, description),
+    ("price", sanitize.PRICE, _legacy_price, "1500"),
+    ("date", sanitize.DATE, _legacy_date, "15/03/2025 23:00"),
+  ]
+  for name, schema, legacy, text in fields:
+    results = []
+    for fn in (legacy, schema.clean):
+      start = time.perf_counter()
+      for _ in range(args.repeat * 100):
+        fn(text)
+      results.append((time.perf_counter() - start) / (args.repeat * 100) * 1e6)
+    print(f"{name:12} legacy {results[0]:6.2f} us, sanitize {results[1]:6.2f} us")
+  script = "Ciao<script>alert(1)</script> a tutti"
+  print(f"script block: legacy {_legacy_sanitize_input(script)!r}, sanitize {sanitize.sanitize_input(script)!r}")
+
+BENCHMARKS = {
+  'payments': bench_payments,
+  'render': bench_render,
+  'posts': bench_posts,
+  'sanitize': bench_sanitize,
+}
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('benchmark', choices=BENCHMARKS)
+  parser.add_argument('--rows', type=int, default=1_000_000, help="payments to generate")
+  parser.add_argument('--users', type=int, default=50_000)
+  parser.add_argument('--events', type=int, default=500)
+  parser.add_argument('--lookups', type=int, default=200)
+  parser.add_argument('--repeat', type=int, default=20)
+  parser.add_argument('--corpus', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'post_corpus.jsonl'),
+                      help="posts with their expected fields, one JSON object per line")
+  parser.add_argument('--verbose', action='store_true', help="list the posts that aren't fully parsed")
+  args = parser.parse_args()
+  BENCHMARKS[args.benchmark](args)
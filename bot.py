@@ -1,58 +1,471 @@
 import logging
-import sqlite3
 import os
+import time
 from datetime import datetime, timedelta
-from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton, LabeledPrice, InputMediaPhoto
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, PreCheckoutQueryHandler, filters, ContextTypes, ConversationHandler
+from telegram import Update, Message, ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton, LabeledPrice, InputMediaPhoto
+from telegram.ext import Application, ApplicationHandlerStop, BaseRateLimiter, BaseUpdateProcessor, CommandHandler, MessageHandler, CallbackQueryHandler, PreCheckoutQueryHandler, TypeHandler, filters, ContextTypes, ConversationHandler
 from telegram.constants import ParseMode
-from collections import defaultdict
-import re
-from html import escape
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from collections import OrderedDict
+import asyncio
+import binascii
+import csv
+import heapq
+import itertools
+import secrets
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from urllib.parse import urlparse
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# database reads its settings from the environment, so import it once .env is loaded
+from database import from_epoch, setup_database, add_event, rm_event, payment_ingestor, inventory, get_user_payments_page, get_all_events, get_event, set_event_file_id, get_poster, add_poster, add_broadcast, get_unfinished_broadcasts, claim_recipients, release_recipients, finish_broadcast
+import database
+import metrics
+import posters
+import bulk
+import sanitize
+from post_parser import parse_post, mesi_estesi
+from persistence import SQLitePersistence
+
 BOT_TOKEN = os.getenv('TOKEN_1')
 PAYMENT_PROVIDER_TOKEN = os.getenv('TOKEN_2')
 
+# Webhook mode: set WEBHOOK_URL (the public https URL Telegram posts to) to replace polling
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+# Updates received but not yet processed; when full the webhook stops answering and Telegram retries
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', '1000'))
+# Alternative Bot API server, e.g. a local one
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+# Updates handled at the same time; updates of the same user still run one at a time
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '64'))
+# Updates a user can have waiting for their previous ones; more are dropped
+MAX_PENDING_PER_USER = int(os.getenv('MAX_PENDING_PER_USER', '20'))
+# Updates taken off the queue and not done yet, those waiting for their user's previous ones included:
+# past this they stay in the queue. The default leaves room for a full pile behind every running update
+UPDATES_IN_FLIGHT = int(os.getenv('UPDATES_IN_FLIGHT', str(CONCURRENT_UPDATES * MAX_PENDING_PER_USER)))
+# Telegram's flood limits: ~30 messages/s overall, ~1/s in a chat (short bursts tolerated)
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', '30'))
+OUTBOUND_CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', '1'))
+OUTBOUND_CHAT_BURST = int(os.getenv('OUTBOUND_CHAT_BURST', '3'))
+# Telegram user ids allowed to use admin commands, comma separated
+ADMIN_IDS = {int(user_id) for user_id in os.getenv('ADMIN_IDS', '').split(',') if user_id.strip()}
+# Announcements: concurrent sends, and recipients claimed per DB transaction
+BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', '8'))
+BROADCAST_PAGE = int(os.getenv('BROADCAST_PAGE', '50'))
+# Set by cluster.py in its worker processes: worker 0 takes the payments and resumes announcements
+CLUSTER_WORKER = int(os.getenv('CLUSTER_WORKER', '0'))
+
 # Enable logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# 3. Input Validation
-def validate_input(text):
-  # Example: Allow only alphanumeric characters and spaces
-  return re.match(r'^[a-zA-Z0-9 ]*$', text) is not None
-def validate_string(text):
-  # Example: Allow only alphanumeric characters and spaces
-  return re.match(r'^[a-zA-Z ]*$', text) is not None
-
-def sanitize_input(input_string):
+# 3. Input Validation: the field schemas are in sanitize.py
+def reason(error):
   """
-  Sanitize input by escaping HTML special characters and removing any potential script tags.
+  A schema's ValueError as the start of a reply: "Titolo oltre 100 caratteri".
   """
-  # Escape HTML special characters
-  sanitized = escape(input_string)
-  # Remove any potential script tags
-  sanitized = re.sub(r'<script.*?>.*?</script>', '', sanitized, flags=re.DOTALL | re.IGNORECASE)
-  return sanitized
+  text = str(error)
+  return text[:1].upper() + text[1:]
 
 # 4. Rate Limiting
 class RateLimiter:
-  def __init__(self, max_calls, time_frame):
+  """
+  Token bucket (GCRA) limiter: max_calls per time_frame, bursts of up to max_calls.
+  Each user costs a single float, the monotonic time at which their bucket is full again,
+  kept in LRU order so idle users are evicted and at most max_users are tracked.
+  """
+  def __init__(self, max_calls, time_frame, max_users=100_000):
     self.max_calls = max_calls
     self.time_frame = time_frame
-    self.calls = defaultdict(list)
+    self.max_users = max_users
+    self._period = time_frame.total_seconds()
+    self._interval = self._period / max_calls
+    self.users = OrderedDict()
+
+  def is_allowed(self, user_id, cost=1):
+    now = time.monotonic()
+    # pop + set moves the user to the most recently used end
+    tat = max(self.users.pop(user_id, now), now)
+    allowed = tat + self._interval * cost - now <= self._period
+    if allowed:
+      tat += self._interval * cost
+    self.users[user_id] = tat
+    self._evict(now)
+    return allowed
+
+  def _evict(self, now):
+    while len(self.users) > self.max_users:
+      self.users.popitem(last=False)
+    # A bucket that refilled completely is the same as no entry at all
+    for _ in range(2):
+      user_id, tat = next(iter(self.users.items()))
+      if tat > now:
+        break
+      del self.users[user_id]
+      if not self.users:
+        break
 
-  def is_allowed(self, user_id):
-    current_time = datetime.now()
-    self.calls[user_id] = [call for call in self.calls[user_id] if call > current_time - self.time_frame]
-    if len(self.calls[user_id]) < self.max_calls:
-      self.calls[user_id].append(current_time)
+class SharedRateLimiter:
+  """
+  Same GCRA limiter with its state in the shared_state backend, so several bot processes
+  serving the same users share the limits. Checks run in the DB thread pool; if the backend
+  fails, e.g. a locked DB, the update is let through.
+  """
+  def __init__(self, state, max_calls, time_frame):
+    self.max_calls = max_calls
+    self.time_frame = time_frame
+    self._state = state
+    self._period = time_frame.total_seconds()
+    self._interval = self._period / max_calls
+
+  async def is_allowed(self, user_id, cost=1):
+    try:
+      return await database.run_shared(self._state.rate_limit, user_id, self._interval * cost, self._period)
+    except Exception as e:
+      logger.warning(f"Shared rate limit check failed for user {user_id} ({e}), letting the update through")
       return True
-    return False
 
-rate_limiter = RateLimiter(max_calls=40, time_frame=timedelta(minutes=1))
+# Only needed when processes not sharded by user (cluster.py is) serve the same users
+RATE_LIMIT_SHARED = os.getenv('RATE_LIMIT_SHARED', '0') == '1'
+if RATE_LIMIT_SHARED:
+  rate_limiter = SharedRateLimiter(database.shared, max_calls=40, time_frame=timedelta(minutes=1))
+else:
+  rate_limiter = RateLimiter(max_calls=40, time_frame=timedelta(minutes=1), max_users=int(os.getenv('RATE_LIMIT_MAX_USERS', '100000')))
+
+# 5. Concurrency
+class UpdateQueue(asyncio.Queue):
+  """
+  The application's update queue, handing out at most max_in_flight updates not done yet.
+  With concurrent updates PTB starts a task for every update as soon as it gets one, so
+  without this bound the queue would never fill up and the webhook never slow Telegram down.
+  """
+  def __init__(self, maxsize, max_in_flight):
+    super().__init__(maxsize)
+    self._in_flight = asyncio.Semaphore(max_in_flight)
+
+  async def get(self):
+    await self._in_flight.acquire()
+    try:
+      return await super().get()
+    except BaseException:
+      self._in_flight.release()
+      raise
+
+  def task_done(self):
+    # PTB calls it once per update it got, when the update is done (or dropped at shutdown)
+    super().task_done()
+    self._in_flight.release()
+
+class TimedUpdateProcessor(BaseUpdateProcessor):
+  """
+  Runs updates as PTB's default processor does, timing each one for metrics.slow_updates.
+  Installed as is when updates run one at a time, so the latency metrics exist in both modes.
+  """
+  async def do_process_update(self, update, coroutine):
+    await metrics.slow_updates.track(update, coroutine)
+
+  async def initialize(self) -> None:
+    pass
+
+  async def shutdown(self) -> None:
+    pass
+
+def is_payment(update):
+  """
+  A pre-checkout query or a successful payment: the user is being or has been charged.
+  """
+  return isinstance(update, Update) and bool(update.pre_checkout_query or (update.message and update.message.successful_payment))
+
+class PerUserUpdateProcessor(TimedUpdateProcessor):
+  """
+  Runs updates of different users concurrently, up to max_running at once, while updates
+  of the same user (or chat) run one at a time in arrival order, so ConversationHandler
+  states and user_data['quantity'] see no interleaving. Updates waiting for their user's
+  previous ones hold none of the max_running slots, only one of the max_in_flight that
+  UpdateQueue hands out, which is also PTB's max_concurrent_updates.
+  A user with max_pending_per_user updates not done yet has further ones dropped.
+  Payments are neither dropped nor queued behind their user's other updates: the charge
+  is already under way and Telegram waits only 10 seconds for the pre-checkout answer.
+  """
+  def __init__(self, max_running, max_in_flight, max_pending_per_user=MAX_PENDING_PER_USER):
+    super().__init__(max_in_flight)
+    self.max_pending_per_user = max_pending_per_user
+    self._running = asyncio.Semaphore(max_running)
+    self._locks = {}
+
+  @staticmethod
+  def _key(update):
+    if isinstance(update, Update):
+      if update.effective_user:
+        return update.effective_user.id
+      if update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+  async def do_process_update(self, update, coroutine):
+    # PTB's slot is held already, but UpdateQueue never hands out more updates than there are
+    key = self._key(update)
+    if key is None or is_payment(update):
+      async with self._running:
+        await super().do_process_update(update, coroutine)
+      return
+    entry = self._locks.get(key)
+    if entry is None:
+      entry = self._locks[key] = [asyncio.Lock(), 0]
+    if entry[1] >= self.max_pending_per_user:
+      coroutine.close()
+      metrics.dropped_updates.inc('pending_per_user')
+      return
+    entry[1] += 1
+    try:
+      async with entry[0], self._running:
+        await super().do_process_update(update, coroutine)
+    finally:
+      entry[1] -= 1
+      if entry[1] == 0:
+        del self._locks[key]
+
+# 6. Callback data
+# One-char opcodes of the inline buttons, dispatched by route_callback
+OP_PAY, OP_TRANSFER, OP_INCREASE, OP_DECREASE, OP_REMOVE, OP_PAGE, OP_HISTORY = 'p', 't', '+', '-', 'r', 'g', 'h'
+
+def encode_callback(op, *args):
+  """
+  Callback data as an opcode followed by its unsigned int arguments packed as base64 varints.
+  Prices are never sent: handlers read them from the cached event.
+  """
+  payload = bytearray()
+  for n in args:
+    while n >= 0x80:
+      payload.append(n & 0x7f | 0x80)
+      n >>= 7
+    payload.append(n)
+  return op + urlsafe_b64encode(payload).rstrip(b'=').decode()
+
+def decode_callback(data):
+  payload = urlsafe_b64decode(data[1:] + '=' * (-(len(data) - 1) % 4))
+  args, n, shift = [], 0, 0
+  for byte in payload:
+    n |= (byte & 0x7f) << shift
+    if byte & 0x80:
+      shift += 7
+    else:
+      args.append(n)
+      n = shift = 0
+  return data[0], args
+
+# 7. Keyboard edits
+class KeyboardEditCoalescer:
+  """
+  Turns a burst of +/- taps on one message into a single edit: the first tap schedules a
+  redraw after `delay` seconds, later taps in that window only replace what it will draw,
+  and nothing is sent if the final keyboard is the one already shown.
+  """
+  def __init__(self, delay):
+    self.delay = delay
+    self._pending = {}
+
+  def schedule(self, application, query, render):
+    key = (query.message.chat_id, query.message.message_id)
+    if key in self._pending:
+      self._pending[key][1] = render
+      return
+    self._pending[key] = [query, render]
+    application.create_task(self._flush(key, query.message.reply_markup))
+
+  async def _flush(self, key, shown):
+    await asyncio.sleep(self.delay)
+    query, render = self._pending.pop(key)
+    markup = render()
+    if markup == shown:
+      return
+    try:
+      await query.edit_message_reply_markup(reply_markup=markup)
+    except BadRequest as e:
+      if 'not modified' not in str(e):
+        raise
+
+keyboard_edits = KeyboardEditCoalescer(delay=float(os.getenv('KEYBOARD_EDIT_DELAY', '0.4')))
+
+# 8. Outbound rate limiting
+PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW = range(3)
+LANE_NAMES = ('high', 'normal', 'low')
+# Lane of each endpoint that posts to a chat; the others (answerCallbackQuery,
+# answerPreCheckoutQuery, getFile...) aren't flood limited and skip the queue.
+# A call can pick its lane with rate_limit_args=PRIORITY_...
+ENDPOINT_PRIORITIES = {
+  'sendInvoice': PRIORITY_HIGH,
+  'sendMessage': PRIORITY_NORMAL,
+  'editMessageText': PRIORITY_NORMAL,
+  'editMessageCaption': PRIORITY_NORMAL,
+  'editMessageReplyMarkup': PRIORITY_NORMAL,
+  'editMessageMedia': PRIORITY_LOW,
+  'sendPhoto': PRIORITY_LOW,
+  'sendMediaGroup': PRIORITY_LOW,
+  'sendDocument': PRIORITY_LOW,
+}
+
+class OutboundScheduler(BaseRateLimiter):
+  """
+  Queues outgoing messages so the bot stays under Telegram's flood limits instead of
+  collecting 429s: sends are paced at global_rate overall and chat_rate per chat (bursts of
+  chat_burst, GCRA), and among the sends allowed at a given moment the highest priority lane
+  goes first, so an invoice isn't stuck behind someone's catalog photos.
+  A RetryAfter pauses every lane for the time Telegram asks, then the request is queued again.
+  """
+  def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, max_retries=3):
+    self.global_interval = 1 / global_rate
+    self.chat_interval = 1 / chat_rate
+    self.chat_tolerance = (chat_burst - 1) * self.chat_interval
+    self.max_retries = max_retries
+    self._seq = itertools.count()
+    # chat_id -> heap of (priority, seq, enqueued, future) waiting to be sent
+    self._queues = {}
+    # chat_id -> GCRA theoretical arrival time
+    self._tat = {}
+    # Heads of the chats that may send now, (priority, seq, chat_id); stale entries are skipped
+    self._ready = []
+    # (time, chat_id) of the chats with requests waiting for their next slot
+    self._sleeping = []
+    self._next_send = 0.0
+    self._wakeup = None
+    self._dispatcher = None
+    self.lanes = [0, 0, 0]
+    self.sent = 0
+    self.retries = 0
+    self.total_wait = 0.0
+    self.max_wait = 0.0
+
+  async def initialize(self):
+    if self._dispatcher is None:
+      self._wakeup = asyncio.Event()
+      self._dispatcher = asyncio.create_task(self._dispatch())
+
+  async def shutdown(self):
+    if self._dispatcher is not None:
+      self._dispatcher.cancel()
+      try:
+        await self._dispatcher
+      except asyncio.CancelledError:
+        pass
+      self._dispatcher = None
+
+  async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+    priority = rate_limit_args if isinstance(rate_limit_args, int) else ENDPOINT_PRIORITIES.get(endpoint)
+    if priority is None:
+      return await self._call(callback, args, kwargs, endpoint)
+    chat_id = data.get('chat_id')
+    for attempt in range(self.max_retries + 1):
+      await self._acquire(chat_id, priority)
+      try:
+        return await self._call(callback, args, kwargs, endpoint)
+      except RetryAfter as e:
+        if attempt == self.max_retries:
+          raise
+        delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+        self.retries += 1
+        logger.warning(f"Flood control on {endpoint} to {chat_id}: pausing sends for {delay}s")
+        self._next_send = max(self._next_send, time.monotonic() + delay)
+
+  @staticmethod
+  async def _call(callback, args, kwargs, endpoint):
+    start = time.perf_counter()
+    try:
+      return await callback(*args, **kwargs)
+    except Exception as e:
+      metrics.api_errors.inc(endpoint, type(e).__name__)
+      raise
+    finally:
+      metrics.api_latency.observe(time.perf_counter() - start, endpoint)
+
+  def _ready_at(self, chat_id):
+    if chat_id is None:
+      return 0.0
+    return self._tat.get(chat_id, 0.0) - self.chat_tolerance
+
+  async def _acquire(self, chat_id, priority):
+    future = asyncio.get_running_loop().create_future()
+    entry = (priority, next(self._seq), time.monotonic(), future)
+    queue = self._queues.setdefault(chat_id, [])
+    heapq.heappush(queue, entry)
+    self.lanes[priority] += 1
+    ready_at = self._ready_at(chat_id)
+    if ready_at <= entry[2]:
+      if queue[0] is entry:
+        heapq.heappush(self._ready, (priority, entry[1], chat_id))
+    elif len(queue) == 1:
+      heapq.heappush(self._sleeping, (ready_at, chat_id))
+    self._wakeup.set()
+    try:
+      await future
+    except asyncio.CancelledError:
+      # Still queued: dropped when it reaches the head of its chat
+      if future.cancelled():
+        self.lanes[priority] -= 1
+      raise
+
+  def _requeue(self, chat_id, now):
+    queue = self._queues.get(chat_id)
+    if not queue:
+      self._queues.pop(chat_id, None)
+      return
+    ready_at = self._ready_at(chat_id)
+    if ready_at <= now:
+      heapq.heappush(self._ready, (queue[0][0], queue[0][1], chat_id))
+    else:
+      heapq.heappush(self._sleeping, (ready_at, chat_id))
+
+  async def _dispatch(self):
+    while True:
+      now = time.monotonic()
+      while self._sleeping and self._sleeping[0][0] <= now:
+        self._requeue(heapq.heappop(self._sleeping)[1], now)
+      if self._ready and self._next_send <= now:
+        priority, seq, chat_id = heapq.heappop(self._ready)
+        queue = self._queues.get(chat_id)
+        if not queue or queue[0][1] != seq or self._ready_at(chat_id) > now:
+          continue
+        priority, seq, enqueued, future = heapq.heappop(queue)
+        if not future.done():
+          self.lanes[priority] -= 1
+          future.set_result(None)
+          self.sent += 1
+          self.total_wait += now - enqueued
+          self.max_wait = max(self.max_wait, now - enqueued)
+          metrics.outbound_wait.observe(now - enqueued, LANE_NAMES[priority])
+          self._next_send = now + self.global_interval
+          if chat_id is not None:
+            self._tat[chat_id] = max(self._tat.get(chat_id, now), now) + self.chat_interval
+        self._requeue(chat_id, now)
+        if len(self._tat) > 10_000:
+          self._tat = {chat_id: tat for chat_id, tat in self._tat.items() if tat > now}
+        continue
+      # Nothing may go out now: sleep until the next global slot, a chat's slot or a new request
+      timeouts = []
+      if self._ready:
+        timeouts.append(self._next_send - now)
+      if self._sleeping:
+        timeouts.append(self._sleeping[0][0] - now)
+      self._wakeup.clear()
+      try:
+        await asyncio.wait_for(self._wakeup.wait(), min(timeouts) if timeouts else None)
+      except asyncio.TimeoutError:
+        pass
+
+  def stats(self):
+    return {
+      'depth': sum(self.lanes),
+      'lanes': dict(zip(LANE_NAMES, self.lanes)),
+      'sent': self.sent,
+      'retries': self.retries,
+      'avg_wait': self.total_wait / self.sent if self.sent else 0.0,
+      'max_wait': self.max_wait,
+    }
 
 # Main menu keyboard
 main_keyboard = ReplyKeyboardMarkup([["Eventi", "I tuoi biglietti"], ["Aggiungi Evento", "Rimuovi Evento"], ["Aggiungi Evento Da Post"]], resize_keyboard=True)
@@ -61,688 +474,1107 @@ cancel_button = "Annulla"
 event_keyboard = ReplyKeyboardMarkup([[back_button, cancel_button]], one_time_keyboard=True, resize_keyboard=True)
 event_keyboard_NOBACK = ReplyKeyboardMarkup([[cancel_button]], one_time_keyboard=True, resize_keyboard=True)
 
-# Conversation states
-TITLE, DATE, DESCRIPTION, PRICE, PHOTO, TRANSFER_OPTION, START_LOCATION, END_LOCATION,TRANSFER_TIME, TRANSFER_PRICE, ADD_FROM_POST, TITLE_FROM_POST= range(12)
+# Above this many active events "Eventi" shows a single paginated message
+CATALOG_PAGE_THRESHOLD = int(os.getenv('CATALOG_PAGE_THRESHOLD', '3'))
 
-mesi_estesi = {
-    1: "Gennaio", 2: "Febbraio", 3: "Marzo", 4: "Aprile",
-    5: "Maggio", 6: "Giugno", 7: "Luglio", 8: "Agosto",
-    9: "Settembre", 10: "Ottobre", 11: "Novembre", 12: "Dicembre"
-}
+# Conversation states
+TITLE, DATE, DESCRIPTION, PRICE, PHOTO, TRANSFER_OPTION, START_LOCATION, END_LOCATION,TRANSFER_TIME, TRANSFER_PRICE, ADD_FROM_POST, TITLE_FROM_POST, CAPACITY, TRANSFER_CAPACITY = range(14)
 
 # Ensure the 'event_images' directory exists
 if not os.path.exists('event_images'):
   os.makedirs('event_images')
 
-# Database setup
-def setup_database():
-  conn = sqlite3.connect('event_payments.db')
-  c = conn.cursor()
-  #c.execute('''DROP TABLE events''')
-  #c.execute('''DROP TABLE payments''')
-  c.execute('''CREATE TABLE IF NOT EXISTS events
-         (id INTEGER PRIMARY KEY, title TEXT, description TEXT, price INTEGER, image_path TEXT,
-         start_location TEXT, end_location TEXT, transfer_price INTEGER, transfer_time DATETIME, date DATETIME, active BOOLEAN)''')
-  c.execute('''CREATE TABLE IF NOT EXISTS payments
-         (id INTEGER PRIMARY KEY, event_id INTEGER, user_id INTEGER, amount INTEGER, 
-          timestamp DATETIME DEFAULT CURRENT_TIMESTAMP, is_transfer BOOLEAN,
-          transfer_start_location TEXT, time DATETIME, quantity INTEGER)''')
-  conn.commit()
-  conn.close()
-
-# Database handlers
-def add_event(title, description, price, image_path, start_location, end_location, transfer_price, transfer_time, date, active = True):
-  conn = sqlite3.connect('event_payments.db')
-  c = conn.cursor()
-  c.execute("""INSERT INTO events (title, description, price, image_path, start_location, end_location, transfer_price, transfer_time, date, active) 
-         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-        (title, description, price, image_path, start_location, end_location, transfer_price, transfer_time, date, active))
-  event_id = c.lastrowid
-  conn.commit()
-  conn.close()
-  return event_id
-
-def rm_event(event_id):
-  conn = sqlite3.connect('event_payments.db')
-  c = conn.cursor()
-  c.execute("""UPDATE events
-        SET active = 0
-        WHERE id=?""",
-        (event_id,))
-  conn.commit()
-  conn.close()
-  return event_id
-
-def add_payment(event_id, user_id, amount, is_transfer, time, quantity, transfer_start_location=None):
-  conn = sqlite3.connect('event_payments.db')
-  c = conn.cursor()
-  c.execute("""INSERT INTO payments (event_id, user_id, amount, is_transfer, time, quantity, transfer_start_location) 
-         VALUES (?, ?, ?, ?, ?, ?, ?)""",
-        (event_id, user_id, amount, is_transfer, datetime.strptime(time, "%d/%m/%Y %H:%M"), quantity, transfer_start_location))
-  payment_id = c.lastrowid
-  conn.commit()
-  conn.close()
-  return payment_id
-
-def get_user_payments(user_id):
-  conn = sqlite3.connect('event_payments.db')
-  c = conn.cursor()
-  c.execute("""SELECT events.title, payments.amount, payments.timestamp, payments.is_transfer, payments.transfer_start_location, payments.time, payments.quantity
-         FROM payments 
-         JOIN events ON payments.event_id = events.id 
-         WHERE payments.user_id = ?""", (user_id,))
-  payments = c.fetchall()
-  conn.close()
-  return payments
-
-def get_all_events():
-  conn = sqlite3.connect('event_payments.db')
-  c = conn.cursor()
-  c.execute("SELECT * FROM events WHERE active = 1")
-  events = c.fetchall()
-  conn.close()
-  return events
-
-def get_event(id : int):
-  conn = sqlite3.connect('event_payments.db')
-  c = conn.cursor()
-  c.execute("SELECT * FROM events WHERE active = 1 and id = ?", (id,))
-  event = c.fetchone()[0]
-  conn.close()
-  return event
+def poster_on_disk(event):
+  """
+  Path of the event's poster in event_images/, None if it has none there (e.g. only a file_id).
+  """
+  return event[4] if event[4] and os.path.exists(event[4]) else None
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def send_event_photo(context: ContextTypes.DEFAULT_TYPE, chat_id, event, **kwargs):
+  """
+  Send an event poster reusing its Telegram file_id, uploading from event_images/ only
+  when there is no id yet or Telegram rejects it. The id of a fresh upload is stored.
+  Without a file to upload, the caption is sent as a text message.
+  """
+  if event[11]:
+    try:
+      return await context.bot.send_photo(chat_id=chat_id, photo=event[11], **kwargs)
+    except BadRequest as e:
+      logger.warning(f"file_id of event {event[0]} rejected ({e}), uploading from disk")
+  if poster_on_disk(event) is None:
+    logger.error(f"Event {event[0]} has no usable poster, sending it without")
+    return await context.bot.send_message(chat_id=chat_id, text=kwargs.pop('caption', event[1]), **kwargs)
+  with open(event[4], 'rb') as photo:
+    message = await context.bot.send_photo(chat_id=chat_id, photo=photo, **kwargs)
+  await set_event_file_id(event[0], message.photo[-1].file_id)
+  return message
+
+async def edit_event_photo(query, event, caption, reply_markup):
+  """
+  Replace the poster and caption of a catalog message, with the same file_id reuse as send_event_photo.
+  """
+  if event[11]:
+    try:
+      return await query.edit_message_media(InputMediaPhoto(event[11], caption=caption, parse_mode=ParseMode.MARKDOWN), reply_markup=reply_markup)
+    except BadRequest as e:
+      if 'not modified' in str(e):
+        raise
+      logger.warning(f"file_id of event {event[0]} rejected ({e}), uploading from disk")
+  if poster_on_disk(event) is None:
+    # Keep the poster on screen and only update the caption
+    logger.error(f"Event {event[0]} has no usable poster, editing the caption only")
+    return await query.edit_message_caption(caption, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+  with open(event[4], 'rb') as photo:
+    message = await query.edit_message_media(InputMediaPhoto(photo, caption=caption, parse_mode=ParseMode.MARKDOWN), reply_markup=reply_markup)
+  if isinstance(message, Message):
+    await set_event_file_id(event[0], message.photo[-1].file_id)
+  return message
+
+# Cost of an update against the per-user rate limit, by button opcode or menu text
+CALLBACK_COSTS = {
+  OP_PAY: 5, OP_TRANSFER: 5,  # each tap creates an invoice
+  OP_PAGE: 2,  # swaps the poster
+  OP_HISTORY: 2,
+}
+UPDATE_COSTS = {
+  'Eventi': 3,
+  'I tuoi biglietti': 2,
+}
+
+def update_cost(update: Update):
+  # Never drop a payment that is already in flight
+  if is_payment(update):
+    return 0
+  if update.callback_query:
+    return CALLBACK_COSTS.get((update.callback_query.data or ' ')[0], 1)
+  if update.message and update.message.text:
+    return UPDATE_COSTS.get(update.message.text, 1)
+  return 1
+
+# Users told they are over the limit, by monotonic time of the warning, oldest first
+rate_limit_warnings = OrderedDict()
+
+def should_warn(user_id):
+  """
+  True at most once per rate limit window per user: a flood of dropped updates must not
+  turn into a flood of replies queued on that chat.
+  """
+  now = time.monotonic()
+  window = rate_limiter.time_frame.total_seconds()
+  while rate_limit_warnings:
+    oldest, warned = next(iter(rate_limit_warnings.items()))
+    if now - warned < window:
+      break
+    del rate_limit_warnings[oldest]
+  if user_id in rate_limit_warnings:
+    return False
+  rate_limit_warnings[user_id] = now
+  return True
+
+async def rate_limit_guard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+  """
+  Runs in group -1 before every other handler: charges the update to its user and
+  drops it, before any ConversationHandler sees it, when the user is over the limit.
+  """
   user = update.effective_user
-  if not rate_limiter.is_allowed(user.id):
-    await update.message.reply_text("Rate limit exceeded. Please try again later.")
-    logger.warning(f"Rate limit exceeded for user {user.id}")
+  cost = update_cost(update)
+  if user is None or cost == 0:
+    return
+  allowed = rate_limiter.is_allowed(user.id, cost)
+  # SharedRateLimiter checks off the event loop
+  if not isinstance(allowed, bool):
+    allowed = await allowed
+  if allowed:
     return
+  warn = should_warn(user.id)
+  if warn:
+    logger.warning(f"Rate limit exceeded for user {user.id}")
+  if update.callback_query:
+    # Always answered, or the button keeps spinning
+    await update.callback_query.answer("Rate limit exceeded. Please try again later." if warn else None)
+  elif warn and update.effective_message:
+    await update.effective_message.reply_text("Rate limit exceeded. Please try again later.")
+  raise ApplicationHandlerStop
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+  await update.message.reply_text("Benvenuto! Scegli un'opzione:", reply_markup=main_keyboard)
+
+def catalog_keyboard(event, quantity, page=None):
+  keyboard = [
+    [InlineKeyboardButton(f"🎟️ Paga {quantity} bigliett{'o' if quantity == 1 else 'i'} (€{quantity*event[3]/100:.2f})", callback_data=encode_callback(OP_PAY, event[0]))]
+  ]
+  if event[7] is not None:  # If transfer_price exists
+    keyboard.append([InlineKeyboardButton(f"🚌 Paga {quantity} transfer (€{quantity*event[7]/100:.2f})", callback_data=encode_callback(OP_TRANSFER, event[0]))])
+
+  keyboard.append([
+      InlineKeyboardButton("-", callback_data=encode_callback(OP_DECREASE, event[0])),
+      InlineKeyboardButton("+", callback_data=encode_callback(OP_INCREASE, event[0]))
+    ])
+  if page:
+    index, total = page
+    keyboard.append([
+      InlineKeyboardButton("◀️", callback_data=encode_callback(OP_PAGE, (index - 1) % total)),
+      InlineKeyboardButton(f"{index + 1}/{total}", callback_data=encode_callback(OP_PAGE, index)),
+      InlineKeyboardButton("▶️", callback_data=encode_callback(OP_PAGE, (index + 1) % total))
+    ])
+  return InlineKeyboardMarkup(keyboard)
+
+def event_caption(event):
+  date_obj = from_epoch(event[9])
+  # Riformattazione in 'DD-MM-YYYY HH:MM'
+  formatted_time = date_obj.strftime("%d/%m/%Y %H:%M ")
+
+  if event[7] is None:
+    return f"{formatted_time[:11]}, ore {formatted_time[11:]}\n\n📍{event[6]}\n\n*{event[1]}*\n\n{event[2]}"
   else:
-    await update.message.reply_text("Benvenuto! Scegli un'opzione:", reply_markup=main_keyboard)
+    transer_data = from_epoch(event[8])
+    mese_esteso = mesi_estesi[transer_data.month]
+    return f"{formatted_time[:11]}, ore {formatted_time[11:]}\n\n📍{event[6]}\n\n*{event[1]}*\n\n{event[2]}\n\n🚌 Disponibile navetta su prenotazione\n*Quando*: {transer_data.strftime(f"%H:%M, %d {mese_esteso} %y")}\n*Dove*: {event[5]}"
+
+def catalog_page(event_id, events):
+  """
+  (index, total) of the event in the paginated catalog, or None when the events are listed one message each.
+  """
+  if len(events) <= CATALOG_PAGE_THRESHOLD:
+    return None
+  for index, event in enumerate(events):
+    if event[0] == event_id:
+      return index, len(events)
+  return None
+
+class RenderCache:
+  """
+  Memoized event_caption/catalog_keyboard results. Keyboards are keyed by
+  (event_id, quantity, has_transfer, page); everything is dropped when the events
+  cache version moves, i.e. on add_event, rm_event or a new poster file_id.
+  Markups are immutable, so the same object is safely reused across chats.
+  """
+  def __init__(self):
+    self._version = None
+    self._captions = {}
+    self._keyboards = {}
+    self.hits = 0
+    self.misses = 0
+
+  def _check_version(self):
+    if self._version != database.events_cache.version:
+      self._captions.clear()
+      self._keyboards.clear()
+      self._version = database.events_cache.version
+
+  def caption(self, event):
+    self._check_version()
+    caption = self._captions.get(event[0])
+    if caption is None:
+      self.misses += 1
+      caption = self._captions[event[0]] = event_caption(event)
+    else:
+      self.hits += 1
+    return caption
+
+  def keyboard(self, event, quantity, page=None):
+    self._check_version()
+    key = (event[0], quantity, event[7] is not None, page)
+    keyboard = self._keyboards.get(key)
+    if keyboard is None:
+      self.misses += 1
+      keyboard = self._keyboards[key] = catalog_keyboard(event, quantity, page)
+    else:
+      self.hits += 1
+    return keyboard
+
+  def stats(self):
+    return {'hits': self.hits, 'misses': self.misses, 'size': len(self._captions) + len(self._keyboards)}
+
+render_cache = RenderCache()
 
 async def handle_events(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-  user = update.effective_user
-  if not rate_limiter.is_allowed(user.id):
-    await update.message.reply_text("Rate limit exceeded. Please try again later.")
-    logger.warning(f"Rate limit exceeded for user {user.id}")
-    return
+  events = await get_all_events()
+  if len(events) == 0:
+    await update.message.reply_text("Nessun evento con biglietti disponibili al momento!", reply_markup=main_keyboard)
   else:
-    events = get_all_events()
-    if len(events) == 0:
-      await update.message.reply_text("Nessun evento con biglietti disponibili al momento!", reply_markup=main_keyboard)
-    else:
-      if 'quantity' not in context.user_data:
-        context.user_data['quantity'] = {ev[0]: 1 for ev in events}
-      chat_id = update.effective_chat.id
-      for event in events:
-        if event[0] not in context.user_data['quantity']:
-          context.user_data['quantity'] = {event[0]: 1}
-        quantity = context.user_data['quantity'][event[0]]
-        keyboard = [
-          [InlineKeyboardButton(f"🎟️ Paga {quantity} bigliett{'o' if quantity == 1 else 'i'} (€{quantity*event[3]/100:.2f})", callback_data=f"pay_{event[0]}")]
-        ]
-        if  event[7] is not None:  # If transfer_price exists
-          keyboard.append([InlineKeyboardButton(f"🚌 Paga {quantity} transfer (€{quantity*event[7]/100:.2f})", callback_data=f"transfer_{event[0]}")])
-        
-        keyboard.append([
-            InlineKeyboardButton("-", callback_data=f"decrease_{event[0]}_{1 if event[7] is not None else 0}_{event[3]}_{event[7] if event[7] is not None else 0}"),
-            InlineKeyboardButton("+", callback_data=f"increase_{event[0]}_{1 if event[7] is not None else 0}_{event[3]}_{event[7] if event[7] is not None else 0}")
-          ])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        # Parsing della stringa al formato datetime
-        date_obj = datetime.strptime(event[9][:-3], "%Y-%m-%d %H:%M")
-        # Riformattazione in 'DD-MM-YYYY HH:MM'
-        formatted_time = date_obj.strftime("%d/%m/%Y %H:%M ")
-        
-        if event[7] is None:
-          caption=f"{formatted_time[:11]}, ore {formatted_time[11:]}\n\n📍{event[6]}\n\n*{event[1]}*\n\n{event[2]}"
-        else:
-          transer_data = datetime.strptime(event[8][:-3], "%Y-%m-%d %H:%M")
-          mese_esteso = mesi_estesi[transer_data.month]
-          caption=f"{formatted_time[:11]}, ore {formatted_time[11:]}\n\n📍{event[6]}\n\n*{event[1]}*\n\n{event[2]}\n\n🚌 Disponibile navetta su prenotazione\n*Quando*: {transer_data.strftime(f"%H:%M, %d {mese_esteso} %y")}\n*Dove*: {event[5]}"
-        
-        if event[4]:  # If image path exists
-          with open(event[4], 'rb') as photo:
-            await context.bot.send_photo(
-            chat_id=chat_id,
-            photo = photo,
-            caption=caption,
-            reply_markup=reply_markup,
-            parse_mode=ParseMode.MARKDOWN
-            )
-        else:
-          await update.message.reply_text(
-            f"{event[1]}\n{event[2]}",
-            reply_markup=reply_markup,
-            parse_mode=ParseMode.MARKDOWN
-          )
-
-async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if 'quantity' not in context.user_data:
+      context.user_data['quantity'] = {ev[0]: 1 for ev in events}
+    chat_id = update.effective_chat.id
+    # With many events send only the first page, browsed with ◀️/▶️, instead of one message per event
+    listed = events[:1] if len(events) > CATALOG_PAGE_THRESHOLD else events
+    for event in listed:
+      quantity = context.user_data['quantity'].setdefault(event[0], 1)
+      reply_markup = render_cache.keyboard(event, quantity, catalog_page(event[0], events))
+      caption = render_cache.caption(event)
+
+      if event[4] or event[11]:  # If a poster exists
+        await send_event_photo(
+          context, chat_id, event,
+          caption=caption,
+          reply_markup=reply_markup,
+          parse_mode=ParseMode.MARKDOWN
+        )
+      else:
+        await update.message.reply_text(
+          f"{event[1]}\n{event[2]}",
+          reply_markup=reply_markup,
+          parse_mode=ParseMode.MARKDOWN
+        )
+
+async def handle_catalog_page(update: Update, context: ContextTypes.DEFAULT_TYPE, op, index) -> None:
   query = update.callback_query
-  data = query.data.split("_")
-  action = data[0]
-  event_id = int(data[1])
-  has_transfer = int(data[2])
-  ticket_price = int(data[3])
-  if has_transfer:
-    transfer_price = int(data[4])
-  else:
-    transfer_price = 0
-  quantity = context.user_data['quantity'][event_id]
-  if action == "increase" and quantity == 10 or action == "decrease" and quantity == 1:
-    #no modifica
+  await query.answer()
+  events = await get_all_events()
+  if len(events) == 0:
+    await query.edit_message_reply_markup(reply_markup=None)
+    await context.bot.send_message(chat_id=update.effective_chat.id, text="Nessun evento con biglietti disponibili al momento!", reply_markup=main_keyboard)
     return
-  else:
-    if action == "increase":
-      context.user_data['quantity'][event_id] = min(10, quantity + 1)
-    elif action == "decrease":
-      context.user_data['quantity'][event_id] = max(1, quantity - 1)
-    quantity = context.user_data['quantity'][event_id]
-    if has_transfer:
-      keyboard = [
-              [InlineKeyboardButton(f"🎟️ Paga {quantity} bigliett{'o' if quantity == 1 else 'i'} (€{quantity*ticket_price/100:.2f})", callback_data=f"pay_{event_id}")],
-              [InlineKeyboardButton(f"🚌 Paga {quantity} transfer (€{quantity*transfer_price/100:.2f})", callback_data=f"transfer_{event_id}")],
-              [
-                InlineKeyboardButton("-", callback_data=f"decrease_{event_id}_1_{ticket_price}_{transfer_price}"),
-                InlineKeyboardButton("+", callback_data=f"increase_{event_id}_1_{ticket_price}_{transfer_price}")
-              ]
-            ]
+  event = events[index % len(events)]
+  quantity = context.user_data.setdefault('quantity', {}).setdefault(event[0], 1)
+  reply_markup = render_cache.keyboard(event, quantity, catalog_page(event[0], events))
+  caption = render_cache.caption(event)
+  try:
+    if (event[4] or event[11]) and query.message.photo:
+      await edit_event_photo(query, event, caption, reply_markup)
+    elif query.message.photo:
+      await query.edit_message_caption(caption, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
     else:
-      keyboard = [
-              [InlineKeyboardButton(f"🎟️ Paga {quantity} bigliett{'o' if quantity == 1 else 'i'} (€{quantity*ticket_price/100:.2f})", callback_data=f"pay_{event_id}")],
-              [
-                InlineKeyboardButton("-", callback_data=f"decrease_{event_id}_0_{ticket_price}_{transfer_price}"),
-                InlineKeyboardButton("+", callback_data=f"increase_{event_id}_0_{ticket_price}_{transfer_price}")
-              ]
-            ]
-    await query.edit_message_reply_markup(reply_markup= InlineKeyboardMarkup(keyboard))
+      await query.edit_message_text(caption, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+  except BadRequest as e:
+    # Tapping the page counter re-renders the same page
+    if 'not modified' not in str(e):
+      raise
 
-async def handle_my_payments(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-  user = update.effective_user
-  if not rate_limiter.is_allowed(user.id):
-    await update.message.reply_text("Rate limit exceeded. Please try again later.")
-    logger.warning(f"Rate limit exceeded for user {user.id}")
+async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE, op, event_id) -> None:
+  query = update.callback_query
+  event = await get_event(event_id)
+  if event is None:
+    await query.answer("Evento non più disponibile")
     return
-  else:
-    user_id = update.effective_user.id
-    payments = get_user_payments(user_id)
-    current_datetime = datetime.now()
-    separator = "\n--------------------\n"
-    if payments:
-      eventi_futuri = [p for p in payments if datetime.strptime(p[5][:-3], '%Y-%m-%d %H:%M') >= current_datetime - timedelta(days=2)]
-      eventi_passati = [p for p in payments if datetime.strptime(p[5][:-3], '%Y-%m-%d %H:%M') < current_datetime - timedelta(days=2)]
-      if len(eventi_futuri):
-        response = "*📬 I tuoi pagamenti per eventi futuri:*\n"
-        response += separator 
-        for payment in reversed(eventi_futuri):
-          raw_date = datetime.strptime(payment[5][:-3], '%Y-%m-%d %H:%M')
-          quantity = int(payment[6])
-          mese_esteso = mesi_estesi[raw_date.month]
-
-          response += f"""
+  # Stop the button spinner right away, the keyboard follows once the taps settle
+  await query.answer()
+  quantity = context.user_data.setdefault('quantity', {}).setdefault(event_id, 1)
+  if op == OP_INCREASE:
+    context.user_data['quantity'][event_id] = min(10, quantity + 1)
+  elif op == OP_DECREASE:
+    context.user_data['quantity'][event_id] = max(1, quantity - 1)
+  page = catalog_page(event_id, await get_all_events())
+  quantities = context.user_data['quantity']
+  keyboard_edits.schedule(context.application, query, lambda: render_cache.keyboard(event, quantities.get(event_id, 1), page))
+
+# "I tuoi biglietti" shows this many payments per page
+PAYMENTS_PAGE_SIZE = 5
+MESSAGE_LIMIT = 4096
+
+def payment_chunks(payments):
+  """
+  Yield (payment, text) for each payment row, the section header included when the
+  row starts the future or past section, so a page is built one bounded chunk at a time.
+  """
+  separator = "\n--------------------\n"
+  cutoff = datetime.now() - timedelta(days=2)
+  section = None
+  for payment in payments:
+    raw_date = from_epoch(payment[5])
+    future = raw_date >= cutoff
+    text = ""
+    if future != section:
+      if section is not None:
+        text += "\n"
+      text += "*📬 I tuoi pagamenti per eventi futuri:*\n" if future else "*📭 I tuoi pagamenti per eventi passati:*\n"
+      text += separator
+      section = future
+    quantity = int(payment[6])
+    mese_esteso = mesi_estesi[raw_date.month]
+    text += f"""
 🎉 *{payment[0]}*
 
 {'🚌' if payment[3] else '🎟️'} *{quantity}x* {'transfers' if payment[3] else 'tickets'}  
 📍 *Data {'Partenza' if payment[3] else 'Evento'}*:\n     {raw_date.strftime(f"%H:%M %d {mese_esteso} %y")}
 💳 *Pagato*: €{payment[1]/100:.2f}  
-📆 *Data Pagamento*:\n      {payment[2]}
+📆 *Data Pagamento*:\n      {from_epoch(payment[2])}
 """
-          response += separator 
-        response.rstrip(separator)
-      if len(eventi_passati):
-        if len(eventi_futuri):
-          response += "\n*📭 I tuoi pagamenti per eventi passati:*\n"
-        else:
-          response = "*📭 I tuoi pagamenti per eventi passati:*\n"
-        response += separator 
-        for payment in reversed(eventi_passati):
-          raw_date = datetime.strptime(payment[5][:-3], '%Y-%m-%d %H:%M')
-          quantity = int(payment[6])
-          formatted_time = raw_date.strftime("%d/%m/%Y %H:%M")
-          response += f"""
-🎉 *{payment[0]}*
+    text += separator
+    yield payment, text
 
-{'🚌' if payment[3] else '🎟️'} *{quantity}x* {'transfers' if payment[3] else 'tickets'}  
-📍 *Data {'Partenza' if payment[3] else 'Evento'}*:\n      {raw_date.strftime(f"%H:%M %d {mese_esteso} %y")}
-💳 *Pagato*: €{payment[1]/100:.2f}  
-📆 *Data Pagamento*:\n      {payment[2]}
-"""
-          response += separator 
-        response.rstrip(separator)
-    else:
-      response = "Non hai ancora preso biglietti."
-    await update.message.reply_text(response,parse_mode=ParseMode.MARKDOWN)
+async def render_payments_page(user_id, cursor=None, newer=False):
+  rows = await get_user_payments_page(user_id, cursor, newer, PAYMENTS_PAGE_SIZE + 1)
+  if newer:
+    # Rows come latest first: the extra one, if any, is at the start
+    has_newer, has_older = len(rows) > PAYMENTS_PAGE_SIZE, True
+    rows = rows[-PAYMENTS_PAGE_SIZE:]
+  else:
+    has_newer, has_older = cursor is not None, len(rows) > PAYMENTS_PAGE_SIZE
+    rows = rows[:PAYMENTS_PAGE_SIZE]
+  if not rows:
+    return None, None
+  parts, length, shown = [], 0, []
+  for payment, text in payment_chunks(rows):
+    if length + len(text) > MESSAGE_LIMIT:
+      # The rest goes to the next page
+      has_older = True
+      break
+    parts.append(text)
+    length += len(text)
+    shown.append(payment)
+  buttons = []
+  if has_newer:
+    buttons.append(InlineKeyboardButton("◀️ Più recenti", callback_data=encode_callback(OP_HISTORY, shown[0][5], shown[0][7], 1)))
+  if has_older:
+    buttons.append(InlineKeyboardButton("Meno recenti ▶️", callback_data=encode_callback(OP_HISTORY, shown[-1][5], shown[-1][7], 0)))
+  return "".join(parts), InlineKeyboardMarkup([buttons]) if buttons else None
+
+async def handle_my_payments(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+  response, reply_markup = await render_payments_page(update.effective_user.id)
+  if response is None:
+    response = "Non hai ancora preso biglietti."
+  await update.message.reply_text(response, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
+
+async def handle_payments_page(update: Update, context: ContextTypes.DEFAULT_TYPE, op, time, payment_id, newer) -> None:
+  query = update.callback_query
+  await query.answer()
+  # The cursor only positions the page: rows always belong to the user who tapped
+  response, reply_markup = await render_payments_page(update.effective_user.id, (time, payment_id), bool(newer))
+  if response is None:
+    response, reply_markup = await render_payments_page(update.effective_user.id)
+  await query.edit_message_text(response or "Non hai ancora preso biglietti.", parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
 
 async def handle_add_event(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-  user = update.effective_user
-  if not rate_limiter.is_allowed(user.id):
-    await update.message.reply_text("Rate limit exceeded. Please try again later.")
-    logger.warning(f"Rate limit exceeded for user {user.id}")
-    return
-  else:
-    if update.message.text == "Aggiungi Evento Da Post":
-      await update.message.reply_text("Stai aggiungendo da un post. Qual'è il nome dell'evento?", reply_markup=event_keyboard_NOBACK)
-      return TITLE_FROM_POST
-    elif update.message.text == "Aggiungi Evento":
-      await update.message.reply_text("Aggiungiamo un nuovo evento. Qual'è il nome dell'evento?", reply_markup=event_keyboard_NOBACK)
-      return TITLE
+  context.user_data.pop('post_transfer', None)
+  if update.message.text == "Aggiungi Evento Da Post":
+    await update.message.reply_text("Stai aggiungendo da un post. Qual'è il nome dell'evento?", reply_markup=event_keyboard_NOBACK)
+    return TITLE_FROM_POST
+  elif update.message.text == "Aggiungi Evento":
+    await update.message.reply_text("Aggiungiamo un nuovo evento. Qual'è il nome dell'evento?", reply_markup=event_keyboard_NOBACK)
+    return TITLE
 
 async def title_from_post(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-  user = update.effective_user
-  if not rate_limiter.is_allowed(user.id):
-    await update.message.reply_text("Rate limit exceeded. Please try again later.")
-    logger.warning(f"Rate limit exceeded for user {user.id}")
-    return
+  if update.message.text == cancel_button:
+    await update.message.reply_text("Conversazione annullata.", reply_markup=main_keyboard)
+    return ConversationHandler.END
   else:
-    if update.message.text == cancel_button:
+    try:
+      context.user_data['title'] = sanitize.TITLE.clean(update.message.text)
+    except ValueError as error:
+      await update.message.reply_text(f"{reason(error)}. Per favore, usa meno di 100 caratteri su una riga.", reply_markup=event_keyboard)
+      return TITLE_FROM_POST
+    caption = "Perfetto. Ora invia il post dell'evento: ne prenderò data e ora, location, prezzo ed eventuale navetta.\n\n"
+    caption +="Esempio:\n"
+    caption +="Sabato 22 marzo ore 23:30\n"
+    caption +="📍 Piper Club, Roma\n"
+    caption +="Ingresso 15€\n"
+    caption +="Navetta da Piazza Cavour alle 22:30, 5€\n"
+    caption +="descrizione..."
+    await update.message.reply_text(caption, reply_markup=event_keyboard)
+    return ADD_FROM_POST
+
+async def add_from_post(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+  if update.message.text == cancel_button:
       await update.message.reply_text("Conversazione annullata.", reply_markup=main_keyboard)
       return ConversationHandler.END
-    else:
-      sanitized_title = sanitize_input(update.message.text)
-      if len(sanitized_title) > 100:  # Limit title length
-        await update.message.reply_text("Il titolo è troppo lungo. Per favore, usa meno di 100 caratteri.", reply_markup=event_keyboard)
-        return TITLE_FROM_POST
-      context.user_data['title'] = update.message.text
-      caption = "Perfetto. Ora invia un post da cui prenderò le informazioni sull'evento con questo formato:\n\n"
-      caption +="data in formato dd/mm/yyyy hh:mm"
-      caption +="\n\n"
-      caption +="location / locale"
-      caption +="\n\n"
-      caption +="descrizione"
-      await update.message.reply_text(caption, reply_markup=event_keyboard)
+  elif update.message.text == back_button:
+      await update.message.reply_text("Aggiungiamo un nuovo evento. Qual'è il nome dell'evento?", reply_markup=event_keyboard_NOBACK)
+      return TITLE_FROM_POST
+  elif update.message.text:
+    try:
+      sanitize.POST.clean(update.message.text)
+    except ValueError as error:
+      await update.message.reply_text(f"{reason(error)}. Per favore, usa meno caratteri.", reply_markup=event_keyboard)
       return ADD_FROM_POST
+    post = parse_post(update.message.text)
+    context.user_data.pop('post_transfer', None)
+    if post['date'] is None or post['end_location'] is None:
+      await update.message.reply_text(f"Non ho trovato data, ora e location nel post, si passa all'inserimento manuale\nOra, inserisci la data e l'ora dell'evento (formato: DD/MM/YYYY HH:MM)\n```Esempio:\n{datetime.now().strftime("%d/%m/%Y %H:%M")}```",  parse_mode=ParseMode.MARKDOWN, reply_markup=event_keyboard)
+      return DATE
+    try:
+      end_location = sanitize.LOCATION.clean(post['end_location'])
+      description = sanitize.DESCRIPTION.clean(post['description'])
+    except ValueError as error:
+      await update.message.reply_text(f"{reason(error)}: rimanda il post dell'evento correggendolo.", reply_markup=event_keyboard)
+      return ADD_FROM_POST
+    context.user_data['date'] = post['date']
+    context.user_data['end_location'] = end_location
+    context.user_data['description'] = description
+    # Offered in place of the transfer questions once the poster is in, if the post has all of it
+    if post['start_location'] and post['transfer_time'] and (post['transfer_price'] or 0) >= 100:
+      try:
+        context.user_data['post_transfer'] = {
+          'start_location': sanitize.START_LOCATION.clean(post['start_location']),
+          'transfer_time': post['transfer_time'],
+          'transfer_price': post['transfer_price'],
+        }
+      except ValueError:
+        pass
+    summary = f"Dal post ho letto:\n📅 {post['date'].strftime('%d/%m/%Y %H:%M')}\n📍 {context.user_data['end_location']}"
+    if (post['price'] or 0) >= 100:
+      context.user_data['price'] = post['price']
+      summary += f"\n💶 €{post['price']/100:.2f}"
+      await update.message.reply_text(f"{summary}\n\nQuanti biglietti sono disponibili? (0 = nessun limite)", parse_mode=ParseMode.HTML, reply_markup=event_keyboard)
+      return CAPACITY
+    await update.message.reply_text(f"{summary}\n\nQual'è il costo dell'evento? (in centesimi)", parse_mode=ParseMode.HTML, reply_markup=event_keyboard)
+    return PRICE
 
-async def add_from_post(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-  user = update.effective_user
-  if not rate_limiter.is_allowed(user.id):
-    await update.message.reply_text("Rate limit exceeded. Please try again later.")
-    logger.warning(f"Rate limit exceeded for user {user.id}")
-    return
+async def handle_remove_event(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+  events = await get_all_events()
+  if len(events) == 0:
+    await update.message.reply_text("Nessun evento con biglietti disponibili al momento!", reply_markup=main_keyboard)
   else:
-    if update.message.text == cancel_button:
-        await update.message.reply_text("Conversazione annullata.", reply_markup=main_keyboard)
-        return ConversationHandler.END
-    elif update.message.text == back_button:
-        await update.message.reply_text("Aggiungiamo un nuovo evento. Qual'è il nome dell'evento?", reply_markup=event_keyboard_NOBACK)
-        return TITLE_FROM_POST
-    elif update.message.text:
-      sanitized_post = sanitize_input(update.message.text)
-      if len(sanitized_post) > 1024 - 200:  # Limit title length
-        await update.message.reply_text("Il post è troppo lungo. Per favore, usa meno caratteri.", reply_markup=event_keyboard)
-        return ADD_FROM_POST
+    chat_id = update.effective_chat.id
+    for event in events:
+      keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("Rimuovi", callback_data=encode_callback(OP_REMOVE, event[0]))]
+      ])
+      if event[4] or event[11]:  # If a poster exists
+        await send_event_photo(
+          context, chat_id, event,
+          caption=f"{event[1]}\n\n{event[2]}",
+          reply_markup=keyboard
+        )
       else:
-        try:
-          caption = [frasi for frasi in sanitized_post.split("\n") if len(frasi)>1]
-          '''if datetime.strptime(caption[0].strip(), '%d/%m/%Y %H:%M') < datetime.now():
-            await update.message.reply_text("La data indicata è nel passato.\nInvia di nuovo il messaggio con data corretta", reply_markup=event_keyboard)
-            return ADD_FROM_POST
-          else:'''
-          context.user_data['date'] = datetime.strptime(caption[0].strip(), '%d/%m/%Y %H:%M')
-          if caption[1][0] == '📍':
-              context.user_data['end_location'] = sanitize_input(caption[1][1:])
-          else:
-              context.user_data['end_location'] = sanitize_input(caption[1])
-          context.user_data['description'] = sanitize_input("\n".join(caption[2:]))
-          if len(list(context.user_data['description'])) > 1024 - 200:
-              await update.message.reply_text("Telegram ha un limite di 1024 caratteri per le descrizioni di immagini.\nLa descrizione che hai mandato potrebbe superare il limite, rimanda il post dell'evento accorciando la descrizione.\n", reply_markup=event_keyboard)
-              return ADD_FROM_POST
-          else:
-              await update.message.reply_text("Qual'è il costo dell'evento? (in centesimi)", reply_markup=event_keyboard)
-              return PRICE
-        except ValueError:
-          await update.message.reply_text(f"Il formato non è corretto, si passa all'inserimento manuale\nOra, inserisci la data e l'ora dell'evento (formato: DD/MM/YYYY HH:MM)\n```Esempio:\n{datetime.now().strftime("%d/%m/%Y %H:%M")}```",  parse_mode=ParseMode.MARKDOWN, reply_markup=event_keyboard)
-          return DATE
+        await update.message.reply_text(
+          f"{event[1]}\n\n{event[2]}",
+          reply_markup=keyboard
+        )
 
-async def handle_remove_event(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-  user = update.effective_user
-  if not rate_limiter.is_allowed(user.id):
-    await update.message.reply_text("Rate limit exceeded. Please try again later.")
-    logger.warning(f"Rate limit exceeded for user {user.id}")
-    return
-  else:
-    events = get_all_events()
-    if len(events) == 0:
-      await update.message.reply_text("Nessun evento con biglietti disponibili al momento!", reply_markup=main_keyboard)
-    else:
-      chat_id = update.effective_chat.id
-      for event in events:
-        keyboard = InlineKeyboardMarkup([
-          [InlineKeyboardButton("Rimuovi", callback_data=f"rm_{event[0]}")]
-        ])
-        if event[4]:  # If image path exists
-          with open(event[4], 'rb') as photo:
-            await context.bot.send_photo(
-              chat_id=chat_id,
-              photo = photo,
-              caption=f"{event[1]}\n\n{event[2]}",
-              reply_markup=keyboard
-            )
-        else:
-          await update.message.reply_text(
-            f"{event[1]}\n\n{event[2]}",
-            reply_markup=keyboard
-          )
-
-
-async def handle_removal(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+
+async def handle_removal(update: Update, context: ContextTypes.DEFAULT_TYPE, op, event_id) -> None:
   query = update.callback_query
   await query.answer()
   
-  event_id = int(query.data.split("_")[1])
-  rm_event(event_id)
+  await rm_event(event_id)
 
   # Manda un nuovo messaggio
   await context.bot.send_message(chat_id=update.effective_chat.id, text="Event removed")
 
 
 async def title(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-  user = update.effective_user
-  if not rate_limiter.is_allowed(user.id):
-    await update.message.reply_text("Rate limit exceeded. Please try again later.")
-    logger.warning(f"Rate limit exceeded for user {user.id}")
-    return
+  if update.message.text == cancel_button:
+    await update.message.reply_text("Conversazione annullata.", reply_markup=main_keyboard)
+    return ConversationHandler.END
   else:
-    if update.message.text == cancel_button:
-      await update.message.reply_text("Conversazione annullata.", reply_markup=main_keyboard)
-      return ConversationHandler.END
+    try:
+      context.user_data['title'] = sanitize.TITLE.clean(update.message.text)
+    except ValueError as error:
+      await update.message.reply_text(f"{reason(error)}. Per favore, usa meno di 100 caratteri su una riga.", reply_markup=event_keyboard)
+      return TITLE
     else:
-      sanitized_title = sanitize_input(update.message.text)
-      if len(sanitized_title) > 100:  # Limit title length
-        await update.message.reply_text("Il titolo è troppo lungo. Per favore, usa meno di 100 caratteri.", reply_markup=event_keyboard)
-        return TITLE
-      else:
-        context.user_data['title'] = update.message.text
-        await update.message.reply_text(f"Ottimo! Ora, inserisci la data e l'ora dell'evento (formato: DD/MM/YYYY HH:MM):\n```Esempio:\n{datetime.now().strftime("%d/%m/%Y %H:%M")}```",  parse_mode=ParseMode.MARKDOWN,reply_markup=event_keyboard)
-        return DATE
+      await update.message.reply_text(f"Ottimo! Ora, inserisci la data e l'ora dell'evento (formato: DD/MM/YYYY HH:MM):\n```Esempio:\n{datetime.now().strftime("%d/%m/%Y %H:%M")}```",  parse_mode=ParseMode.MARKDOWN,reply_markup=event_keyboard)
+      return DATE
 
 async def date(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-  user = update.effective_user
-  if not rate_limiter.is_allowed(user.id):
-    await update.message.reply_text("Rate limit exceeded. Please try again later.")
-    logger.warning(f"Rate limit exceeded for user {user.id}")
-    return
+  if update.message.text == cancel_button:
+    await update.message.reply_text("Conversazione annullata.", reply_markup=main_keyboard)
+    return ConversationHandler.END
+  elif update.message.text == back_button:
+    await update.message.reply_text("Aggiungiamo un nuovo evento. Qual'è il nome dell'evento?", reply_markup=event_keyboard_NOBACK)
+    return TITLE
   else:
-    if update.message.text == cancel_button:
-      await update.message.reply_text("Conversazione annullata.", reply_markup=main_keyboard)
-      return ConversationHandler.END
-    elif update.message.text == back_button:
-      await update.message.reply_text("Aggiungiamo un nuovo evento. Qual'è il nome dell'evento?", reply_markup=event_keyboard_NOBACK)
-      return TITLE
-    else:
-      try:
-        '''if datetime.strptime(update.message.text, '%d/%m/%Y %H:%M') < datetime.now():
-          await update.message.reply_text("La data indicata è nel passato.\nInvia di nuovo il messaggio con data corretta", reply_markup=event_keyboard)
-          return DATE
-        else:'''
-        context.user_data['date'] = datetime.strptime(sanitize_input(update.message.text), '%d/%m/%Y %H:%M')
-        await update.message.reply_text("Qual'è la location / il locale dell'evento?", reply_markup=event_keyboard)
-        return END_LOCATION
-      except ValueError:
-        await update.message.reply_text(f"Il formato non è corretto.```Esempio:\n{datetime.now().strftime("%d/%m/%Y %H:%M")}```",  parse_mode=ParseMode.MARKDOWN, reply_markup=event_keyboard)
+    try:
+      '''if datetime.strptime(update.message.text, '%d/%m/%Y %H:%M') < datetime.now():
+        await update.message.reply_text("La data indicata è nel passato.\nInvia di nuovo il messaggio con data corretta", reply_markup=event_keyboard)
         return DATE
+      else:'''
+      context.user_data['date'] = sanitize.DATE.clean(update.message.text)
+      await update.message.reply_text("Qual'è la location / il locale dell'evento?", reply_markup=event_keyboard)
+      return END_LOCATION
+    except ValueError:
+      await update.message.reply_text(f"Il formato non è corretto.```Esempio:\n{datetime.now().strftime("%d/%m/%Y %H:%M")}```",  parse_mode=ParseMode.MARKDOWN, reply_markup=event_keyboard)
+      return DATE
 
 async def end_location(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-  user = update.effective_user
-  if not rate_limiter.is_allowed(user.id):
-    await update.message.reply_text("Rate limit exceeded. Please try again later.")
-    logger.warning(f"Rate limit exceeded for user {user.id}")
-    return
+  if update.message.text == cancel_button:
+    await update.message.reply_text("Conversazione annullata.", reply_markup=main_keyboard)
+    return ConversationHandler.END
+  elif update.message.text == back_button:
+    await update.message.reply_text(f"Ottimo! Ora, inserisci la data e l'ora dell'evento (formato: DD/MM/YYYY HH:MM)\n```Esempio:\n{datetime.now().strftime("%d/%m/%Y %H:%M")}```",  parse_mode=ParseMode.MARKDOWN,reply_markup=event_keyboard)
+    return DATE
   else:
-    if update.message.text == cancel_button:
-      await update.message.reply_text("Conversazione annullata.", reply_markup=main_keyboard)
-      return ConversationHandler.END
-    elif update.message.text == back_button:
-      await update.message.reply_text(f"Ottimo! Ora, inserisci la data e l'ora dell'evento (formato: DD/MM/YYYY HH:MM)\n```Esempio:\n{datetime.now().strftime("%d/%m/%Y %H:%M")}```",  parse_mode=ParseMode.MARKDOWN,reply_markup=event_keyboard)
-      return DATE
-    else:
-      context.user_data['end_location'] = sanitize_input(update.message.text)
-      await update.message.reply_text("Ottimo! Ora fornisci una descrizione per l'evento", reply_markup=event_keyboard)
-      return DESCRIPTION
+    try:
+      context.user_data['end_location'] = sanitize.LOCATION.clean(update.message.text)
+    except ValueError as error:
+      await update.message.reply_text(f"{reason(error)}. Qual'è la location / il locale dell'evento?", reply_markup=event_keyboard)
+      return END_LOCATION
+    await update.message.reply_text("Ottimo! Ora fornisci una descrizione per l'evento", reply_markup=event_keyboard)
+    return DESCRIPTION
 
 async def description(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-  user = update.effective_user
-  if not rate_limiter.is_allowed(user.id):
-    await update.message.reply_text("Rate limit exceeded. Please try again later.")
-    logger.warning(f"Rate limit exceeded for user {user.id}")
-    return
+  if update.message.text == cancel_button:
+    await update.message.reply_text("Conversazione annullata.", reply_markup=main_keyboard)
+    return ConversationHandler.END
+  elif update.message.text == back_button:
+    await update.message.reply_text("Qual'è la location / il locale dell'evento?", reply_markup=event_keyboard)
+    return END_LOCATION
   else:
-    if update.message.text == cancel_button:
-      await update.message.reply_text("Conversazione annullata.", reply_markup=main_keyboard)
-      return ConversationHandler.END
-    elif update.message.text == back_button:
-      await update.message.reply_text("Qual'è la location / il locale dell'evento?", reply_markup=event_keyboard)
-      return END_LOCATION
-    else:
-      context.user_data['description'] = sanitize_input(update.message.text)
-      await update.message.reply_text("Quanto costa un biglietto? (in centesimi)", reply_markup=event_keyboard)
-      return PRICE
+    try:
+      context.user_data['description'] = sanitize.DESCRIPTION.clean(update.message.text)
+    except ValueError as error:
+      await update.message.reply_text(f"{reason(error)}: Telegram ha un limite di 1024 caratteri per le descrizioni di immagini, accorciala.", reply_markup=event_keyboard)
+      return DESCRIPTION
+    await update.message.reply_text("Quanto costa un biglietto? (in centesimi)", reply_markup=event_keyboard)
+    return PRICE
 
 async def price(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-  user = update.effective_user
-  if not rate_limiter.is_allowed(user.id):
-    await update.message.reply_text("Rate limit exceeded. Please try again later.")
-    logger.warning(f"Rate limit exceeded for user {user.id}")
-    return
+  if update.message.text == cancel_button:
+    await update.message.reply_text("Conversazione annullata.", reply_markup=main_keyboard)
+    return ConversationHandler.END
+  elif update.message.text == back_button:
+    await update.message.reply_text("Ottimo! Ora fornisci una descrizione per l'evento", reply_markup=event_keyboard)
+    return DESCRIPTION
   else:
+    try:
+      context.user_data['price'] = sanitize.PRICE.clean(update.message.text)
+      await update.message.reply_text("Quanti biglietti sono disponibili? (0 = nessun limite)", reply_markup=event_keyboard)
+      return CAPACITY
+    except ValueError:
+      await update.message.reply_text("Inserisci un numero per il costo del biglietto? (in centesimi)\nValore minimo un euro", reply_markup=event_keyboard)
+      return PRICE
+
+async def capacity(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+  if update.message.text == cancel_button:
+    await update.message.reply_text("Conversazione annullata.", reply_markup=main_keyboard)
+    return ConversationHandler.END
+  elif update.message.text == back_button:
+    await update.message.reply_text("Quanto costa un biglietto? (in centesimi)", reply_markup=event_keyboard)
+    return PRICE
+  else:
+    try:
+      context.user_data['capacity'] = sanitize.CAPACITY.clean(update.message.text) or None
+      await update.message.reply_text("Ora manda la locandina dell'evento!", reply_markup=event_keyboard)
+      return PHOTO
+    except ValueError:
+      await update.message.reply_text("Inserisci il numero di biglietti disponibili (0 = nessun limite)", reply_markup=event_keyboard)
+      return CAPACITY
+
+async def photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+  if update.message.text:
     if update.message.text == cancel_button:
       await update.message.reply_text("Conversazione annullata.", reply_markup=main_keyboard)
       return ConversationHandler.END
     elif update.message.text == back_button:
-      await update.message.reply_text("Ottimo! Ora fornisci una descrizione per l'evento", reply_markup=event_keyboard)
-      return DESCRIPTION
-    else:
-      try:
-        if int(sanitize_input(update.message.text)) >= 100:
-          context.user_data['price'] = int(sanitize_input(update.message.text))
-          await update.message.reply_text("Ora manda la locandina dell'evento!", reply_markup=event_keyboard)
-          return PHOTO
-        else:
-          raise ValueError
-      except ValueError:
-        await update.message.reply_text("Inserisci un numero per il costo del biglietto? (in centesimi)\nValore minimo un euro", reply_markup=event_keyboard)
-        return PRICE
+      await update.message.reply_text("Quanti biglietti sono disponibili? (0 = nessun limite)", reply_markup=event_keyboard)
+      return CAPACITY
+  elif update.message.photo:
+    photo_file = await update.message.photo[-1].get_file()
+    file_extension = os.path.splitext(photo_file.file_path)[1]
+    data = bytes(await photo_file.download_as_bytearray())
+    # Posters are stored by content hash: the same image is processed once, whatever the title
+    poster = await get_poster(posters.poster_hash(data))
+    if poster is None:
+      poster = await add_poster(await posters.store_poster(data, file_extension))
+    context.user_data['image_path'] = poster[2]
+    # The admin's upload is already on Telegram's servers: reuse it instead of re-uploading
+    context.user_data['image_file_id'] = update.message.photo[-1].file_id
+    
+    question = "Vuoi aggiungere una navetta per l'evento? (yes/no)"
+    if transfer := context.user_data.get('post_transfer'):
+      question = (f"Nel post c'è una navetta da {transfer['start_location']} il {transfer['transfer_time'].strftime('%d/%m/%Y %H:%M')}"
+                  f" a €{transfer['transfer_price']/100:.2f}. Vuoi aggiungerla? (yes/no)")
+    await update.message.reply_text(question, parse_mode=ParseMode.HTML, reply_markup=event_keyboard)
+    return TRANSFER_OPTION
 
-async def photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-  user = update.effective_user
-  if not rate_limiter.is_allowed(user.id):
-    await update.message.reply_text("Rate limit exceeded. Please try again later.")
-    logger.warning(f"Rate limit exceeded for user {user.id}")
-    return
+async def transfer_option(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+  if update.message.text == cancel_button:
+    await update.message.reply_text("Conversazione annullata.", reply_markup=main_keyboard)
+    return ConversationHandler.END
+  elif update.message.text == back_button:
+    await update.message.reply_text("Ora manda la locandina dell'evento!", reply_markup=event_keyboard)
+    return PHOTO
+  elif update.message.text.lower() == 'yes':
+    if transfer := context.user_data.get('post_transfer'):
+      context.user_data.update(transfer)
+      await update.message.reply_text("Quanti posti ci sono sul transfer? (0 = nessun limite)", reply_markup=event_keyboard)
+      return TRANSFER_CAPACITY
+    await update.message.reply_text("Da dove parte il transfer?", reply_markup=event_keyboard)
+    return START_LOCATION
+  elif update.message.text.lower() == 'no':
+    event_id = await add_event(
+      context.user_data['title'],
+      context.user_data['description'],
+      context.user_data['price'],
+      context.user_data['image_path'],
+      None, 
+      context.user_data['end_location'],
+      None, None,
+      context.user_data['date'],
+      True,
+      context.user_data.get('image_file_id'),
+      context.user_data.get('capacity'),
+      None
+    )
+    await update.message.reply_text(f"Event added successfully with ID: {event_id}\nPer avvisare chi ha già comprato: /annuncia {event_id}", reply_markup=main_keyboard)
+    return ConversationHandler.END
   else:
-    if update.message.text:
-      if update.message.text == cancel_button:
-        await update.message.reply_text("Conversazione annullata.", reply_markup=main_keyboard)
-        return ConversationHandler.END
-      elif update.message.text == back_button:
-        await update.message.reply_text("Quanto costa un biglietto? (in centesimi)", reply_markup=event_keyboard)
-        return PRICE
-    elif update.message.photo:
-      photo_file = await update.message.photo[-1].get_file()
-      file_extension = os.path.splitext(photo_file.file_path)[1]
-      file_name = f"event_images/event_{context.user_data['title'].replace(' ', '_')}{file_extension}"
-      await photo_file.download_to_drive(file_name)
-      context.user_data['image_path'] = file_name
-      
-      await update.message.reply_text("Vuoi aggiungere una navetta per l'evento? (yes/no)", reply_markup=event_keyboard)
-      return TRANSFER_OPTION
+    await update.message.reply_text("Non chiaro, rispondi yes/no", reply_markup=event_keyboard)
+    return TRANSFER_OPTION
 
-async def transfer_option(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-  user = update.effective_user
-  if not rate_limiter.is_allowed(user.id):
-    await update.message.reply_text("Rate limit exceeded. Please try again later.")
-    logger.warning(f"Rate limit exceeded for user {user.id}")
-    return
+async def start_location(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+  if update.message.text == cancel_button:
+    await update.message.reply_text("Conversazione annullata.", reply_markup=main_keyboard)
+    return ConversationHandler.END
+  elif update.message.text == back_button:
+    await update.message.reply_text("Vuoi aggiungere una navetta per l'evento? (yes/no)", reply_markup=event_keyboard)
+    return TRANSFER_OPTION
   else:
-    if update.message.text == cancel_button:
-      await update.message.reply_text("Conversazione annullata.", reply_markup=main_keyboard)
-      return ConversationHandler.END
-    elif update.message.text == back_button:
-      await update.message.reply_text("Ora manda la locandina dell'evento!", reply_markup=event_keyboard)
-      return PHOTO
-    elif update.message.text.lower() == 'yes':
-      await update.message.reply_text("Da dove parte il transfer?", reply_markup=event_keyboard)
+    try:
+      context.user_data['start_location'] = sanitize.START_LOCATION.clean(update.message.text)
+    except ValueError as error:
+      await update.message.reply_text(f"{reason(error)}. Da dove parte il transfer?", reply_markup=event_keyboard)
       return START_LOCATION
-    elif update.message.text.lower() == 'no':
-      event_id = add_event(
-        context.user_data['title'],
-        context.user_data['description'],
-        context.user_data['price'],
-        context.user_data['image_path'],
-        None, 
-        context.user_data['end_location'],
-        None, None,
-        context.user_data['date'],
-        True
-      )
-      await update.message.reply_text(f"Event added successfully with ID: {event_id}", reply_markup=main_keyboard)
-      return ConversationHandler.END
-    else:
-      await update.message.reply_text("Non chiaro, rispondi yes/no", reply_markup=event_keyboard)
-      return TRANSFER_OPTION
+    await update.message.reply_text(f"Qual'è l'orario di partenza? (formato: DD/MM/YYYY HH:MM)\n```Esempio:\n{datetime.now().strftime("%d/%m/%Y %H:%M")}```",  parse_mode=ParseMode.MARKDOWN,reply_markup=event_keyboard)
+    return TRANSFER_TIME
 
-async def start_location(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-  user = update.effective_user
-  if not rate_limiter.is_allowed(user.id):
-    await update.message.reply_text("Rate limit exceeded. Please try again later.")
-    logger.warning(f"Rate limit exceeded for user {user.id}")
-    return
+async def transfer_time(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+  if update.message.text == cancel_button:
+    await update.message.reply_text("Conversazione annullata.", reply_markup=main_keyboard)
+    return ConversationHandler.END
+  elif update.message.text == back_button:
+    await update.message.reply_text("Da dove parte il transfer?", reply_markup=event_keyboard)
+    return START_LOCATION
   else:
-    if update.message.text == cancel_button:
-      await update.message.reply_text("Conversazione annullata.", reply_markup=main_keyboard)
-      return ConversationHandler.END
-    elif update.message.text == back_button:
-      await update.message.reply_text("Vuoi aggiungere una navetta per l'evento? (yes/no)", reply_markup=event_keyboard)
-      return TRANSFER_OPTION
-    else:
-      context.user_data['start_location'] = sanitize_input(update.message.text)
-      await update.message.reply_text(f"Qual'è l'orario di partenza? (formato: DD/MM/YYYY HH:MM)\n```Esempio:\n{datetime.now().strftime("%d/%m/%Y %H:%M")}```",  parse_mode=ParseMode.MARKDOWN,reply_markup=event_keyboard)
+    try:
+      '''
+      if datetime.strptime(sanitize_input(update.message.text.strip()), '%d/%m/%Y %H:%M') < datetime.now():
+        await update.message.reply_text("La data indicata è nel passato.\nInvia di nuovo il messaggio con data corretta", reply_markup=event_keyboard)
+        return ADD_FROM_POST
+      else:'''
+      context.user_data['transfer_time'] = sanitize.TRANSFER_TIME.clean(update.message.text)
+      await update.message.reply_text("Ottimo! Ora fornisci il prezzo del transfer (in centesimi)", reply_markup=event_keyboard)
+      return TRANSFER_PRICE
+    except ValueError:
+      await update.message.reply_text(f"Il formato non è corretto.\n```Esempio:\n{datetime.now().strftime("%d/%m/%Y %H:%M")}```",  parse_mode=ParseMode.MARKDOWN,reply_markup=event_keyboard)
       return TRANSFER_TIME
 
-async def transfer_time(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-  user = update.effective_user
-  if not rate_limiter.is_allowed(user.id):
-    await update.message.reply_text("Rate limit exceeded. Please try again later.")
-    logger.warning(f"Rate limit exceeded for user {user.id}")
-    return
+async def transfer_price(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+  if update.message.text == cancel_button:
+    await update.message.reply_text("Conversazione annullata.", reply_markup=main_keyboard)
+    return ConversationHandler.END
+  elif update.message.text == back_button:
+    await update.message.reply_text("Qual'è l'orario di partenza? (formato: DD-MM-YYYY HH:MM)", reply_markup=event_keyboard)
+    return TRANSFER_TIME
   else:
-    if update.message.text == cancel_button:
-      await update.message.reply_text("Conversazione annullata.", reply_markup=main_keyboard)
-      return ConversationHandler.END
-    elif update.message.text == back_button:
-      await update.message.reply_text("Da dove parte il transfer?", reply_markup=event_keyboard)
-      return START_LOCATION
-    else:
+    try:
+      context.user_data['transfer_price'] = sanitize.TRANSFER_PRICE.clean(update.message.text)
+      await update.message.reply_text("Quanti posti ci sono sul transfer? (0 = nessun limite)", reply_markup=event_keyboard)
+      return TRANSFER_CAPACITY
+    except ValueError:
+      await update.message.reply_text("Inserisci un numero valido per il costo del transfer (in centesimi).\nValore minimo un euro", reply_markup=event_keyboard)
+      return TRANSFER_PRICE
+
+async def transfer_capacity(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+  if update.message.text == cancel_button:
+    await update.message.reply_text("Conversazione annullata.", reply_markup=main_keyboard)
+    return ConversationHandler.END
+  elif update.message.text == back_button:
+    await update.message.reply_text("Ottimo! Ora fornisci il prezzo del transfer (in centesimi)", reply_markup=event_keyboard)
+    return TRANSFER_PRICE
+  else:
+    try:
+      places = sanitize.TRANSFER_CAPACITY.clean(update.message.text)
+    except ValueError:
+      await update.message.reply_text("Inserisci il numero di posti sul transfer (0 = nessun limite)", reply_markup=event_keyboard)
+      return TRANSFER_CAPACITY
+    event_id = await add_event(
+      context.user_data['title'],
+      context.user_data['description'],
+      context.user_data['price'],
+      context.user_data['image_path'],
+      context.user_data['start_location'],
+      context.user_data['end_location'],
+      context.user_data['transfer_price'],
+      context.user_data['transfer_time'],
+      context.user_data['date'],
+      True,
+      context.user_data.get('image_file_id'),
+      context.user_data.get('capacity'),
+      places or None
+    )
+    await update.message.reply_text(f"Event added successfully with ID: {event_id}\nPer avvisare chi ha già comprato: /annuncia {event_id}", reply_markup=main_keyboard)
+    return ConversationHandler.END
+
+# Announcements
+async def broadcast_recipients(broadcast_id, after, results):
+  """
+  Past buyers of any event with user id greater than `after`, streamed a page at a time.
+  Each page is claimed in the DB, together with the results of the sends so far, before
+  it is yielded: after a crash the broadcast resumes from its cursor and never sends
+  twice to a claimed user.
+  """
+  while True:
+    batch = results[:]
+    claimed, after = await claim_recipients(broadcast_id, after, BROADCAST_PAGE, batch)
+    # Only once recorded: if the claim fails they are still there for release_recipients
+    del results[:len(batch)]
+    if after is None:
+      return
+    if claimed:
+      yield claimed
+
+async def send_announcement(application, user_id, event):
+  caption = f"🆕 Nuovo evento!\n\n{render_cache.caption(event)}"
+  reply_markup = render_cache.keyboard(event, 1)
+  # Low priority: replies to users who are using the bot go out first
+  if event[4] or event[11]:
+    await send_event_photo(application, user_id, event, caption=caption, reply_markup=reply_markup,
+                           parse_mode=ParseMode.MARKDOWN, rate_limit_args=PRIORITY_LOW)
+  else:
+    await application.bot.send_message(user_id, caption, reply_markup=reply_markup,
+                                       parse_mode=ParseMode.MARKDOWN, rate_limit_args=PRIORITY_LOW)
+
+class Broadcaster:
+  """
+  Runs announcements in the background: a producer streams the claimed recipients into a
+  small queue, a pool of workers sends. Throughput is set by the OutboundScheduler (the
+  global flood limit), the queue only keeps enough sends in flight to saturate it.
+  """
+  def __init__(self, workers=BROADCAST_WORKERS):
+    self.workers = workers
+    self._tasks = set()
+
+  def start(self, application, broadcast_id, event_id, chat_id, after=0):
+    task = asyncio.create_task(self._run(application, broadcast_id, event_id, chat_id, after))
+    self._tasks.add(task)
+    task.add_done_callback(self._tasks.discard)
+
+  async def stop(self):
+    for task in self._tasks:
+      task.cancel()
+    await asyncio.gather(*self._tasks, return_exceptions=True)
+
+  async def _run(self, application, broadcast_id, event_id, chat_id, after):
+    queue = asyncio.Queue(maxsize=self.workers * 2)
+    results = []
+    # Claimed, not yet picked up by a worker
+    unsent = set()
+    workers = [asyncio.create_task(self._work(application, broadcast_id, event_id, queue, results, unsent)) for _ in range(self.workers)]
+    sent = False
+    try:
+      async for page in broadcast_recipients(broadcast_id, after, results):
+        unsent.update(page)
+        for user_id in page:
+          await queue.put(user_id)
+      for _ in workers:
+        await queue.put(None)
+      await asyncio.gather(*workers)
+      sent = True
+      counts = await finish_broadcast(broadcast_id, results)
+      logger.info(f"Broadcast {broadcast_id} of event {event_id} done: {counts}")
+      await application.bot.send_message(chat_id, f"Annuncio dell'evento {event_id} completato: {counts.get('sent', 0)} inviati, {counts.get('failed', 0)} non consegnati")
+    except Exception:
+      # Unless finish_broadcast went through, it resumes from its cursor at the next start
+      logger.exception(f"Broadcast {broadcast_id} of event {event_id} interrupted")
+      if not sent:
+        # The workers are fine: the recipients already queued still get their announcement
+        for _ in workers:
+          await queue.put(None)
+        await asyncio.gather(*workers, return_exceptions=True)
+    finally:
+      # Whatever stopped the producer, no worker is left waiting on the queue. When shutting down,
+      # sends in progress stay claimed (they may have gone out), the ones never started are released
+      for worker in workers:
+        worker.cancel()
+      if not sent:
+        try:
+          await release_recipients(broadcast_id, sorted(unsent), results)
+        except Exception:
+          logger.exception(f"Failed to release the recipients of broadcast {broadcast_id}")
+
+  async def _work(self, application, broadcast_id, event_id, queue, results, unsent):
+    while (user_id := await queue.get()) is not None:
+      unsent.discard(user_id)
       try:
-        '''
-        if datetime.strptime(sanitize_input(update.message.text.strip()), '%d/%m/%Y %H:%M') < datetime.now():
-          await update.message.reply_text("La data indicata è nel passato.\nInvia di nuovo il messaggio con data corretta", reply_markup=event_keyboard)
-          return ADD_FROM_POST
-        else:'''
-        context.user_data['transfer_time'] = datetime.strptime(sanitize_input(update.message.text), '%d/%m/%Y %H:%M')
-        await update.message.reply_text("Ottimo! Ora fornisci il prezzo del transfer (in centesimi)", reply_markup=event_keyboard)
-        return TRANSFER_PRICE
-      except ValueError:
-        await update.message.reply_text(f"Il formato non è corretto.\n```Esempio:\n{datetime.now().strftime("%d/%m/%Y %H:%M")}```",  parse_mode=ParseMode.MARKDOWN,reply_markup=event_keyboard)
-        return TRANSFER_TIME
+        # From the events cache: picks up the poster file_id once the first upload stored it
+        event = await get_event(event_id, active_only=False)
+        await send_announcement(application, user_id, event)
+        results.append(('sent', broadcast_id, user_id))
+      except (Forbidden, BadRequest) as e:
+        # Blocked the bot or deleted the account
+        logger.info(f"Announcement to {user_id} not delivered: {e}")
+        results.append(('failed', broadcast_id, user_id))
+      except Exception:
+        logger.exception(f"Announcement to {user_id} failed")
+        results.append(('failed', broadcast_id, user_id))
 
-async def transfer_price(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-  user = update.effective_user
-  if not rate_limiter.is_allowed(user.id):
-    await update.message.reply_text("Rate limit exceeded. Please try again later.")
-    logger.warning(f"Rate limit exceeded for user {user.id}")
+broadcaster = Broadcaster()
+
+async def handle_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+  if update.effective_user.id not in ADMIN_IDS:
+    await update.message.reply_text("Comando riservato agli amministratori.")
+    return
+  try:
+    event_id = int(context.args[0])
+  except (IndexError, ValueError):
+    await update.message.reply_text("Uso: /annuncia <id evento>")
+    return
+  if not await get_event(event_id):
+    await update.message.reply_text("Evento non trovato")
     return
+  broadcast_id = await add_broadcast(event_id, update.effective_chat.id)
+  if broadcast_id is None:
+    await update.message.reply_text("Questo evento è già stato annunciato.")
+    return
+  broadcaster.start(context.application, broadcast_id, event_id, update.effective_chat.id)
+  await update.message.reply_text(f"Annuncio dell'evento {event_id} avviato, ti avviso quando è completato.")
+
+# Bulk import / export
+# Rows accepted per uploaded file, and the largest file a bot can download from Telegram
+BULK_MAX_ROWS = int(os.getenv('BULK_MAX_ROWS', '500'))
+BULK_MAX_BYTES = 20 * 1024 * 1024
+
+def _places(value, schema):
+  if not value:
+    return None
+  # 0 = no limit, as in the conversation
+  return schema.clean(value) or None
+
+def _when(value, schema):
+  # Spreadsheets and JSON often carry ISO 8601 dates
+  try:
+    return datetime.fromisoformat(value).replace(tzinfo=None)
+  except ValueError:
+    return schema.clean(value)
+
+def parse_event_row(fields):
+  """
+  Validate a row of an event file with the rules of the add-event conversation.
+  Returns a dict of add_event's arguments, with the poster's file name in place of
+  image_path, or raises ValueError with the reason, in Italian, for the report.
+  """
+  missing = [column for column in ('title', 'date', 'end_location', 'description', 'price') if not fields.get(column)]
+  if missing:
+    raise ValueError(f"mancano {', '.join(missing)}")
+  event = {
+    'title': sanitize.TITLE.clean(fields['title']),
+    'description': sanitize.DESCRIPTION.clean(fields['description']),
+    'price': sanitize.PRICE.clean(fields['price']),
+    'end_location': sanitize.LOCATION.clean(fields['end_location']),
+    'date': _when(fields['date'], sanitize.DATE),
+    'capacity': _places(fields.get('capacity'), sanitize.CAPACITY),
+    'start_location': None,
+    'transfer_time': None,
+    'transfer_price': None,
+    'transfer_capacity': None,
+    'poster': fields.get('poster') or None,
+  }
+  if any(fields.get(column) for column in ('start_location', 'transfer_time', 'transfer_price', 'transfer_capacity')):
+    missing = [column for column in ('start_location', 'transfer_time', 'transfer_price') if not fields.get(column)]
+    if missing:
+      raise ValueError(f"transfer incompleto, mancano {', '.join(missing)}")
+    event['start_location'] = sanitize.START_LOCATION.clean(fields['start_location'])
+    event['transfer_time'] = _when(fields['transfer_time'], sanitize.TRANSFER_TIME)
+    event['transfer_price'] = sanitize.TRANSFER_PRICE.clean(fields['transfer_price'])
+    event['transfer_capacity'] = _places(fields.get('transfer_capacity'), sanitize.TRANSFER_CAPACITY)
+  return event
+
+async def reply_report(message, lines, summary):
+  lines = list(lines)
+  text = "\n".join([summary, ""] + lines)
+  if len(text) <= MESSAGE_LIMIT:
+    await message.reply_text(text)
   else:
-    if update.message.text == cancel_button:
-      await update.message.reply_text("Conversazione annullata.", reply_markup=main_keyboard)
-      return ConversationHandler.END
-    elif update.message.text == back_button:
-      await update.message.reply_text("Qual'è l'orario di partenza? (formato: DD-MM-YYYY HH:MM)", reply_markup=event_keyboard)
-      return TRANSFER_TIME
-    else:
+    await message.reply_document(document="\n".join(lines).encode(), filename="report.txt", caption=summary)
+
+async def store_bulk_posters(event_file, names):
+  """
+  Process the posters named by an import, each once: file name -> image_path.
+  """
+  async def store(name):
+    data = event_file.poster(name)
+    poster = await get_poster(posters.poster_hash(data))
+    if poster is None:
+      poster = await add_poster(await posters.store_poster(data, os.path.splitext(name)[1].lower()))
+    return poster[2]
+  return dict(zip(names, await asyncio.gather(*(store(name) for name in names))))
+
+async def handle_import(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+  """
+  An admin sent a document: import the events it lists, all of them or none.
+  """
+  if update.effective_user.id not in ADMIN_IDS:
+    await update.message.reply_text("Solo gli amministratori possono importare eventi.")
+    return
+  document = update.message.document
+  if document.file_size and document.file_size > BULK_MAX_BYTES:
+    await update.message.reply_text("Il file è troppo grande: massimo 20 MB.")
+    return
+  data = bytes(await (await document.get_file()).download_as_bytearray())
+  try:
+    event_file = bulk.EventFile(data, document.file_name or '')
+  except ValueError as e:
+    await update.message.reply_text(str(e))
+    return
+
+  # Same title and date as an active event or an earlier row: skipped, so an edited export can be sent back
+  seen = {(event[1], event[9]) for event in await get_all_events()}
+  # line -> outcome, in file order
+  report = {}
+  events = []
+  errors = 0
+  skipped = 0
+  try:
+    for line, fields in event_file.rows():
+      if len(report) >= BULK_MAX_ROWS:
+        report['…'] = f"Oltre {BULK_MAX_ROWS} righe: le successive non sono state lette"
+        errors += 1
+        break
       try:
-        if int(sanitize_input(update.message.text)) >= 100:
-          context.user_data['transfer_price'] = int(sanitize_input(update.message.text))
-          event_id = add_event(
-            context.user_data['title'],
-            context.user_data['description'],
-            context.user_data['price'],
-            context.user_data['image_path'],
-            context.user_data['start_location'],
-            context.user_data['end_location'],
-            context.user_data['transfer_price'],
-            context.user_data['transfer_time'],
-            context.user_data['date'],
-            True
-          )
-          await update.message.reply_text(f"Event added successfully with ID: {event_id}", reply_markup=main_keyboard)
-          return ConversationHandler.END
-        else:
-          raise ValueError
-      except ValueError:
-        await update.message.reply_text("Inserisci un numero valido per il costo del transfer (in centesimi).\nValore minimo un euro", reply_markup=event_keyboard)
-        return TRANSFER_PRICE
+        if fields is None:
+          raise ValueError("riga non leggibile")
+        event = parse_event_row(fields)
+        key = (event['title'], database.to_epoch(event['date']))
+        if key in seen:
+          skipped += 1
+          report[line] = f"Riga {line}: ⏭️ {event['title']} già presente"
+          continue
+        if event['poster'] and not event_file.has_poster(event['poster']):
+          raise ValueError(f"locandina {event['poster']} non trovata nello zip")
+      except ValueError as e:
+        errors += 1
+        report[line] = f"Riga {line}: ❌ {e}"
+        continue
+      seen.add(key)
+      events.append((line, event))
+      report[line] = f"Riga {line}: ✅ {event['title']}"
+  except (ValueError, csv.Error) as e:
+    # Broken JSON or CSV quoting, not decodable as UTF-8...
+    await update.message.reply_text(f"File non leggibile: {e}")
+    return
 
-async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-  user = update.effective_user
-  if not rate_limiter.is_allowed(user.id):
-    await update.message.reply_text("Rate limit exceeded. Please try again later.")
-    logger.warning(f"Rate limit exceeded for user {user.id}")
+  if errors:
+    await reply_report(update.message, report.values(), "Nessun evento importato: correggi le righe segnalate e manda di nuovo il file.")
+    return
+  if not events:
+    await reply_report(update.message, report.values(), "Nessun nuovo evento da importare.")
     return
-  else:
-    await update.message.reply_text("Event creation cancelled.")
-    return ConversationHandler.END
 
-async def handle_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-  user = update.effective_user
-  if not rate_limiter.is_allowed(user.id):
-    await update.message.reply_text("Rate limit exceeded. Please try again later.")
-    logger.warning(f"Rate limit exceeded for user {user.id}")
+  try:
+    image_paths = await store_bulk_posters(event_file, sorted({event['poster'] for _, event in events if event['poster']}))
+  except Exception as e:
+    logger.exception("Failed to process the posters of an import")
+    await update.message.reply_text(f"Nessun evento importato: una locandina non è un'immagine valida ({e}).")
     return
-  else:
-    query = update.callback_query
-    await query.answer()
-    
-    payment_type, event_id = query.data.split('_')
-    event_id = int(event_id)
-    quantity = context.user_data['quantity'][event_id]
+  event_ids = await database.add_events_bulk([
+    (event['title'], event['description'], event['price'], image_paths.get(event['poster']), event['start_location'],
+     event['end_location'], event['transfer_price'], event['transfer_time'], event['date'], True, None,
+     event['capacity'], event['transfer_capacity'])
+    for _, event in events
+  ])
+  for (line, _), event_id in zip(events, event_ids):
+    report[line] += f" (ID {event_id})"
+  await reply_report(update.message, report.values(), f"Importati {len(event_ids)} eventi, {skipped} già presenti.\nPer avvisare chi ha già comprato: /annuncia <id>")
 
-    conn = sqlite3.connect('event_payments.db')
-    c = conn.cursor()
-    c.execute("SELECT * FROM events WHERE id = ?", (event_id,))
-    event = c.fetchone()
-    conn.close()
+async def handle_export(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+  if update.effective_user.id not in ADMIN_IDS:
+    await update.message.reply_text("Comando riservato agli amministratori.")
+    return
+  events = await get_all_events()
+  if not events:
+    await update.message.reply_text("Nessun evento attivo da esportare.")
+    return
+  # Reads the posters from disk: off the event loop
+  data = await asyncio.to_thread(bulk.export_events, events)
+  await update.message.reply_document(
+    document=data, filename=f"eventi_{datetime.now():%Y%m%d}.zip",
+    caption=f"{len(events)} eventi attivi. Aggiungi righe a events.csv e rimandami lo zip per importare i nuovi eventi."
+  )
+
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+  await update.message.reply_text("Event creation cancelled.")
+  return ConversationHandler.END
+
+async def handle_payment(update: Update, context: ContextTypes.DEFAULT_TYPE, op, event_id) -> None:
+  query = update.callback_query
+  await query.answer()
+  
+  payment_type = 'pay' if op == OP_PAY else 'transfer'
+  quantity = context.user_data.setdefault('quantity', {}).get(event_id, 1)
+
+  event = await get_event(event_id, active_only=False)
+  
+  if event:
+    chat_id = update.effective_chat.id
+    title = event[1]
+    price = event[3] if payment_type == 'pay' else event[7]
+    price = price * quantity
+
+    available = await inventory.available(event, payment_type == 'transfer')
+    if available is not None and available < quantity:
+      what = "biglietti" if payment_type == 'pay' else "posti sul transfer"
+      await context.bot.send_message(chat_id, f"Restano solo {available} {what}" if available > 0 else f"{what.capitalize()} esauriti")
+      return
+    image_path = event[4]
+
+    # Parsing della stringa al formato datetime
+    date_obj = from_epoch(event[9])
+
+    # Riformattazione in 'DD/MM/YYYY HH:MM'
+    formatted_time = date_obj.strftime("%d/%m/%Y %H:%M")
     
-    if event:
-      chat_id = update.effective_chat.id
-      title = event[1]
-      price = event[3] if payment_type == 'pay' else event[7]
-      price = price * quantity
-      image_path = event[4]
-
-      # Parsing della stringa al formato datetime
-      date_obj = datetime.strptime(event[9][:-3], "%Y-%m-%d %H:%M")
-
-      # Riformattazione in 'DD/MM/YYYY HH:MM'
-      formatted_time = date_obj.strftime("%d/%m/%Y %H:%M")
-      
-      if payment_type == 'pay':
-        invoice_payload = f"payment_for_event_{event_id}_{formatted_time}_{quantity}"
-        caption = f"{quantity}x 🎟️ bigliett{'i' if quantity > 1 else 'o'}\n{event[1]}\n"
-      else:
-        invoice_payload = f"payment_for_transfer_{event_id}_{formatted_time}_{quantity}"
-        caption = f"{quantity}x 🚌 transfer\n{event[1]} at {event[8]}\n"
-      
-      await context.bot.send_invoice(
-        chat_id, title,  caption, invoice_payload, 
-        PAYMENT_PROVIDER_TOKEN, "EUR", [LabeledPrice(title, price)],
-        photo_url=f"file://{os.path.abspath(image_path)}" if image_path else None
-      )
+    if payment_type == 'pay':
+      invoice_payload = f"payment_for_event_{event_id}_{formatted_time}_{quantity}"
+      caption = f"{quantity}x 🎟️ bigliett{'i' if quantity > 1 else 'o'}\n{event[1]}\n"
     else:
-      await query.edit_message_text("Event not found")
+      invoice_payload = f"payment_for_transfer_{event_id}_{formatted_time}_{quantity}"
+      caption = f"{quantity}x 🚌 transfer\n{event[1]} at {from_epoch(event[8])}\n"
+    
+    await context.bot.send_invoice(
+      chat_id=chat_id, title=title, description=caption, payload=invoice_payload,
+      provider_token=PAYMENT_PROVIDER_TOKEN, currency="EUR", prices=[LabeledPrice(title, price)],
+      photo_url=f"file://{os.path.abspath(posters.variant_path(image_path, 'invoice'))}" if image_path else None
+    )
+  else:
+    await query.edit_message_text("Event not found")
+
+# opcode -> (handler, number of arguments)
+CALLBACK_ROUTES = {
+  OP_PAY: (handle_payment, 1),
+  OP_TRANSFER: (handle_payment, 1),
+  OP_INCREASE: (button_click, 1),
+  OP_DECREASE: (button_click, 1),
+  OP_REMOVE: (handle_removal, 1),
+  OP_PAGE: (handle_catalog_page, 1),
+  OP_HISTORY: (handle_payments_page, 3),
+}
+# Timed per route: route_callback itself only decodes and dispatches
+CALLBACK_ROUTES = {op: (metrics.timed_callback(handler, f"{handler.__name__}[{op}]"), arity) for op, (handler, arity) in CALLBACK_ROUTES.items()}
+
+async def route_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+  """
+  Single entry point of the inline buttons: decodes the callback data and dispatches on its opcode.
+  """
+  query = update.callback_query
+  try:
+    op, args = decode_callback(query.data)
+    handler, arity = CALLBACK_ROUTES[op]
+    if len(args) != arity:
+      raise ValueError(query.data)
+  except (KeyError, IndexError, ValueError, binascii.Error):
+    # Buttons sent before the current encoding, or tampered with
+    await query.answer("Pulsante non più valido, apri di nuovo \"Eventi\"")
+    return
+  await handler(update, context, op, *args)
 
 async def precheckout_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+  """
+  Telegram waits at most 10 seconds for this answer: everything here is served from
+  memory (events cache, inventory ledger), the DB is written only once the payment succeeds.
+  """
   query = update.pre_checkout_query
+  try:
+    payment_type, event_id, event_date, quantity = query.invoice_payload.split('_')[-4:]
+    event_id = int(event_id)
+    quantity = int(quantity)
+  except ValueError:
+    await query.answer(ok=False, error_message="Pagamento non valido")
+    return
+
+  is_transfer = payment_type == 'transfer'
+  event = await get_event(event_id)
+  price = event and (event[7] if is_transfer else event[3])
+  if not price or quantity < 1:
+    await query.answer(ok=False, error_message="Evento non più disponibile")
+    return
+  if query.currency != "EUR" or query.total_amount != price * quantity:
+    await query.answer(ok=False, error_message="Il prezzo è cambiato, apri di nuovo \"Eventi\"")
+    return
+  if not await inventory.reserve(event, is_transfer, (query.from_user.id, query.invoice_payload), quantity):
+    await query.answer(ok=False, error_message="Posti sul transfer esauriti" if is_transfer else "Biglietti esauriti")
+    return
   await query.answer(ok=True)
 
 async def successful_payment_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -752,28 +1584,68 @@ async def successful_payment_callback(update: Update, context: ContextTypes.DEFA
   user_id = update.effective_user.id
   amount = payment_info.total_amount
   quantity = int(quantity)
-  
-  conn = sqlite3.connect('event_payments.db')
-  c = conn.cursor()
-  c.execute("SELECT start_location FROM events WHERE id = ?", (event_id,))
-  start_location = c.fetchone()[0]
-  conn.close()
 
   is_transfer = payment_type == 'transfer'
-  payment_id = add_payment(event_id, user_id, amount, is_transfer, event_date, quantity, start_location if is_transfer else None)
-  
+  hold = (user_id, payment_info.invoice_payload)
+  # Returns once the payment is committed; a redelivered update is recognised by its charge id
+  if await payment_ingestor.submit(event_id, user_id, amount, is_transfer, event_date, quantity, payment_info.telegram_payment_charge_id):
+    await inventory.commit(event_id, is_transfer, hold, quantity)
+  else:
+    inventory.release(event_id, is_transfer, hold)
+    logger.info(f"Payment {payment_info.telegram_payment_charge_id} already recorded")
+
+  # The confirmation goes out ahead of any queued catalog message
   if is_transfer:
-    await update.message.reply_text(
-      f"Transfer payment of €{amount/100:.2f} was successful!"
+    await context.bot.send_message(
+      update.effective_chat.id, f"Transfer payment of €{amount/100:.2f} was successful!", rate_limit_args=PRIORITY_HIGH
     )
   else:
-    await update.message.reply_text(
-      f"Event payment of €{amount/100:.2f} was successful!"
+    await context.bot.send_message(
+      update.effective_chat.id, f"Event payment of €{amount/100:.2f} was successful!", rate_limit_args=PRIORITY_HIGH
     )
 
-def main() -> None:
-  setup_database()
-  application = Application.builder().token(BOT_TOKEN).build()
+async def post_init(application: Application) -> None:
+  payment_ingestor.start()
+  application.persistence.start(application)
+  await inventory.load()
+  application.bot_data['metrics_server'] = await metrics.serve()
+  # Announcements interrupted by a restart, resumed by a single process
+  if CLUSTER_WORKER == 0:
+    for broadcast_id, event_id, chat_id, cursor in await get_unfinished_broadcasts():
+      logger.info(f"Resuming broadcast {broadcast_id} after user {cursor}")
+      broadcaster.start(application, broadcast_id, event_id, chat_id, cursor)
+
+async def post_stop(application: Application) -> None:
+  await broadcaster.stop()
+  if application.bot_data.get('metrics_server'):
+    application.bot_data.pop('metrics_server').close()
+
+async def post_shutdown(application: Application) -> None:
+  # Wait for pending DB writes and close the pooled connections
+  await payment_ingestor.stop()
+  logger.info(f"Events cache stats: {database.events_cache.stats()}")
+  logger.info(f"Render cache stats: {render_cache.stats()}")
+  logger.info(f"Inventory stats: {inventory.stats()}")
+  logger.info(f"Persistence stats: {application.persistence.stats()}")
+  logger.info(f"Outbound stats: {application.bot.rate_limiter.stats()}")
+  logger.info(f"Slowest updates:\n{metrics.slow_updates.report()}")
+  posters.close()
+  database.close()
+
+def build_application() -> Application:
+  builder = Application.builder().token(BOT_TOKEN).post_init(post_init).post_stop(post_stop).post_shutdown(post_shutdown)
+  # Quantities and half-written events survive restarts
+  builder.persistence(SQLitePersistence())
+  builder.rate_limiter(OutboundScheduler(OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST))
+  if CONCURRENT_UPDATES > 1:
+    processor = PerUserUpdateProcessor(CONCURRENT_UPDATES, UPDATES_IN_FLIGHT)
+  else:
+    processor = TimedUpdateProcessor(1)
+  builder.concurrent_updates(processor)
+  builder.update_queue(UpdateQueue(UPDATE_QUEUE_SIZE, processor.max_concurrent_updates))
+  if TELEGRAM_API_URL:
+    builder.base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+  application = builder.build()
 
   conv_handler = ConversationHandler(
     entry_points=[MessageHandler(filters.Regex("^Aggiungi Evento"), handle_add_event)],
@@ -785,27 +1657,65 @@ def main() -> None:
       END_LOCATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, end_location)],
       DESCRIPTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, description)],
       PRICE: [MessageHandler(filters.TEXT & ~filters.COMMAND, price)],
+      CAPACITY: [MessageHandler(filters.TEXT & ~filters.COMMAND, capacity)],
       PHOTO: [MessageHandler(filters.PHOTO | filters.TEXT & ~filters.COMMAND, photo)],
       TRANSFER_OPTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, transfer_option)],
       START_LOCATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, start_location)],
       TRANSFER_TIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, transfer_time)],
       TRANSFER_PRICE: [MessageHandler(filters.TEXT & ~filters.COMMAND, transfer_price)],
+      TRANSFER_CAPACITY: [MessageHandler(filters.TEXT & ~filters.COMMAND, transfer_capacity)],
     },
     fallbacks=[MessageHandler(filters.TEXT & ~filters.COMMAND, start)],
+    name="add_event",
+    persistent=True,
   )
 
+  application.add_handler(TypeHandler(Update, rate_limit_guard), group=-1)
   application.add_handler(CommandHandler("start", start))
+  application.add_handler(CommandHandler("annuncia", handle_broadcast))
+  application.add_handler(CommandHandler("esporta", handle_export))
   application.add_handler(MessageHandler(filters.Regex("^Eventi$"), handle_events))
   application.add_handler(MessageHandler(filters.Regex("^I tuoi biglietti$"), handle_my_payments))
   application.add_handler(conv_handler)
   application.add_handler(MessageHandler(filters.Regex("^Rimuovi Evento$"), handle_remove_event))
-  application.add_handler(CallbackQueryHandler(handle_payment, pattern="^(pay|transfer)_"))
-  application.add_handler(CallbackQueryHandler(handle_removal, pattern="^rm_"))
+  application.add_handler(CallbackQueryHandler(route_callback))
   application.add_handler(PreCheckoutQueryHandler(precheckout_callback))
   application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_callback))
-  application.add_handler(CallbackQueryHandler(button_click, pattern="^(increase|decrease)_"))
+  application.add_handler(MessageHandler(filters.Document.ALL, handle_import))
+
+  metrics.instrument_handlers(application)
+  scheduler = application.bot.rate_limiter
+  metrics.queue_depth.track(application.update_queue.qsize, 'updates')
+  metrics.queue_depth.track(payment_ingestor.queue_depth, 'payments')
+  metrics.queue_depth.track(lambda: application.persistence.stats()['pending'], 'persistence')
+  for lane, name in enumerate(LANE_NAMES):
+    metrics.queue_depth.track(lambda lane=lane: scheduler.lanes[lane], f'outbound_{name}')
+  return application
+
+def webhook_options():
+  """
+  run_webhook/Updater.start_webhook arguments from the WEBHOOK_* settings.
+  """
+  # Several workers behind a load balancer must share WEBHOOK_SECRET
+  secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+  return dict(
+    listen=WEBHOOK_LISTEN,
+    port=WEBHOOK_PORT,
+    url_path=urlparse(WEBHOOK_URL).path.lstrip('/'),
+    webhook_url=WEBHOOK_URL,
+    secret_token=secret,
+    allowed_updates=Update.ALL_TYPES
+  )
+
+def main() -> None:
+  setup_database()
+  application = build_application()
 
-  application.run_polling()
+  if WEBHOOK_URL:
+    # On SIGINT/SIGTERM the webhook stops accepting updates and the queued ones are processed before exit
+    application.run_webhook(**webhook_options())
+  else:
+    application.run_polling()
 
 if __name__ == '__main__':
   main()
\ No newline at end of file
@@ -0,0 +1,142 @@
+"""
+Event files for the admins' bulk import and export: a CSV (comma or semicolon separated),
+a JSON array, a JSON Lines file, or a zip holding one of them plus the posters it names.
+Rows are read one at a time from the upload, and values are left as strings: validation
+is bot.parse_event_row's job, with the same rules as the add-event conversation.
+"""
+import csv
+import html
+import io
+import itertools
+import json
+import os
+import zipfile
+
+from database import from_epoch
+
+# Columns of an event file, in export order
+COLUMNS = ('title', 'date', 'end_location', 'description', 'price', 'capacity',
+           'start_location', 'transfer_time', 'transfer_price', 'transfer_capacity', 'poster')
+DATE_FORMAT = '%d/%m/%Y %H:%M'
+TABLE_EXTENSIONS = ('.csv', '.json', '.jsonl')
+# Zip members are not read past this size (Telegram doesn't let bots download more anyway)
+MAX_MEMBER_SIZE = 20 * 1024 * 1024
+
+class EventFile:
+  """
+  An uploaded event file. rows() yields (line, fields) lazily, fields being a dict of
+  lower-case column -> stripped string, or None for a line that can't be parsed.
+  Raises ValueError if the file itself is not usable.
+  """
+  def __init__(self, data, file_name):
+    self._data = data
+    self._zip = None
+    self._posters = {}
+    name = file_name.lower()
+    if name.endswith('.zip') or zipfile.is_zipfile(io.BytesIO(data)):
+      try:
+        self._zip = zipfile.ZipFile(io.BytesIO(data))
+      except zipfile.BadZipFile:
+        raise ValueError("Lo zip è danneggiato")
+      members = [info for info in self._zip.infolist() if not info.is_dir() and not info.filename.startswith('__MACOSX/')]
+      tables = [info for info in members if info.filename.lower().endswith(TABLE_EXTENSIONS)]
+      if len(tables) != 1:
+        raise ValueError("Lo zip deve contenere un solo file .csv, .json o .jsonl con gli eventi")
+      self._table = tables[0]
+      if self._table.file_size > MAX_MEMBER_SIZE:
+        raise ValueError("Il file degli eventi è troppo grande")
+      name = self._table.filename.lower()
+      # Posters are looked up by file name, whatever folder they are in
+      self._posters = {os.path.basename(info.filename).lower(): info for info in members if info is not self._table}
+    if not name.endswith(TABLE_EXTENSIONS):
+      raise ValueError("Formato non supportato: manda un file .csv, .json, .jsonl o uno .zip con le locandine")
+    self._name = name
+
+  def _open(self):
+    return self._zip.open(self._table) if self._zip else io.BytesIO(self._data)
+
+  def rows(self):
+    with self._open() as stream:
+      # utf-8-sig: spreadsheets often start their CSV with a BOM
+      text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+      if self._name.endswith('.csv'):
+        yield from self._csv_rows(text)
+      else:
+        yield from self._json_rows(text)
+
+  @staticmethod
+  def _csv_rows(text):
+    header = text.readline()
+    # Spreadsheets with an Italian locale separate columns with semicolons
+    delimiter = max(',;\t', key=header.count)
+    reader = csv.DictReader(itertools.chain([header], text), delimiter=delimiter)
+    reader.fieldnames = [name.strip().lower() for name in reader.fieldnames or ()]
+    for row in reader:
+      fields = {name: (value or '').strip() for name, value in row.items() if isinstance(name, str)}
+      if any(fields.values()):
+        yield reader.line_num, fields
+
+  @staticmethod
+  def _fields(item):
+    if not isinstance(item, dict):
+      return None
+    return {str(name).strip().lower(): '' if value is None else str(value).strip() for name, value in item.items()}
+
+  def _json_rows(self, text):
+    head = text.readline()
+    if head.lstrip().startswith('['):
+      # A JSON array has to be read whole; JSON Lines are read line by line
+      for number, item in enumerate(json.loads(head + text.read()), 1):
+        yield number, self._fields(item)
+      return
+    for number, line in enumerate(itertools.chain([head], text), 1):
+      if not line.strip():
+        continue
+      try:
+        yield number, self._fields(json.loads(line))
+      except ValueError:
+        yield number, None
+
+  def has_poster(self, name):
+    return os.path.basename(name).lower() in self._posters
+
+  def poster(self, name):
+    """
+    The image called name in the zip, None if missing or too large.
+    """
+    info = self._posters.get(os.path.basename(name).lower())
+    if info is None or info.file_size > MAX_MEMBER_SIZE:
+      return None
+    return self._zip.read(info)
+
+def _date(timestamp):
+  return from_epoch(timestamp).strftime(DATE_FORMAT) if timestamp is not None else ''
+
+def _blank(value):
+  return '' if value is None else value
+
+def export_events(events):
+  """
+  Zip of events (rows of the events table) in the import format: events.csv plus their
+  posters. Text other than the title was HTML-escaped when entered and is unescaped here,
+  so that importing the file again gives back the same events.
+  """
+  out = io.BytesIO()
+  with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as archive:
+    table = io.StringIO()
+    writer = csv.writer(table)
+    writer.writerow(COLUMNS)
+    written = set()
+    for event in events:
+      poster = ''
+      if event[4] and os.path.exists(event[4]):
+        poster = os.path.basename(event[4])
+        if poster not in written:
+          # JPEGs don't compress any further
+          archive.write(event[4], f"posters/{poster}", compress_type=zipfile.ZIP_STORED)
+          written.add(poster)
+      writer.writerow((event[1], _date(event[9]), html.unescape(event[6] or ''), html.unescape(event[2] or ''),
+                       event[3], _blank(event[12]), html.unescape(event[5] or ''), _date(event[8]), _blank(event[7]),
+                       _blank(event[13]), poster))
+    archive.writestr('events.csv', table.getvalue())
+  return out.getvalue()
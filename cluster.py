@@ -0,0 +1,172 @@
+"""
+Runs the bot on several cores: a dispatcher process receives the updates (polling, or the
+webhook when WEBHOOK_URL is set) and hands each one to one of CLUSTER_WORKERS worker
+processes, each running the Application built by bot.build_application().
+
+- Updates are sharded by user id: a user's updates always reach the same worker, in order,
+  so their user_data, conversation state and rate limit stay in one process as before.
+- Pre-checkout queries and successful payments all go to worker 0, the single process that
+  holds the ticket reservations and writes payments.
+- The workers share the SQLite DB and tell each other when the active events or the tickets
+  sold change through shared_state (SHARED_STATE_DB, next to the DB unless set).
+- Telegram's overall flood limit is split evenly between the workers; the per-chat limit needs
+  no sharing, a private chat belongs to a single user.
+
+  CLUSTER_WORKERS=4 python cluster.py
+"""
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+from dotenv import load_dotenv
+
+load_dotenv()
+# Read by database.py in every process, so set before any of them imports it
+os.environ.setdefault('SHARED_STATE_DB', os.getenv('DB_PATH', 'event_payments.db') + '.shared')
+
+CLUSTER_WORKERS = int(os.getenv('CLUSTER_WORKERS', str(os.cpu_count() or 1)))
+# Seconds between checks for changes made by the other workers
+CLUSTER_SYNC_INTERVAL = float(os.getenv('CLUSTER_SYNC_INTERVAL', '0.5'))
+
+PAYMENT_WORKER = 0
+
+logger = logging.getLogger(__name__)
+
+def worker_for_user(user_id, workers):
+  return user_id % workers
+
+def worker_for(update, workers):
+  if update.pre_checkout_query or (update.message and update.message.successful_payment):
+    return PAYMENT_WORKER
+  user = update.effective_user
+  return worker_for_user(user.id, workers) if user else PAYMENT_WORKER
+
+# Workers
+def worker(index, workers, updates, global_rate, metrics_port):
+  # The dispatcher handles SIGINT/SIGTERM: it stops the workers once it stopped receiving updates
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  signal.signal(signal.SIGTERM, signal.SIG_IGN)
+  # bot.py reads its settings at import
+  os.environ['CLUSTER_WORKER'] = str(index)
+  os.environ['OUTBOUND_GLOBAL_RATE'] = str(global_rate / workers)
+  if metrics_port:
+    os.environ['METRICS_PORT'] = str(metrics_port + index)
+  asyncio.run(_run_worker(index, workers, updates))
+
+def _next_update(updates):
+  """
+  Next update for this worker as JSON, None once the dispatcher stops or dies.
+  """
+  parent = multiprocessing.parent_process()
+  while True:
+    try:
+      return updates.get(timeout=1)
+    except queue.Empty:
+      if parent is not None and not parent.is_alive():
+        return None
+
+async def _sync(index):
+  import database
+  while True:
+    await asyncio.sleep(CLUSTER_SYNC_INTERVAL)
+    try:
+      await database.events_cache.sync()
+      if index != PAYMENT_WORKER:
+        await database.inventory.sync()
+    except Exception:
+      logger.exception("Failed to sync with the other workers")
+
+async def _run_worker(index, workers, updates):
+  from telegram import Update
+  import bot
+
+  application = bot.build_application()
+  # Only the owner of a user saves their data: payments of other users reach worker 0 too
+  application.persistence.owns = lambda user_id: worker_for_user(user_id, workers) == index
+  await application.initialize()
+  await application.post_init(application)
+  await application.start()
+  sync = asyncio.create_task(_sync(index))
+  loop = asyncio.get_running_loop()
+  try:
+    while (data := await loop.run_in_executor(None, _next_update, updates)) is not None:
+      await application.update_queue.put(Update.de_json(json.loads(data), application.bot))
+  finally:
+    sync.cancel()
+    # Processes the updates already queued, then the same shutdown as run_polling
+    await application.stop()
+    await application.post_stop(application)
+    await application.shutdown()
+    await application.post_shutdown(application)
+
+# Dispatcher
+async def _forward(updates, queues):
+  while (update := await updates.get()) is not None:
+    queues[worker_for(update, len(queues))].put(update.to_json())
+
+async def dispatch(queues, processes, spawn):
+  from telegram import Bot
+  from telegram.ext import Updater
+  from bot import BOT_TOKEN, TELEGRAM_API_URL, WEBHOOK_URL, webhook_options
+
+  options = {}
+  if TELEGRAM_API_URL:
+    options = dict(base_url=f"{TELEGRAM_API_URL}/bot", base_file_url=f"{TELEGRAM_API_URL}/file/bot")
+  updates = asyncio.Queue()
+  stop = asyncio.Event()
+  loop = asyncio.get_running_loop()
+  for signum in (signal.SIGINT, signal.SIGTERM):
+    loop.add_signal_handler(signum, stop.set)
+
+  async with Updater(Bot(BOT_TOKEN, **options), updates) as updater:
+    if WEBHOOK_URL:
+      await updater.start_webhook(**webhook_options())
+    else:
+      await updater.start_polling()
+    forwarder = asyncio.create_task(_forward(updates, queues))
+    logger.info(f"Dispatching updates to {len(queues)} workers")
+    while not stop.is_set():
+      try:
+        await asyncio.wait_for(stop.wait(), 5)
+      except asyncio.TimeoutError:
+        pass
+      for index, process in enumerate(processes):
+        if not process.is_alive() and not stop.is_set():
+          logger.error(f"Worker {index} exited with code {process.exitcode}, restarting it")
+          processes[index] = spawn(index)
+    await updater.stop()
+    # Hand over what was received before stopping
+    updates.put_nowait(None)
+    await forwarder
+
+def main() -> None:
+  import bot
+  import database
+  import metrics
+
+  bot.setup_database()
+  database.close()
+  # spawn: the workers must not inherit the dispatcher's threads and event loop
+  context = multiprocessing.get_context('spawn')
+  queues = [context.Queue() for _ in range(CLUSTER_WORKERS)]
+
+  def spawn(index):
+    process = context.Process(target=worker, name=f"bot-worker-{index}", daemon=False,
+                              args=(index, CLUSTER_WORKERS, queues[index], bot.OUTBOUND_GLOBAL_RATE, metrics.METRICS_PORT))
+    process.start()
+    return process
+
+  processes = [spawn(index) for index in range(CLUSTER_WORKERS)]
+  try:
+    asyncio.run(dispatch(queues, processes, spawn))
+  finally:
+    for updates in queues:
+      updates.put(None)
+    for process in processes:
+      process.join()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,773 @@
+import asyncio
+import calendar
+import json
+import logging
+import os
+import pickle
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import metrics
+import shared_state
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = os.getenv('DB_PATH', 'event_payments.db')
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '4'))
+# Seconds a pre-checkout reservation holds its tickets while the payment completes
+RESERVATION_TTL = int(os.getenv('RESERVATION_TTL', '600'))
+
+# Applied to every pooled connection. WAL lets readers run while a writer commits,
+# synchronous=NORMAL is safe in WAL mode and avoids an fsync on every commit.
+PRAGMAS = (
+  "PRAGMA journal_mode=WAL",
+  "PRAGMA synchronous=NORMAL",
+  "PRAGMA temp_store=MEMORY",
+  "PRAGMA cache_size=-16000",
+  "PRAGMA busy_timeout=5000",
+  "PRAGMA foreign_keys=ON",
+)
+
+# Connection pool
+class ConnectionPool:
+  """
+  Bounded pool of SQLite connections shared by the executor threads.
+  Connections are opened lazily and keep their prepared statement cache between calls,
+  so the constant SQL strings below are compiled once per connection.
+  """
+  def __init__(self, path, size):
+    self.path = path
+    self.size = size
+    self._idle = queue.LifoQueue(maxsize=size)
+    self._created = 0
+    self._lock = threading.Lock()
+
+  def _connect(self):
+    conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False, cached_statements=256)
+    for pragma in PRAGMAS:
+      conn.execute(pragma)
+    return conn
+
+  def _acquire(self):
+    try:
+      return self._idle.get_nowait()
+    except queue.Empty:
+      pass
+    with self._lock:
+      if self._created < self.size:
+        self._created += 1
+        try:
+          return self._connect()
+        except Exception:
+          self._created -= 1
+          raise
+    return self._idle.get()
+
+  @contextmanager
+  def connection(self):
+    conn = self._acquire()
+    try:
+      yield conn
+    except BaseException:
+      conn.rollback()
+      raise
+    finally:
+      self._idle.put(conn)
+
+  def close(self):
+    while True:
+      try:
+        self._idle.get_nowait().close()
+      except queue.Empty:
+        break
+    self._created = 0
+
+pool = ConnectionPool(DB_PATH, DB_POOL_SIZE)
+_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix='db')
+
+def _call(fn, args, queued):
+  start = time.perf_counter()
+  metrics.db_wait.observe(start - queued)
+  try:
+    with pool.connection() as conn:
+      return fn(conn, *args)
+  finally:
+    metrics.db_latency.observe(time.perf_counter() - start, fn.__name__)
+
+async def run(fn, *args):
+  """
+  Run fn(conn, *args) on a pooled connection in the DB thread pool, off the event loop.
+  """
+  loop = asyncio.get_running_loop()
+  return await loop.run_in_executor(_executor, _call, fn, args, time.perf_counter())
+
+async def run_shared(fn, *args):
+  """
+  Run fn(*args), a call on the shared state, in the DB thread pool if the backend blocks.
+  """
+  if not shared.blocking:
+    return fn(*args)
+  loop = asyncio.get_running_loop()
+  return await loop.run_in_executor(_executor, fn, *args)
+
+def close():
+  _executor.shutdown(wait=True)
+  pool.close()
+
+# Dates are stored as integer seconds since the epoch, reading naive datetimes as UTC
+EPOCH = datetime(1970, 1, 1)
+
+def to_epoch(dt):
+  return calendar.timegm(dt.timetuple()) if dt is not None else None
+
+def from_epoch(ts):
+  return EPOCH + timedelta(seconds=ts) if ts is not None else None
+
+# Schema migrations
+def _migration_initial(conn):
+  conn.execute('''CREATE TABLE IF NOT EXISTS events
+         (id INTEGER PRIMARY KEY, title TEXT, description TEXT, price INTEGER, image_path TEXT,
+         start_location TEXT, end_location TEXT, transfer_price INTEGER, transfer_time DATETIME, date DATETIME, active BOOLEAN)''')
+  conn.execute('''CREATE TABLE IF NOT EXISTS payments
+         (id INTEGER PRIMARY KEY, event_id INTEGER, user_id INTEGER, amount INTEGER,
+          timestamp DATETIME DEFAULT CURRENT_TIMESTAMP, is_transfer BOOLEAN,
+          transfer_start_location TEXT, time DATETIME, quantity INTEGER)''')
+
+def _migration_image_file_id(conn):
+  # Databases set up before versioning may already have the column
+  columns = [row[1] for row in conn.execute("PRAGMA table_info(events)")]
+  if 'image_file_id' not in columns:
+    conn.execute("ALTER TABLE events ADD COLUMN image_file_id TEXT")
+
+def _migration_epoch_dates(conn):
+  # SQLite can't change a column type: rebuild both tables, converting the DATETIME text
+  conn.execute('''CREATE TABLE events_new
+         (id INTEGER PRIMARY KEY, title TEXT, description TEXT, price INTEGER, image_path TEXT,
+         start_location TEXT, end_location TEXT, transfer_price INTEGER, transfer_time INTEGER, date INTEGER, active BOOLEAN,
+         image_file_id TEXT)''')
+  conn.execute("""INSERT INTO events_new
+         SELECT id, title, description, price, image_path, start_location, end_location, transfer_price,
+         CAST(strftime('%s', transfer_time) AS INTEGER), CAST(strftime('%s', date) AS INTEGER), active, image_file_id
+         FROM events""")
+  conn.execute("DROP TABLE events")
+  conn.execute("ALTER TABLE events_new RENAME TO events")
+  conn.execute('''CREATE TABLE payments_new
+         (id INTEGER PRIMARY KEY, event_id INTEGER, user_id INTEGER, amount INTEGER,
+          timestamp INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)), is_transfer BOOLEAN,
+          transfer_start_location TEXT, time INTEGER, quantity INTEGER)''')
+  conn.execute("""INSERT INTO payments_new
+         SELECT id, event_id, user_id, amount, CAST(strftime('%s', timestamp) AS INTEGER), is_transfer,
+         transfer_start_location, CAST(strftime('%s', time) AS INTEGER), quantity
+         FROM payments""")
+  conn.execute("DROP TABLE payments")
+  conn.execute("ALTER TABLE payments_new RENAME TO payments")
+
+def _migration_indexes(conn):
+  conn.execute("CREATE INDEX IF NOT EXISTS payments_user_time ON payments(user_id, time)")
+  conn.execute("CREATE INDEX IF NOT EXISTS payments_event ON payments(event_id)")
+  conn.execute("CREATE INDEX IF NOT EXISTS events_active_date ON events(active, date)")
+
+def _migration_posters(conn):
+  conn.execute('''CREATE TABLE IF NOT EXISTS posters
+         (hash TEXT PRIMARY KEY, original_path TEXT, thumb_path TEXT, invoice_path TEXT,
+          width INTEGER, height INTEGER, bytes INTEGER, created INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)))''')
+
+def _migration_charge_id(conn):
+  conn.execute("ALTER TABLE payments ADD COLUMN charge_id TEXT")
+  # NULLs (payments recorded before this migration) don't collide
+  conn.execute("CREATE UNIQUE INDEX payments_charge_id ON payments(charge_id)")
+
+def _migration_capacity(conn):
+  # NULL: no limit, as for every event created before this migration
+  conn.execute("ALTER TABLE events ADD COLUMN capacity INTEGER")
+  conn.execute("ALTER TABLE events ADD COLUMN transfer_capacity INTEGER")
+
+def _migration_user_state(conn):
+  conn.execute("CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data BLOB, updated INTEGER)")
+  conn.execute("CREATE TABLE IF NOT EXISTS conversations (name TEXT, key TEXT, state BLOB, PRIMARY KEY (name, key))")
+
+def _migration_broadcasts(conn):
+  # One announcement per event; a delivery row is written (claimed) before its message is sent
+  conn.execute('''CREATE TABLE IF NOT EXISTS broadcasts
+         (id INTEGER PRIMARY KEY, event_id INTEGER UNIQUE, chat_id INTEGER, cursor INTEGER DEFAULT 0, done BOOLEAN DEFAULT 0,
+          created INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)))''')
+  conn.execute('''CREATE TABLE IF NOT EXISTS broadcast_deliveries
+         (broadcast_id INTEGER, user_id INTEGER, status TEXT, PRIMARY KEY (broadcast_id, user_id)) WITHOUT ROWID''')
+
+# (version, description, step): append new steps at the end, never edit applied ones
+MIGRATIONS = [
+  (1, "initial events and payments tables", _migration_initial),
+  (2, "events.image_file_id", _migration_image_file_id),
+  (3, "integer epoch dates", _migration_epoch_dates),
+  (4, "indexes on payments(user_id, time), payments(event_id), events(active, date)", _migration_indexes),
+  (5, "posters manifest", _migration_posters),
+  (6, "payments.charge_id, unique", _migration_charge_id),
+  (7, "events.capacity, events.transfer_capacity", _migration_capacity),
+  (8, "user_data and conversations, for SQLitePersistence", _migration_user_state),
+  (9, "broadcasts and broadcast_deliveries", _migration_broadcasts),
+]
+
+def migrate(conn, target=None):
+  """
+  Apply the migrations newer than the schema_version of conn, each in its own transaction.
+  """
+  conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, description TEXT, applied INTEGER)")
+  conn.commit()
+  current = conn.execute("SELECT max(version) FROM schema_version").fetchone()[0] or 0
+  for version, description, step in MIGRATIONS:
+    if version <= current or (target is not None and version > target):
+      continue
+    logger.info(f"Applying migration {version}: {description}")
+    conn.execute("BEGIN")
+    try:
+      step(conn)
+      conn.execute("INSERT INTO schema_version VALUES (?, ?, CAST(strftime('%s', 'now') AS INTEGER))", (version, description))
+      conn.commit()
+    except BaseException:
+      conn.rollback()
+      raise
+  return conn.execute("SELECT max(version) FROM schema_version").fetchone()[0]
+
+# Database setup
+def setup_database():
+  with pool.connection() as conn:
+    migrate(conn)
+
+# Queries (kept as constants so each connection's statement cache can reuse them)
+INSERT_EVENT = """INSERT INTO events (title, description, price, image_path, start_location, end_location, transfer_price, transfer_time, date, active, image_file_id, capacity, transfer_capacity)
+       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+DEACTIVATE_EVENT = "UPDATE events SET active = 0 WHERE id=?"
+UPDATE_EVENT_FILE_ID = "UPDATE events SET image_file_id = ? WHERE id=?"
+INSERT_PAYMENT = """INSERT INTO payments (event_id, user_id, amount, is_transfer, time, quantity, transfer_start_location)
+       VALUES (?, ?, ?, ?, ?, ?, ?)"""
+# Telegram may deliver the same successful payment twice: the charge id makes the insert idempotent
+INGEST_PAYMENT = """INSERT OR IGNORE INTO payments (event_id, user_id, amount, is_transfer, time, quantity, transfer_start_location, charge_id)
+       VALUES (?, ?, ?, ?, ?, ?, CASE WHEN ? THEN (SELECT start_location FROM events WHERE id = ?) END, ?)"""
+SELECT_USER_PAYMENTS = """SELECT events.title, payments.amount, payments.timestamp, payments.is_transfer, payments.transfer_start_location, payments.time, payments.quantity
+       FROM payments
+       JOIN events ON payments.event_id = events.id
+       WHERE payments.user_id = ?"""
+# Keyset pagination over (time, id), served by the payments_user_time index
+SELECT_USER_PAYMENTS_OLDER = """SELECT events.title, payments.amount, payments.timestamp, payments.is_transfer, payments.transfer_start_location, payments.time, payments.quantity, payments.id
+       FROM payments
+       JOIN events ON payments.event_id = events.id
+       WHERE payments.user_id = ? AND (payments.time, payments.id) < (?, ?)
+       ORDER BY payments.time DESC, payments.id DESC
+       LIMIT ?"""
+SELECT_USER_PAYMENTS_NEWER = """SELECT events.title, payments.amount, payments.timestamp, payments.is_transfer, payments.transfer_start_location, payments.time, payments.quantity, payments.id
+       FROM payments
+       JOIN events ON payments.event_id = events.id
+       WHERE payments.user_id = ? AND (payments.time, payments.id) > (?, ?)
+       ORDER BY payments.time ASC, payments.id ASC
+       LIMIT ?"""
+SELECT_POSTER = "SELECT hash, original_path, thumb_path, invoice_path, width, height, bytes FROM posters WHERE hash = ?"
+INSERT_POSTER = """INSERT OR IGNORE INTO posters (hash, original_path, thumb_path, invoice_path, width, height, bytes)
+       VALUES (?, ?, ?, ?, ?, ?, ?)"""
+SELECT_ACTIVE_EVENTS = "SELECT * FROM events WHERE active = 1 ORDER BY date, id"
+SELECT_ACTIVE_EVENT = "SELECT * FROM events WHERE active = 1 and id = ?"
+SELECT_EVENT = "SELECT * FROM events WHERE id = ?"
+SELECT_USER_DATA = "SELECT data FROM user_data WHERE user_id = ?"
+UPSERT_USER_DATA = """INSERT INTO user_data (user_id, data, updated) VALUES (?, ?, CAST(strftime('%s', 'now') AS INTEGER))
+       ON CONFLICT (user_id) DO UPDATE SET data = excluded.data, updated = excluded.updated"""
+DELETE_USER_DATA = "DELETE FROM user_data WHERE user_id = ?"
+SELECT_CONVERSATIONS = "SELECT key, state FROM conversations WHERE name = ?"
+UPSERT_CONVERSATION = """INSERT INTO conversations (name, key, state) VALUES (?, ?, ?)
+       ON CONFLICT (name, key) DO UPDATE SET state = excluded.state"""
+DELETE_CONVERSATION = "DELETE FROM conversations WHERE name = ? AND key = ?"
+INSERT_BROADCAST = "INSERT OR IGNORE INTO broadcasts (event_id, chat_id) VALUES (?, ?)"
+SELECT_UNFINISHED_BROADCASTS = "SELECT id, event_id, chat_id, cursor FROM broadcasts WHERE done = 0"
+# Past buyers by keyset on user_id, served by the payments_user_time index
+SELECT_RECIPIENTS = "SELECT DISTINCT user_id FROM payments WHERE user_id > ? ORDER BY user_id LIMIT ?"
+CLAIM_DELIVERY = "INSERT OR IGNORE INTO broadcast_deliveries (broadcast_id, user_id, status) VALUES (?, ?, 'claimed')"
+RELEASE_DELIVERY = "DELETE FROM broadcast_deliveries WHERE broadcast_id = ? AND user_id = ? AND status = 'claimed'"
+UPDATE_DELIVERY = "UPDATE broadcast_deliveries SET status = ? WHERE broadcast_id = ? AND user_id = ?"
+UPDATE_BROADCAST_CURSOR = "UPDATE broadcasts SET cursor = ? WHERE id = ?"
+FINISH_BROADCAST = "UPDATE broadcasts SET done = 1 WHERE id = ?"
+SELECT_BROADCAST_COUNTS = "SELECT status, COUNT(*) FROM broadcast_deliveries WHERE broadcast_id = ? GROUP BY status"
+SELECT_SOLD = """SELECT event_id, is_transfer, SUM(quantity) FROM payments
+       WHERE event_id IN (SELECT id FROM events WHERE active = 1)
+       GROUP BY event_id, is_transfer"""
+
+def _add_event(conn, title, description, price, image_path, start_location, end_location, transfer_price, transfer_time, date, active, image_file_id, capacity, transfer_capacity):
+  with conn:
+    c = conn.execute(INSERT_EVENT,
+      (title, description, price, image_path, start_location, end_location, transfer_price, to_epoch(transfer_time), to_epoch(date), active, image_file_id, capacity, transfer_capacity))
+  return conn.execute(SELECT_EVENT, (c.lastrowid,)).fetchone()
+
+def _add_events(conn, events):
+  with conn:
+    event_ids = [conn.execute(INSERT_EVENT,
+      (title, description, price, image_path, start_location, end_location, transfer_price, to_epoch(transfer_time), to_epoch(date), active, image_file_id, capacity, transfer_capacity)).lastrowid
+      for title, description, price, image_path, start_location, end_location, transfer_price, transfer_time, date, active, image_file_id, capacity, transfer_capacity in events]
+  return [conn.execute(SELECT_EVENT, (event_id,)).fetchone() for event_id in event_ids]
+
+def _set_event_file_id(conn, event_id, file_id):
+  with conn:
+    conn.execute(UPDATE_EVENT_FILE_ID, (file_id, event_id))
+  return conn.execute(SELECT_EVENT, (event_id,)).fetchone()
+
+def _rm_event(conn, event_id):
+  with conn:
+    conn.execute(DEACTIVATE_EVENT, (event_id,))
+  return event_id
+
+def _add_payment(conn, event_id, user_id, amount, is_transfer, time, quantity, transfer_start_location):
+  with conn:
+    c = conn.execute(INSERT_PAYMENT,
+      (event_id, user_id, amount, is_transfer, to_epoch(datetime.strptime(time, "%d/%m/%Y %H:%M")), quantity, transfer_start_location))
+  return c.lastrowid
+
+def _ingest_payments(conn, payments):
+  # Payments are confirmed to the user after this commit: make it survive a power cut
+  conn.execute("PRAGMA synchronous=FULL")
+  try:
+    with conn:
+      inserted = []
+      for event_id, user_id, amount, is_transfer, paid_at, quantity, charge_id in payments:
+        c = conn.execute(INGEST_PAYMENT,
+          (event_id, user_id, amount, is_transfer, to_epoch(datetime.strptime(paid_at, "%d/%m/%Y %H:%M")), quantity, is_transfer, event_id, charge_id))
+        inserted.append(c.rowcount == 1)
+  finally:
+    conn.execute("PRAGMA synchronous=NORMAL")
+  return inserted
+
+def _get_user_payments(conn, user_id):
+  return conn.execute(SELECT_USER_PAYMENTS, (user_id,)).fetchall()
+
+def _get_user_payments_page(conn, user_id, time, payment_id, newer, limit):
+  if newer:
+    return conn.execute(SELECT_USER_PAYMENTS_NEWER, (user_id, time, payment_id, limit)).fetchall()[::-1]
+  return conn.execute(SELECT_USER_PAYMENTS_OLDER, (user_id, time, payment_id, limit)).fetchall()
+
+def _get_poster(conn, digest):
+  return conn.execute(SELECT_POSTER, (digest,)).fetchone()
+
+def _add_poster(conn, poster):
+  with conn:
+    conn.execute(INSERT_POSTER, poster)
+  return poster
+
+def _get_all_events(conn):
+  return conn.execute(SELECT_ACTIVE_EVENTS).fetchall()
+
+def _get_event(conn, event_id, active_only):
+  return conn.execute(SELECT_ACTIVE_EVENT if active_only else SELECT_EVENT, (event_id,)).fetchone()
+
+def _get_sold(conn):
+  return conn.execute(SELECT_SOLD).fetchall()
+
+def _add_broadcast(conn, event_id, chat_id):
+  with conn:
+    c = conn.execute(INSERT_BROADCAST, (event_id, chat_id))
+  return c.lastrowid if c.rowcount else None
+
+def _get_unfinished_broadcasts(conn):
+  return conn.execute(SELECT_UNFINISHED_BROADCASTS).fetchall()
+
+def _claim_recipients(conn, broadcast_id, after, limit, results):
+  """
+  Record the (status, broadcast_id, user_id) results of earlier sends, then claim the next
+  page of recipients after user id `after` and move the broadcast cursor past them.
+  Returns the newly claimed user ids and the new cursor, None when there are no more.
+  """
+  with conn:
+    conn.executemany(UPDATE_DELIVERY, results)
+    rows = conn.execute(SELECT_RECIPIENTS, (after, limit)).fetchall()
+    # Users claimed before a restart are skipped: they may have been sent to already
+    claimed = [user_id for user_id, in rows if conn.execute(CLAIM_DELIVERY, (broadcast_id, user_id)).rowcount]
+    if rows:
+      conn.execute(UPDATE_BROADCAST_CURSOR, (rows[-1][0], broadcast_id))
+  return claimed, rows[-1][0] if rows else None
+
+def _release_recipients(conn, broadcast_id, user_ids, results):
+  """
+  Record results and give back the claims of user_ids, never sent to, moving the cursor
+  back so that they are claimed again when the broadcast resumes.
+  """
+  with conn:
+    conn.executemany(UPDATE_DELIVERY, results)
+    conn.executemany(RELEASE_DELIVERY, ((broadcast_id, user_id) for user_id in user_ids))
+    if user_ids:
+      conn.execute(UPDATE_BROADCAST_CURSOR, (min(user_ids) - 1, broadcast_id))
+
+def _finish_broadcast(conn, broadcast_id, results):
+  with conn:
+    conn.executemany(UPDATE_DELIVERY, results)
+    conn.execute(FINISH_BROADCAST, (broadcast_id,))
+  return dict(conn.execute(SELECT_BROADCAST_COUNTS, (broadcast_id,)).fetchall())
+
+def _get_user_data(conn, user_id):
+  row = conn.execute(SELECT_USER_DATA, (user_id,)).fetchone()
+  return pickle.loads(row[0]) if row else None
+
+def _get_conversations(conn, name):
+  # Keys are tuples of chat/user ids, stored as JSON arrays
+  return {tuple(json.loads(key)): pickle.loads(state) for key, state in conn.execute(SELECT_CONVERSATIONS, (name,))}
+
+def _save_user_state(conn, user_data, conversations):
+  """
+  user_data: {user_id: pickled dict or None to delete}, conversations: {(name, key): pickled state or None to delete}
+  """
+  with conn:
+    for user_id, data in user_data.items():
+      if data is None:
+        conn.execute(DELETE_USER_DATA, (user_id,))
+      else:
+        conn.execute(UPSERT_USER_DATA, (user_id, data))
+    for (name, key), state in conversations.items():
+      if state is None:
+        conn.execute(DELETE_CONVERSATION, (name, json.dumps(key)))
+      else:
+        conn.execute(UPSERT_CONVERSATION, (name, json.dumps(key), state))
+
+# Generation counters shared with the other bot processes, if any (cluster.py)
+shared = shared_state.from_env()
+
+async def _bump(key):
+  """
+  Tell the other processes that key changed. A failure is only logged: the change it announces
+  is committed already, and their copies catch up with the next bump.
+  """
+  try:
+    await run_shared(shared.bump, key)
+  except Exception as e:
+    logger.warning(f"Failed to bump the {key} generation: {e}")
+
+async def _generation(key):
+  """
+  The current generation of key, None if the shared state can't be read.
+  """
+  try:
+    return await run_shared(shared.generation, key)
+  except Exception as e:
+    logger.warning(f"Failed to read the {key} generation: {e}")
+    return None
+
+# Active events cache
+class EventCache:
+  """
+  Process-wide cache of the active events, keyed by id.
+  Loaded from the DB on first use and kept current by add_event/rm_event (write-through),
+  so listings and lookups of active events never touch the disk. Changes made by other
+  processes are picked up by sync().
+  """
+  def __init__(self):
+    self._events = None
+    self._generation = None
+    self.version = 0
+    self.hits = 0
+    self.misses = 0
+
+  async def _load(self):
+    self.misses += 1
+    version = self.version
+    generation = await _generation('events')
+    events = {event[0]: event for event in await run(_get_all_events)}
+    # A write landed while we were reading: our snapshot may be stale, the next call reloads
+    if version == self.version:
+      self._events = events
+      self._generation = generation
+    return events
+
+  async def all(self):
+    if self._events is None:
+      return list((await self._load()).values())
+    self.hits += 1
+    return list(self._events.values())
+
+  async def get(self, event_id):
+    if self._events is None:
+      return (await self._load()).get(event_id)
+    self.hits += 1
+    return self._events.get(event_id)
+
+  async def put(self, *events):
+    self.version += 1
+    if self._events is not None:
+      for event in events:
+        if event[10]:
+          self._events[event[0]] = event
+        else:
+          self._events.pop(event[0], None)
+      # Same order as SELECT_ACTIVE_EVENTS
+      self._events = dict(sorted(self._events.items(), key=lambda item: (item[1][9], item[0])))
+    await _bump('events')
+
+  async def discard(self, event_id):
+    self.version += 1
+    if self._events is not None:
+      self._events.pop(event_id, None)
+    await _bump('events')
+
+  def invalidate(self):
+    self.version += 1
+    self._events = None
+
+  async def sync(self):
+    """
+    Drop the cached events if a process changed them since they were loaded (our own
+    changes included: they cost one reload).
+    """
+    if self._events is None:
+      return
+    generation = await _generation('events')
+    if generation is not None and generation != self._generation:
+      self.invalidate()
+
+  def stats(self):
+    return {'hits': self.hits, 'misses': self.misses, 'size': len(self._events or ())}
+
+events_cache = EventCache()
+
+# Ticket inventory
+class InventoryLedger:
+  """
+  Tickets and transfer seats sold or held, per (event_id, is_transfer), kept in memory.
+  Pre-checkout reserves against it without touching the DB: every check-and-hold runs
+  on the event loop with no await in between, so concurrent checkouts can't oversell.
+  A hold is turned into a sale once the payment is committed, or expires after ttl seconds.
+  With several bot processes only one takes payments: the others only show availability,
+  and sync() reloads their counts when it sells.
+  """
+  def __init__(self, ttl=RESERVATION_TTL):
+    self.ttl = ttl
+    self._sold = None
+    self._generation = None
+    # key -> OrderedDict(hold -> (quantity, expires)), in expiry order as the ttl is fixed
+    self._holds = {}
+    self._held = {}
+    self.rejected = 0
+
+  async def load(self):
+    self._generation = await _generation('sales')
+    sold = {}
+    for event_id, is_transfer, quantity in await run(_get_sold):
+      sold[(event_id, bool(is_transfer))] = quantity
+    self._sold = sold
+
+  def _expire(self, key, now):
+    holds = self._holds.get(key)
+    while holds:
+      hold, (quantity, expires) = next(iter(holds.items()))
+      if expires > now:
+        break
+      del holds[hold]
+      self._held[key] -= quantity
+
+  def _release(self, key, hold):
+    holds = self._holds.get(key)
+    if holds and hold in holds:
+      self._held[key] -= holds.pop(hold)[0]
+      return True
+    return False
+
+  def _free(self, event, is_transfer):
+    capacity = event[13] if is_transfer else event[12]
+    if capacity is None:
+      return None
+    key = (event[0], is_transfer)
+    self._expire(key, time.monotonic())
+    return capacity - self._sold.get(key, 0) - self._held.get(key, 0)
+
+  async def available(self, event, is_transfer):
+    """
+    Tickets (or transfer seats) still free for event, None if it has no capacity.
+    """
+    if self._sold is None:
+      await self.load()
+    return self._free(event, is_transfer)
+
+  async def reserve(self, event, is_transfer, hold, quantity):
+    """
+    Hold quantity tickets for hold, replacing its previous hold if any. False if there aren't enough left.
+    """
+    if self._sold is None:
+      await self.load()
+    key = (event[0], is_transfer)
+    self._release(key, hold)
+    available = self._free(event, is_transfer)
+    if available is not None and quantity > available:
+      self.rejected += 1
+      return False
+    self._holds.setdefault(key, OrderedDict())[hold] = (quantity, time.monotonic() + self.ttl)
+    self._held[key] = self._held.get(key, 0) + quantity
+    return True
+
+  async def commit(self, event_id, is_transfer, hold, quantity):
+    key = (event_id, is_transfer)
+    if not self._release(key, hold):
+      logger.warning(f"Payment for event {event_id} completed without a live reservation")
+    if self._sold is not None:
+      self._sold[key] = self._sold.get(key, 0) + quantity
+    await _bump('sales')
+
+  async def sync(self):
+    if self._sold is None:
+      return
+    generation = await _generation('sales')
+    if generation is not None and generation != self._generation:
+      await self.load()
+
+  def release(self, event_id, is_transfer, hold):
+    self._release((event_id, is_transfer), hold)
+
+  def stats(self):
+    return {'held': sum(self._held.values()), 'holds': sum(map(len, self._holds.values())), 'rejected': self.rejected}
+
+inventory = InventoryLedger()
+
+# Payment ingestion
+class PaymentIngestor:
+  """
+  Writes successful payments in batches: while one transaction commits, the payments
+  arriving meanwhile queue up and go together in the next one, so a burst costs a few
+  fsyncs instead of one per payment, and a lone payment waits for no timer.
+  """
+  def __init__(self, max_batch=500):
+    self.max_batch = max_batch
+    self._queue = None
+    self._task = None
+
+  def start(self):
+    self._queue = asyncio.Queue()
+    self._task = asyncio.create_task(self._run())
+
+  async def stop(self):
+    if self._task is not None:
+      await self._queue.put(None)
+      await self._task
+      self._task = None
+
+  async def submit(self, event_id, user_id, amount, is_transfer, paid_at, quantity, charge_id):
+    """
+    Queue a payment and wait until it is committed. False if the charge id was already recorded.
+    """
+    future = asyncio.get_running_loop().create_future()
+    await self._queue.put(((event_id, user_id, amount, is_transfer, paid_at, quantity, charge_id), future))
+    return await future
+
+  def queue_depth(self):
+    return self._queue.qsize() if self._queue is not None else 0
+
+  async def _run(self):
+    stopping = False
+    while not stopping:
+      item = await self._queue.get()
+      if item is None:
+        break
+      batch = [item]
+      while len(batch) < self.max_batch and not self._queue.empty():
+        item = self._queue.get_nowait()
+        if item is None:
+          stopping = True
+          break
+        batch.append(item)
+      # A failed batch fails its own payments only: the loop keeps serving later ones
+      try:
+        inserted = await run(_ingest_payments, [payment for payment, _ in batch])
+      except Exception as e:
+        logger.exception(f"Failed to store {len(batch)} payments")
+        for _, future in batch:
+          if not future.done():
+            future.set_exception(e)
+      else:
+        # The payment is committed anyway, but whoever submitted it may have been cancelled meanwhile
+        for (_, future), new in zip(batch, inserted):
+          if not future.done():
+            future.set_result(new)
+
+payment_ingestor = PaymentIngestor()
+
+# Database handlers
+async def add_event(title, description, price, image_path, start_location, end_location, transfer_price, transfer_time, date, active = True, image_file_id = None, capacity = None, transfer_capacity = None):
+  event = await run(_add_event, title, description, price, image_path, start_location, end_location, transfer_price, transfer_time, date, active, image_file_id, capacity, transfer_capacity)
+  await events_cache.put(event)
+  return event[0]
+
+async def add_events_bulk(events):
+  """
+  Insert events, tuples of add_event's arguments, in a single transaction: all of them or none.
+  Returns their ids, in order.
+  """
+  rows = await run(_add_events, events)
+  if rows:
+    await events_cache.put(*rows)
+  return [event[0] for event in rows]
+
+async def set_event_file_id(event_id, file_id):
+  """
+  Remember the Telegram file_id of an event poster so later sends don't re-upload it.
+  """
+  event = await run(_set_event_file_id, event_id, file_id)
+  if event:
+    await events_cache.put(event)
+  return event
+
+async def rm_event(event_id):
+  await run(_rm_event, event_id)
+  await events_cache.discard(event_id)
+  return event_id
+
+async def add_payment(event_id, user_id, amount, is_transfer, time, quantity, transfer_start_location=None):
+  return await run(_add_payment, event_id, user_id, amount, is_transfer, time, quantity, transfer_start_location)
+
+async def get_user_payments(user_id):
+  return await run(_get_user_payments, user_id)
+
+async def get_user_payments_page(user_id, cursor=None, newer=False, limit=5):
+  """
+  Up to limit payments of the user, latest event time first, strictly older (or newer)
+  than cursor, a (time, id) pair of a row from a previous page. No cursor: the latest ones.
+  Rows are the get_user_payments columns plus payments.id.
+  """
+  time, payment_id = cursor or (2**62, 2**62)
+  return await run(_get_user_payments_page, user_id, time, payment_id, newer, limit)
+
+async def get_poster(digest):
+  return await run(_get_poster, digest)
+
+async def add_poster(poster):
+  return await run(_add_poster, poster)
+
+async def get_all_events():
+  return await events_cache.all()
+
+async def get_event(id : int, active_only=True):
+  event = await events_cache.get(id)
+  if event is None and not active_only:
+    # Removed events are not cached, e.g. a payment completing after rm_event
+    return await run(_get_event, id, active_only)
+  return event
+
+async def get_user_data(user_id):
+  return await run(_get_user_data, user_id)
+
+async def get_conversations(name):
+  return await run(_get_conversations, name)
+
+async def save_user_state(user_data, conversations):
+  return await run(_save_user_state, user_data, conversations)
+
+async def add_broadcast(event_id, chat_id):
+  """
+  Create the announcement of event_id. None if the event was already announced.
+  """
+  return await run(_add_broadcast, event_id, chat_id)
+
+async def get_unfinished_broadcasts():
+  return await run(_get_unfinished_broadcasts)
+
+async def claim_recipients(broadcast_id, after, limit, results):
+  return await run(_claim_recipients, broadcast_id, after, limit, results)
+
+async def release_recipients(broadcast_id, user_ids, results):
+  return await run(_release_recipients, broadcast_id, user_ids, results)
+
+async def finish_broadcast(broadcast_id, results):
+  return await run(_finish_broadcast, broadcast_id, results)
@@ -0,0 +1,382 @@
+"""
+Load test: runs the bot's Application (build_application, as main() does) against a local
+stand-in for the Bot API and replays synthetic users, then reports latency and throughput.
+
+  python loadtest.py --users 500 --mix browse=40,storm=30,checkout=25,add_event=5
+
+Each virtual user sends one update at a time and waits for the bot's first reaction to it
+(the answer to a callback or pre-checkout query, or the first message/edit to its chat):
+that wait is the latency reported. Telegram's flood limits are lifted unless --flood-limits
+is given, so the numbers measure the bot rather than the OutboundScheduler pacing.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from collections import defaultdict
+from urllib.parse import parse_qsl
+
+TOKEN = '123456:loadtest'
+
+def _png(side=64):
+  """
+  A small valid PNG, sent as the poster of the add-event conversation.
+  """
+  def chunk(tag, data):
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+  rows = b''.join(b'\x00' + b''.join(bytes((x * 4 % 256, y * 4 % 256, 128)) for x in range(side)) for y in range(side))
+  return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', side, side, 8, 2, 0, 0, 0))
+          + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b''))
+
+POSTER = _png()
+
+# Fake Bot API
+class FakeBotAPI:
+  """
+  Minimal HTTP/1.1 server (keep-alive, no TLS) answering the Bot API methods the bot uses.
+  Updates pushed with push() are handed out by getUpdates; the bot's calls resolve the
+  futures registered with expect().
+  """
+  def __init__(self):
+    self._updates = []
+    self._new_updates = asyncio.Event()
+    self._update_ids = itertools.count(1)
+    self._message_ids = itertools.count(1)
+    self._waiters = {}
+    # chat_id -> last message the bot sent or edited there (callback queries are attached to it)
+    self.messages = {}
+    # chat_id -> parameters of the last sendInvoice
+    self.invoices = {}
+    self.calls = defaultdict(int)
+
+  def push(self, update):
+    update['update_id'] = next(self._update_ids)
+    self._updates.append(update)
+    self._new_updates.set()
+
+  def expect(self, key):
+    future = asyncio.get_running_loop().create_future()
+    self._waiters[key] = future
+    return future
+
+  def _resolve(self, key):
+    future = self._waiters.pop(key, None)
+    if future is not None and not future.done():
+      future.set_result(time.perf_counter())
+
+  async def start(self, host='127.0.0.1', port=0):
+    self._server = await asyncio.start_server(self._serve, host, port)
+    return self._server.sockets[0].getsockname()[1]
+
+  def close(self):
+    self._server.close()
+
+  async def _serve(self, reader, writer):
+    try:
+      while True:
+        request_line = await reader.readline()
+        if not request_line:
+          break
+        headers = {}
+        while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+          name, _, value = line.decode('latin-1').partition(':')
+          headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+        method, path = request_line.decode('latin-1').split()[:2]
+        if path.startswith('/file/'):
+          status, content_type, payload = '200 OK', 'image/png', POSTER
+        else:
+          result = await self._call(path.rsplit('/', 1)[-1], self._params(headers.get('content-type', ''), body))
+          status, content_type, payload = '200 OK', 'application/json', json.dumps({'ok': True, 'result': result}).encode()
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(payload)}\r\n\r\n".encode() + payload)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+      pass
+    finally:
+      writer.close()
+
+  @staticmethod
+  def _params(content_type, body):
+    if 'multipart/form-data' in content_type:
+      # Uploads: only the text fields matter here
+      fields = re.findall(rb'name="([^"]+)"\r\n\r\n(.*?)\r\n--', body, re.DOTALL)
+      pairs = [(name.decode(), value.decode('utf-8', 'replace')) for name, value in fields]
+    elif 'json' in content_type:
+      return json.loads(body or b'{}')
+    else:
+      pairs = parse_qsl(body.decode())
+    params = {}
+    for name, value in pairs:
+      try:
+        params[name] = json.loads(value)
+      except ValueError:
+        params[name] = value
+    return params
+
+  def _message(self, params, **extra):
+    chat_id = params.get('chat_id', 0)
+    message = {'message_id': params.get('message_id') or next(self._message_ids), 'date': int(time.time()),
+               'chat': {'id': chat_id, 'type': 'private'}, **extra}
+    if 'text' in params:
+      message['text'] = params['text']
+    if 'caption' in params:
+      message['caption'] = params['caption']
+    if 'inline_keyboard' in (params.get('reply_markup') or {}):
+      # Only inline keyboards stay attached to a message
+      message['reply_markup'] = params['reply_markup']
+    self.messages[chat_id] = message
+    return message
+
+  async def _call(self, method, params):
+    self.calls[method] += 1
+    if method == 'getMe':
+      return {'id': 1, 'is_bot': True, 'first_name': 'Load test', 'username': 'loadtest_bot'}
+    if method == 'getUpdates':
+      offset = params.get('offset') or 0
+      self._updates = [update for update in self._updates if update['update_id'] >= offset]
+      if not self._updates:
+        self._new_updates.clear()
+        try:
+          await asyncio.wait_for(self._new_updates.wait(), min(float(params.get('timeout') or 0), 1.0))
+        except asyncio.TimeoutError:
+          pass
+      return self._updates[:int(params.get('limit') or 100)]
+    if method == 'getFile':
+      return {'file_id': params['file_id'], 'file_unique_id': params['file_id'], 'file_size': len(POSTER), 'file_path': 'photos/poster.png'}
+    if method == 'answerCallbackQuery':
+      self._resolve(('callback', str(params['callback_query_id'])))
+      return True
+    if method == 'answerPreCheckoutQuery':
+      self._resolve(('precheckout', str(params['pre_checkout_query_id'])))
+      return True
+    if method.startswith(('send', 'edit')):
+      chat_id = params.get('chat_id')
+      if method == 'sendInvoice':
+        self.invoices[chat_id] = params
+        self._resolve(('invoice', chat_id))
+      extra = {}
+      if method in ('sendPhoto', 'editMessageMedia'):
+        extra['photo'] = [{'file_id': f'photo-{chat_id}', 'file_unique_id': f'photo-{chat_id}', 'width': 1280, 'height': 1280}]
+      message = self._message(params, **extra)
+      self._resolve(('chat', chat_id))
+      return message
+    return True
+
+# Virtual users
+class Stats:
+  def __init__(self):
+    self.latencies = defaultdict(list)
+    self.timeouts = defaultdict(int)
+
+  def report(self, elapsed):
+    total = sum(map(len, self.latencies.values()))
+    print(f"{total} updates answered in {elapsed:.1f} s: {total / elapsed:.1f} updates/s")
+    print(f"{'step':<22}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}{'timeouts':>10}")
+    everything = []
+    for step in sorted(set(self.latencies) | set(self.timeouts)):
+      timings = sorted(self.latencies[step])
+      everything += timings
+      if timings:
+        print(f"{step:<22}{len(timings):>8}{timings[len(timings) // 2] * 1000:>10.1f}{timings[int(len(timings) * 0.99)] * 1000:>10.1f}{timings[-1] * 1000:>10.1f}{self.timeouts[step]:>10}")
+      else:
+        print(f"{step:<22}{0:>8}{'-':>10}{'-':>10}{'-':>10}{self.timeouts[step]:>10}")
+    everything.sort()
+    if everything:
+      print(f"{'all':<22}{len(everything):>8}{everything[len(everything) // 2] * 1000:>10.1f}{everything[int(len(everything) * 0.99)] * 1000:>10.1f}{everything[-1] * 1000:>10.1f}{sum(self.timeouts.values()):>10}")
+
+class User:
+  ids = itertools.count(1)
+
+  def __init__(self, api, stats, user_id, timeout):
+    self.api = api
+    self.stats = stats
+    self.id = user_id
+    self.timeout = timeout
+
+  def _from(self):
+    return {'id': self.id, 'is_bot': False, 'first_name': f'User {self.id}'}
+
+  def _message(self, **fields):
+    return {'message': {'message_id': next(self.ids), 'date': int(time.time()), 'chat': {'id': self.id, 'type': 'private'},
+                        'from': self._from(), **fields}}
+
+  async def _step(self, step, update, key):
+    future = self.api.expect(key)
+    start = time.perf_counter()
+    self.api.push(update)
+    try:
+      done = await asyncio.wait_for(future, self.timeout)
+    except asyncio.TimeoutError:
+      self.stats.timeouts[step] += 1
+      return False
+    self.stats.latencies[step].append(done - start)
+    return True
+
+  async def send_text(self, step, text):
+    fields = {'text': text}
+    if text.startswith('/'):
+      fields['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return await self._step(step, self._message(**fields), ('chat', self.id))
+
+  async def send_photo(self, step):
+    photo = [{'file_id': f'poster-{self.id}', 'file_unique_id': f'poster-{self.id}', 'width': 64, 'height': 64}]
+    return await self._step(step, self._message(photo=photo), ('chat', self.id))
+
+  def button(self, label):
+    """
+    callback_data of the first button whose text starts with label in the last message shown.
+    """
+    markup = self.api.messages.get(self.id, {}).get('reply_markup') or {}
+    for row in markup.get('inline_keyboard', ()):
+      for button in row:
+        if button['text'].startswith(label):
+          return button.get('callback_data')
+    return None
+
+  async def tap(self, step, label, key=None):
+    data = self.button(label)
+    if data is None:
+      self.stats.timeouts[f"{step} (no button)"] += 1
+      return False
+    query_id = str(next(self.ids))
+    update = {'callback_query': {'id': query_id, 'from': self._from(), 'chat_instance': str(self.id), 'data': data,
+                                 'message': self.api.messages[self.id]}}
+    return await self._step(step, update, key or ('callback', query_id))
+
+  async def checkout(self):
+    invoice = self.api.invoices[self.id]
+    amount = sum(price['amount'] for price in invoice['prices'])
+    query_id = str(next(self.ids))
+    update = {'pre_checkout_query': {'id': query_id, 'from': self._from(), 'currency': invoice['currency'],
+                                     'total_amount': amount, 'invoice_payload': invoice['payload']}}
+    if not await self._step('pre_checkout', update, ('precheckout', query_id)):
+      return
+    payment = {'currency': invoice['currency'], 'total_amount': amount, 'invoice_payload': invoice['payload'],
+               'telegram_payment_charge_id': f'charge-{query_id}', 'provider_payment_charge_id': f'provider-{query_id}'}
+    await self._step('successful_payment', self._message(successful_payment=payment), ('chat', self.id))
+
+# Scenarios: one run per virtual user, each well under the per-user RateLimiter (40 per minute)
+async def browse(user):
+  if await user.send_text('catalog', 'Eventi'):
+    for _ in range(5):
+      if not await user.tap('page', '▶️'):
+        break
+  await user.send_text('my_payments', 'I tuoi biglietti')
+
+async def storm(user):
+  if await user.send_text('catalog', 'Eventi'):
+    for _ in range(15):
+      await user.tap('+/-', random.choice('+-'))
+
+async def checkout(user):
+  if await user.send_text('catalog', 'Eventi'):
+    await user.tap('+/-', '+')
+    if await user.tap('pay (invoice)', '🎟️', key=('invoice', user.id)):
+      await user.checkout()
+
+async def add_event(user):
+  for text in ('Aggiungi Evento', f'Load test {user.id}', '01/01/2030 21:00', 'Locale', 'Descrizione', '1500', '0'):
+    if not await user.send_text('add_event', text):
+      return
+  if await user.send_photo('add_event (poster)'):
+    await user.send_text('add_event', 'no')
+
+SCENARIOS = {
+  'browse': browse,
+  'storm': storm,
+  'checkout': checkout,
+  'add_event': add_event,
+}
+
+def _mix(text):
+  weights = {}
+  for part in text.split(','):
+    name, _, weight = part.partition('=')
+    if name.strip() not in SCENARIOS:
+      raise argparse.ArgumentTypeError(f"unknown scenario {name!r}, choose from {', '.join(SCENARIOS)}")
+    weights[name.strip()] = float(weight or 1)
+  return weights
+
+async def run(args):
+  api = FakeBotAPI()
+  port = await api.start()
+  # bot.py reads its configuration at import: set it up first
+  os.environ.update({
+    'TOKEN_1': TOKEN,
+    'TELEGRAM_API_URL': f'http://127.0.0.1:{port}',
+    'DB_PATH': os.path.join(args.workdir, 'loadtest.db'),
+    'CONCURRENT_UPDATES': str(args.concurrency),
+  })
+  os.environ.pop('WEBHOOK_URL', None)
+  if not args.flood_limits:
+    os.environ.update({'OUTBOUND_GLOBAL_RATE': '1000000', 'OUTBOUND_CHAT_RATE': '1000000', 'OUTBOUND_CHAT_BURST': '1000'})
+  os.chdir(args.workdir)
+  sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+  import bot
+  import database
+  logging.getLogger().setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+
+  database.setup_database()
+  now = int(time.time())
+  for i in range(args.events):
+    await database.add_event(f"Evento {i}", "Descrizione dell'evento " * 5, 1500, None, "Stazione", "Locale", 800 if i % 2 else None,
+                             database.from_epoch(now + 86400) if i % 2 else None, database.from_epoch(now + (i + 1) * 86400),
+                             True, f'poster-file-{i}', args.users * 10, None)
+
+  application = bot.build_application()
+  await application.initialize()
+  await application.post_init(application)
+  await application.updater.start_polling(poll_interval=0, timeout=1)
+  await application.start()
+
+  stats = Stats()
+  names, weights = zip(*args.mix.items())
+  rng = random.Random(args.seed)
+  random.seed(args.seed)
+
+  async def virtual_user(n):
+    await asyncio.sleep(rng.random() * args.ramp)
+    await SCENARIOS[rng.choices(names, weights)[0]](User(api, stats, 1_000_000 + n, args.timeout))
+
+  start = time.perf_counter()
+  await asyncio.gather(*(virtual_user(n) for n in range(args.users)))
+  elapsed = time.perf_counter() - start
+
+  await application.updater.stop()
+  await application.stop()
+  await application.post_stop(application)
+  await application.shutdown()
+  await application.post_shutdown(application)
+  api.close()
+
+  print()
+  stats.report(elapsed)
+  print(f"API calls: {dict(sorted(api.calls.items()))}")
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--users', type=int, default=200, help="virtual users, each running one scenario")
+  parser.add_argument('--mix', type=_mix, default=_mix('browse=40,storm=30,checkout=25,add_event=5'), help="scenario=weight,...")
+  parser.add_argument('--events', type=int, default=10, help="active events in the catalog")
+  parser.add_argument('--ramp', type=float, default=2.0, help="seconds over which the users start")
+  parser.add_argument('--concurrency', type=int, default=64, help="CONCURRENT_UPDATES for the bot")
+  parser.add_argument('--timeout', type=float, default=10.0, help="seconds to wait for each reaction")
+  parser.add_argument('--flood-limits', action='store_true', help="keep Telegram's flood limits in the OutboundScheduler")
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--verbose', action='store_true', help="keep the bot's logging")
+  parser.add_argument('--workdir', help="where the DB and posters go (default: a temporary directory)")
+  args = parser.parse_args()
+  if args.workdir:
+    asyncio.run(run(args))
+  else:
+    with tempfile.TemporaryDirectory() as args.workdir:
+      asyncio.run(run(args))
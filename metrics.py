@@ -0,0 +1,267 @@
+"""
+In-process instrumentation: latency histograms, counters and queue depth gauges, served in
+the Prometheus text format on http://127.0.0.1:METRICS_PORT/metrics when METRICS_PORT is set.
+/slow lists the slowest updates seen, with a cProfile report for the ones that were sampled.
+"""
+import asyncio
+import cProfile
+import functools
+import heapq
+import io
+import itertools
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+# Fraction of updates run under cProfile (0 = profiler off) and slowest updates kept
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+SLOW_UPDATES = int(os.getenv('SLOW_UPDATES', '20'))
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+REGISTRY = []
+
+def _labels(names, values):
+  if not names:
+    return ''
+  return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, values)) + '}'
+
+class Histogram:
+  """
+  Cumulative-bucket histogram, one series per combination of label values.
+  observe() may be called from the DB threads as well as the event loop.
+  """
+  def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    self.name = name
+    self.help = help
+    self.labels = labels
+    self.buckets = buckets
+    self._series = {}
+    self._lock = threading.Lock()
+    REGISTRY.append(self)
+
+  def observe(self, value, *label_values):
+    with self._lock:
+      series = self._series.get(label_values)
+      if series is None:
+        series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+      for i, bound in enumerate(self.buckets):
+        if value <= bound:
+          series[0][i] += 1
+          break
+      series[1] += value
+      series[2] += 1
+
+  def collect(self):
+    yield f"# HELP {self.name} {self.help}"
+    yield f"# TYPE {self.name} histogram"
+    with self._lock:
+      series = [(values, list(counts), total, count) for values, (counts, total, count) in self._series.items()]
+    for values, counts, total, count in series:
+      for bound, cumulative in zip(self.buckets, itertools.accumulate(counts)):
+        yield f"{self.name}_bucket{_labels(self.labels + ('le',), values + (bound,))} {cumulative}"
+      yield f"{self.name}_bucket{_labels(self.labels + ('le',), values + ('+Inf',))} {count}"
+      yield f"{self.name}_sum{_labels(self.labels, values)} {total}"
+      yield f"{self.name}_count{_labels(self.labels, values)} {count}"
+
+class Counter:
+  def __init__(self, name, help, labels=()):
+    self.name = name
+    self.help = help
+    self.labels = labels
+    self._values = {}
+    self._lock = threading.Lock()
+    REGISTRY.append(self)
+
+  def inc(self, *label_values, amount=1):
+    with self._lock:
+      self._values[label_values] = self._values.get(label_values, 0) + amount
+
+  def collect(self):
+    yield f"# HELP {self.name} {self.help}"
+    yield f"# TYPE {self.name} counter"
+    with self._lock:
+      values = list(self._values.items())
+    for label_values, value in values:
+      yield f"{self.name}{_labels(self.labels, label_values)} {value}"
+
+class Gauge:
+  """
+  Gauge read at scrape time from the functions registered with track().
+  """
+  def __init__(self, name, help, labels=()):
+    self.name = name
+    self.help = help
+    self.labels = labels
+    self._functions = {}
+    REGISTRY.append(self)
+
+  def track(self, fn, *label_values):
+    self._functions[label_values] = fn
+
+  def collect(self):
+    yield f"# HELP {self.name} {self.help}"
+    yield f"# TYPE {self.name} gauge"
+    for label_values, fn in list(self._functions.items()):
+      try:
+        value = fn()
+      except Exception:
+        logger.exception(f"Gauge {self.name}{label_values} failed")
+        continue
+      yield f"{self.name}{_labels(self.labels, label_values)} {value}"
+
+handler_latency = Histogram('bot_handler_seconds', "Handler callback latency", ('handler',))
+update_latency = Histogram('bot_update_seconds', "Time to process an update, once its user's previous updates are done", ('kind',))
+db_latency = Histogram('bot_db_seconds', "DB helper run time on a pooled connection", ('helper',))
+db_wait = Histogram('bot_db_wait_seconds', "Time DB helpers waited for a free DB thread")
+api_latency = Histogram('bot_api_seconds', "Telegram Bot API call latency", ('endpoint',))
+api_errors = Counter('bot_api_errors_total', "Failed Telegram Bot API calls", ('endpoint', 'error'))
+outbound_wait = Histogram('bot_outbound_wait_seconds', "Time sends waited in the outbound queue", ('lane',))
+dropped_updates = Counter('bot_dropped_updates_total', "Updates dropped before any handler ran", ('reason',))
+queue_depth = Gauge('bot_queue_depth', "Items waiting in the bot's internal queues", ('queue',))
+
+def render():
+  return '\n'.join(line for metric in REGISTRY for line in metric.collect()) + '\n'
+
+# Handlers
+def timed_callback(callback, name=None):
+  """
+  Wrap a handler callback so its latency lands in handler_latency.
+  """
+  if getattr(callback, '_timed', False):
+    return callback
+  name = name or callback.__name__
+
+  @functools.wraps(callback)
+  async def wrapper(*args, **kwargs):
+    start = time.perf_counter()
+    try:
+      return await callback(*args, **kwargs)
+    finally:
+      handler_latency.observe(time.perf_counter() - start, name)
+
+  wrapper._timed = True
+  return wrapper
+
+def _handlers(handler):
+  yield handler
+  # ConversationHandler: time the callbacks of its states rather than the dispatcher itself
+  for inner in getattr(handler, 'entry_points', ()):
+    yield from _handlers(inner)
+  for state_handlers in getattr(handler, 'states', {}).values():
+    for inner in state_handlers:
+      yield from _handlers(inner)
+  for inner in getattr(handler, 'fallbacks', ()):
+    yield from _handlers(inner)
+
+def instrument_handlers(application):
+  for group in application.handlers.values():
+    for handler in group:
+      for inner in _handlers(handler):
+        if hasattr(inner, 'callback'):
+          inner.callback = timed_callback(inner.callback)
+
+# Updates
+def update_kind(update):
+  for kind in ('message', 'callback_query', 'pre_checkout_query', 'edited_message', 'inline_query'):
+    if getattr(update, kind, None) is not None:
+      return kind
+  return type(update).__name__
+
+def _describe(update):
+  user = getattr(update, 'effective_user', None)
+  message = getattr(update, 'effective_message', None)
+  query = getattr(update, 'callback_query', None)
+  detail = (query.data if query else None) or (message.text if message else None) or ''
+  return f"{update_kind(update)} from {user.id if user else '?'}: {detail[:40]!r}"
+
+class SlowUpdates:
+  """
+  Times updates into update_latency and keeps the `keep` slowest. With profile_rate > 0 that
+  fraction of the updates runs under cProfile, one at a time; the profiler sees the whole
+  event loop while the update runs, so concurrent updates show up in its report too.
+  """
+  def __init__(self, keep=SLOW_UPDATES, profile_rate=PROFILE_SAMPLE_RATE):
+    self.keep = keep
+    self.profile_rate = profile_rate
+    # Min-heap of (seconds, seq, description, profile report or None)
+    self._slowest = []
+    self._seq = itertools.count()
+    self._profiling = False
+
+  async def track(self, update, coroutine):
+    profile = None
+    if self.profile_rate and not self._profiling and random.random() < self.profile_rate:
+      self._profiling = True
+      profile = cProfile.Profile()
+      profile.enable()
+    start = time.perf_counter()
+    try:
+      return await coroutine
+    finally:
+      elapsed = time.perf_counter() - start
+      if profile is not None:
+        profile.disable()
+        self._profiling = False
+      update_latency.observe(elapsed, update_kind(update))
+      if len(self._slowest) < self.keep or elapsed > self._slowest[0][0]:
+        report = None
+        if profile is not None:
+          out = io.StringIO()
+          pstats.Stats(profile, stream=out).sort_stats('cumulative').print_stats(25)
+          report = out.getvalue()
+        entry = (elapsed, next(self._seq), _describe(update), report)
+        if len(self._slowest) < self.keep:
+          heapq.heappush(self._slowest, entry)
+        else:
+          heapq.heapreplace(self._slowest, entry)
+
+  def report(self):
+    lines = []
+    for elapsed, _, description, profile in sorted(self._slowest, reverse=True):
+      lines.append(f"{elapsed * 1000:.1f} ms  {description}")
+      if profile:
+        lines.append(profile)
+    return '\n'.join(lines) + '\n'
+
+slow_updates = SlowUpdates()
+
+# HTTP endpoint
+async def _serve_request(reader, writer):
+  try:
+    request_line = await reader.readline()
+    while (await reader.readline()).strip():
+      pass
+    parts = request_line.decode('latin-1').split()
+    path = parts[1] if len(parts) > 1 else '/'
+    if path == '/metrics':
+      status, body = '200 OK', render()
+    elif path == '/slow':
+      status, body = '200 OK', slow_updates.report()
+    else:
+      status, body = '404 Not Found', 'not found\n'
+    data = body.encode()
+    writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                 f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data)
+    await writer.drain()
+  except (ConnectionError, asyncio.IncompleteReadError):
+    pass
+  finally:
+    writer.close()
+
+async def serve(port=METRICS_PORT, host=METRICS_HOST):
+  """
+  Start the /metrics endpoint; returns the asyncio server, or None when port is 0.
+  """
+  if not port:
+    return None
+  server = await asyncio.start_server(_serve_request, host, port)
+  logger.info(f"Metrics on http://{host}:{port}/metrics")
+  return server
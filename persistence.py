@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import os
+import pickle
+import time
+from collections import OrderedDict
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import database
+
+logger = logging.getLogger(__name__)
+
+# Seconds between write-behind flushes, and of inactivity after which a user's data leaves memory
+PERSISTENCE_INTERVAL = float(os.getenv('PERSISTENCE_INTERVAL', '10'))
+USER_DATA_IDLE = float(os.getenv('USER_DATA_IDLE', '1800'))
+
+def _snapshot(value):
+  return pickle.dumps(value, pickle.HIGHEST_PROTOCOL) if value is not None else None
+
+class SQLitePersistence(BasePersistence):
+  """
+  user_data and ConversationHandler states in the bot's SQLite DB.
+
+  Nothing is read at startup but the open conversations: a user's data is loaded the first time
+  one of their updates is processed (refresh_user_data) and dropped from memory after
+  USER_DATA_IDLE seconds without updates, so memory and restart time don't grow with the users.
+  Changes are written behind: every update_interval the application hands over the users
+  it touched, and they are saved together in one transaction. They are pickled as they are
+  handed over, on the event loop, so the write never reads a dict a handler is changing.
+
+  With several bot processes, owns(user_id) tells whether this process is the one serving
+  the user: updates of other users that reach it (payments, see cluster.py) neither load
+  nor save their data, so it can't overwrite the owner's.
+  """
+  def __init__(self, update_interval=PERSISTENCE_INTERVAL, idle_timeout=USER_DATA_IDLE, owns=None):
+    super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+                     update_interval=update_interval)
+    self.idle_timeout = idle_timeout
+    self.owns = owns or (lambda user_id: True)
+    # user_id -> last update, oldest first: the users whose data is in application.user_data
+    self._seen = OrderedDict()
+    self._evicting = set()
+    self._application = None
+    self._evictor = None
+    # Changes not yet committed, pickled: the pending batch and the one being written
+    self._pending_users = {}
+    self._pending_conversations = {}
+    self._writing_users = {}
+    self._writer = None
+
+  # Loading
+  async def get_user_data(self):
+    # Loaded lazily by refresh_user_data
+    return {}
+
+  async def refresh_user_data(self, user_id, user_data):
+    if user_id in self._seen:
+      self._seen.move_to_end(user_id)
+      self._seen[user_id] = time.monotonic()
+      return
+    # Tracked even if not owned, so their empty entry is evicted too
+    self._seen[user_id] = time.monotonic()
+    if not self.owns(user_id):
+      return
+    if user_id in self._pending_users or user_id in self._writing_users:
+      # Evicted with its last changes still on the way to the DB
+      data = self._pending_users.get(user_id, self._writing_users.get(user_id))
+      data = pickle.loads(data) if data is not None else None
+    else:
+      data = await database.get_user_data(user_id)
+    if data:
+      for key, value in data.items():
+        user_data.setdefault(key, value)
+
+  async def get_conversations(self, name):
+    return await database.get_conversations(name)
+
+  # Write-behind
+  async def update_user_data(self, user_id, data):
+    if not self.owns(user_id):
+      return
+    self._pending_users[user_id] = _snapshot(data)
+    self._schedule_write()
+
+  async def drop_user_data(self, user_id):
+    if not self.owns(user_id):
+      self._evicting.discard(user_id)
+      return
+    if user_id in self._evicting:
+      # Evicted from memory, not deleted: keep the row
+      self._evicting.discard(user_id)
+      if user_id in self._seen and user_id in self._application.user_data:
+        # Came back before the application got here, which discards their pending changes
+        self._pending_users[user_id] = _snapshot(self._application.user_data[user_id])
+        self._schedule_write()
+      return
+    self._seen.pop(user_id, None)
+    self._pending_users[user_id] = None
+    self._schedule_write()
+
+  async def update_conversation(self, name, key, new_state):
+    self._pending_conversations[(name, key)] = _snapshot(new_state)
+    self._schedule_write()
+
+  def _schedule_write(self):
+    # The application updates every touched user at once: the task starts after all of them queued
+    if self._writer is None or self._writer.done():
+      self._writer = asyncio.create_task(self._write())
+
+  async def _write(self):
+    while self._pending_users or self._pending_conversations:
+      self._writing_users, self._pending_users = self._pending_users, {}
+      conversations, self._pending_conversations = self._pending_conversations, {}
+      try:
+        await database.save_user_state(self._writing_users, conversations)
+      except Exception:
+        logger.exception(f"Failed to save {len(self._writing_users)} users, {len(conversations)} conversations")
+        # Keep them for the next attempt, without overwriting newer changes
+        self._pending_users = {**self._writing_users, **self._pending_users}
+        self._pending_conversations = {**conversations, **self._pending_conversations}
+        return
+      finally:
+        self._writing_users = {}
+
+  async def flush(self):
+    if self._writer is not None:
+      await self._writer
+    await self._write()
+    if self._evictor is not None:
+      self._evictor.cancel()
+      self._evictor = None
+
+  # Eviction
+  def start(self, application):
+    """
+    Start evicting idle users from application.user_data.
+    """
+    self._application = application
+    self._evictor = asyncio.create_task(self._evict_idle())
+
+  async def _evict_idle(self):
+    while True:
+      await asyncio.sleep(max(self.idle_timeout / 10, self.update_interval))
+      cutoff = time.monotonic() - self.idle_timeout
+      while self._seen:
+        user_id, seen = next(iter(self._seen.items()))
+        if seen > cutoff:
+          break
+        del self._seen[user_id]
+        # idle_timeout is much longer than update_interval: their changes are already saved
+        self._evicting.add(user_id)
+        self._application.drop_user_data(user_id)
+
+  def stats(self):
+    return {'users': len(self._seen), 'pending': len(self._pending_users) + len(self._pending_conversations)}
+
+  # Not stored
+  async def get_chat_data(self):
+    return {}
+
+  async def get_bot_data(self):
+    return {}
+
+  async def get_callback_data(self):
+    return None
+
+  async def update_chat_data(self, chat_id, data):
+    pass
+
+  async def update_bot_data(self, data):
+    pass
+
+  async def update_callback_data(self, data):
+    pass
+
+  async def drop_chat_data(self, chat_id):
+    pass
+
+  async def refresh_chat_data(self, chat_id, chat_data):
+    pass
+
+  async def refresh_bot_data(self, bot_data):
+    pass
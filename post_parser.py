@@ -0,0 +1,153 @@
+"""
+Parser for "Aggiungi Evento Da Post": pulls the date, location, ticket price and transfer out
+of a free-form promo post. Each line is scanned once by TOKENS, a single precompiled pattern
+whose named alternatives are the token kinds (numeric dates, dates with Italian month names,
+times, prices, location markers, transfer keywords and departure points); what a token
+means depends on the line it is in, e.g. a price on a line about the shuttle is the
+transfer price.
+"""
+import re
+from datetime import datetime, timedelta
+
+mesi_estesi = {
+    1: "Gennaio", 2: "Febbraio", 3: "Marzo", 4: "Aprile",
+    5: "Maggio", 6: "Giugno", 7: "Luglio", 8: "Agosto",
+    9: "Settembre", 10: "Ottobre", 11: "Novembre", 12: "Dicembre"
+}
+
+# Month number by lower-case name and abbreviation: "aprile", "apr", "sett"...
+MONTHS = {}
+for number, name in mesi_estesi.items():
+  MONTHS[name.lower()] = number
+  MONTHS[name[:3].lower()] = number
+MONTHS['sett'] = 9
+
+# Longest names first, so "settembre" isn't matched as "set"
+_MONTH_NAMES = '|'.join(sorted(MONTHS, key=len, reverse=True))
+_NUMBER = r'\d+(?:[.,]\d{1,2})?'
+
+TOKENS = re.compile(rf"""
+    (?P<place>(?:📍|📌|(?<!\S)@\s|\b(?:location|luogo|dove|indirizzo)\s*[:\-]|\bpresso\b)\s*(?P<where>\S.*))
+  | (?P<date>\b(?P<day>[0-3]?\d)[/.-](?P<month>[01]?\d)[/.-](?P<year>(?:20)?\d\d)\b
+      | \b(?P<sday>[0-3]?\d)/(?P<smonth>[01]?\d)\b(?!/))
+  | (?P<words>\b(?P<wday>[0-3]?\d)(?:°|º)?\s+(?P<wmonth>{_MONTH_NAMES})\b\.?(?:\s+(?P<wyear>20\d\d)\b)?)
+  | (?P<price>€\s*(?P<amount>{_NUMBER})|\b(?P<amount2>{_NUMBER})\s*(?:€|euro\b|eur\b))
+  | (?P<time>\b(?:(?:dalle|alle|ore|h)\s*)+(?P<hour>[0-2]?\d)(?:[:.](?P<minute>[0-5]\d))?\b
+      | \b(?P<hour2>[0-2]?\d)[:.](?P<minute2>[0-5]\d)\b)
+  | (?P<transfer>\b(?:navett[ae]|transfer|shuttle|bus|pullman)\b)
+  | (?P<origin>\b(?:partenza\s+da|parte\s+da|da)\s+(?P<start>[^\W\d][^,;€\n]*?)(?=\s+(?:alle|ore|h|dalle)\b|\s*[,;€(]|\s+\d|$))
+""", re.IGNORECASE | re.VERBOSE)
+
+def _year(year, month, day, now):
+  if year:
+    return int(year) + (2000 if len(year) == 2 else 0)
+  # No year: the next time that day comes, today included
+  candidate = now.year
+  try:
+    if datetime(candidate, month, day) < now.replace(hour=0, minute=0, second=0, microsecond=0):
+      candidate += 1
+  except ValueError:
+    return None
+  return candidate
+
+def _day(match, now):
+  """
+  (year, month, day) of a date or words token, None if it isn't a valid date.
+  """
+  if match.group('words'):
+    day, month, year = int(match.group('wday')), MONTHS[match.group('wmonth').lower()], match.group('wyear')
+  elif match.group('day'):
+    day, month, year = int(match.group('day')), int(match.group('month')), match.group('year')
+  else:
+    day, month, year = int(match.group('sday')), int(match.group('smonth')), None
+  if not (1 <= month <= 12 and 1 <= day <= 31):
+    return None
+  year = _year(year, month, day, now)
+  try:
+    datetime(year, month, day)
+  except (TypeError, ValueError):
+    return None
+  return year, month, day
+
+def _time(match):
+  hour = int(match.group('hour') or match.group('hour2'))
+  minute = int(match.group('minute') or match.group('minute2') or 0)
+  return (hour, minute) if hour < 24 else None
+
+def _cents(match):
+  amount = float((match.group('amount') or match.group('amount2')).replace(',', '.'))
+  return round(amount * 100)
+
+def parse_post(text, now=None):
+  """
+  Returns a dict with date (datetime, None unless both day and time were found), end_location,
+  description (the post without its date and location lines), price in cents and, from
+  lines about the shuttle, start_location, transfer_time and transfer_price. Missing
+  values are None. Nothing is sanitized: that's up to the caller.
+  """
+  now = now or datetime.now()
+  lines = [line.strip() for line in text.splitlines() if line.strip()]
+  day = day_line = time = location = location_line = price = None
+  times = []
+  start = transfer_time = transfer_price = None
+  untagged = set()
+
+  for index, line in enumerate(lines):
+    tokens = list(TOKENS.finditer(line))
+    kinds = {token.lastgroup for token in tokens}
+    # "da" outside of a transfer line is just a word, e.g. "Ristorante Da Luigi"
+    if kinds <= {'origin'}:
+      untagged.add(index)
+      continue
+    if 'transfer' in kinds:
+      for token in tokens:
+        if token.lastgroup == 'time' and transfer_time is None:
+          transfer_time = _time(token)
+        elif token.lastgroup == 'price' and transfer_price is None:
+          transfer_price = _cents(token)
+        elif token.lastgroup == 'origin' and start is None:
+          start = token.group('start').strip()
+        elif token.lastgroup == 'place' and start is None:
+          start = token.group('where').strip()
+      continue
+    for token in tokens:
+      kind = token.lastgroup
+      if kind in ('date', 'words') and day is None:
+        day = _day(token, now)
+        if day is not None:
+          day_line = index
+      elif kind == 'time':
+        value = _time(token)
+        if value is not None:
+          times.append((index, value))
+      elif kind == 'price' and price is None:
+        price = _cents(token)
+      elif kind == 'place' and location is None:
+        location = token.group('where').strip()
+        location_line = index
+
+  date = None
+  if day is not None and times:
+    # The time on the date line, otherwise the first one in the post
+    time = next((value for index, value in times if index == day_line), times[0][1])
+    date = datetime(*day, *time)
+  if location is None and day_line is not None:
+    # The old format: the location on the line after the date (or after the time, on its own line)
+    location_line = next((index for index in (day_line + 1, day_line + 2) if index in untagged), None)
+    if location_line is not None:
+      location = lines[location_line]
+
+  result = {
+    'date': date,
+    'end_location': location,
+    'description': "\n".join(line for index, line in enumerate(lines) if index not in (day_line, location_line)),
+    'price': price,
+    'start_location': start,
+    'transfer_time': None,
+    'transfer_price': transfer_price,
+  }
+  if date is not None and transfer_time is not None:
+    departure = date.replace(hour=transfer_time[0], minute=transfer_time[1])
+    # A shuttle leaving at 23:00 for an event at 00:30 leaves the day before
+    result['transfer_time'] = departure - timedelta(days=1) if departure > date else departure
+  return result
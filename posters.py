@@ -0,0 +1,79 @@
+import asyncio
+import hashlib
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+  from PIL import Image
+except ImportError:  # Pillow is optional: without it posters are stored as uploaded
+  Image = None
+
+POSTERS_DIR = 'event_images'
+POSTER_WORKERS = int(os.getenv('POSTER_WORKERS', '2'))
+
+# name: (longest side in px, JPEG quality)
+VARIANTS = {
+  'thumb': (1280, 82),  # catalog photo: Telegram doesn't show photos larger than 1280px
+  'invoice': (512, 80),  # invoice image
+}
+
+def poster_hash(data):
+  return hashlib.sha256(data).hexdigest()
+
+def variant_path(image_path, variant):
+  """
+  Path of another variant of a poster stored by process_poster, or image_path itself
+  for posters saved before the pipeline existed.
+  """
+  directory, name = os.path.split(image_path)
+  if not name.endswith('_thumb.jpg'):
+    return image_path
+  path = os.path.join(directory, f"{name[:-len('_thumb.jpg')]}_{variant}.jpg")
+  return path if os.path.exists(path) else image_path
+
+def process_poster(data, extension, directory=POSTERS_DIR):
+  """
+  Runs in a worker process: writes a resized, recompressed JPEG for each of VARIANTS,
+  named after the content hash of the upload, and returns the manifest row.
+  Without Pillow the upload itself is stored and used for every variant.
+  """
+  digest = poster_hash(data)
+  width = height = original = None
+  if Image is None:
+    original = os.path.join(directory, f"{digest}{extension or '.jpg'}")
+    with open(original, 'wb') as f:
+      f.write(data)
+    paths = {name: original for name in VARIANTS}
+  else:
+    paths = {}
+    with Image.open(io.BytesIO(data)) as image:
+      width, height = image.size
+      image = image.convert('RGB')
+      for name, (side, quality) in VARIANTS.items():
+        variant = image.copy()
+        variant.thumbnail((side, side), Image.LANCZOS)
+        paths[name] = os.path.join(directory, f"{digest}_{name}.jpg")
+        variant.save(paths[name], 'JPEG', quality=quality, optimize=True, progressive=True)
+  return (digest, original, paths['thumb'], paths['invoice'], width, height, len(data))
+
+_executor = None
+
+async def store_poster(data, extension):
+  """
+  Process an uploaded poster off the event loop, in a process pool.
+  """
+  global _executor
+  if _executor is None:
+    # spawn, as in cluster.py: a forked child would inherit the DB threads and open SQLite
+    # connections of this process, with any lock one of them held at fork time
+    _executor = ProcessPoolExecutor(max_workers=POSTER_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+  loop = asyncio.get_running_loop()
+  return await loop.run_in_executor(_executor, process_poster, data, extension)
+
+def close():
+  global _executor
+  if _executor is not None:
+    _executor.shutdown(wait=True)
+    _executor = None
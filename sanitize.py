@@ -0,0 +1,97 @@
+"""
+Sanitization and validation of the event fields admins type in the add-event conversations
+or upload with a bulk import. Each field has a schema whose clean(value) returns the value to
+store (text, int or datetime) or raises ValueError with the reason, in Italian. Text is stored
+HTML-escaped, except titles, which are stored as typed and shown in Markdown captions.
+Patterns are compiled once here, and a field is sanitized in a single escape pass.
+"""
+import re
+from datetime import datetime
+from html import escape
+
+_SCRIPT = re.compile(r'<script\b[^>]*>.*?</script\s*>', re.IGNORECASE | re.DOTALL)
+# Control characters have no place in an event; single-line fields refuse newlines too
+_CONTROL = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]')
+_CONTROL_OR_NEWLINE = re.compile(r'[\x00-\x1f\x7f]')
+# Up to 9 digits: well past any price in cents or number of places, and never a huge int
+_INTEGER = re.compile(r'\s*(\d{1,9})\s*')
+_DATE = re.compile(r'\s*(\d{1,2})/(\d{1,2})/(\d{4})\s+(\d{1,2}):(\d{2})\s*')
+
+def sanitize_input(input_string):
+  """
+  Escape HTML special characters, dropping any <script> block first.
+  """
+  # The script check only pays a regex scan when there can be a tag at all
+  if '<' in input_string:
+    input_string = _SCRIPT.sub('', input_string)
+  return escape(input_string)
+
+class Text:
+  def __init__(self, name, max_length, single_line=False, escaped=True):
+    self.name = name
+    self.max_length = max_length
+    self.escaped = escaped
+    self._control = _CONTROL_OR_NEWLINE if single_line else _CONTROL
+
+  def clean(self, value):
+    value = value.strip()
+    # isprintable() is a quick yes for most single-line values; it's False for newlines and emoji joiners too
+    if not value.isprintable() and self._control.search(value):
+      raise ValueError(f"{self.name} contiene caratteri non ammessi")
+    if self.escaped:
+      value = sanitize_input(value)
+    elif '<' in value:
+      value = _SCRIPT.sub('', value)
+    # The limit applies to the stored text, which is what ends up in the caption
+    if len(value) > self.max_length:
+      raise ValueError(f"{self.name} oltre {self.max_length} caratteri")
+    return value
+
+class Integer:
+  def __init__(self, name, minimum=0, unit=None, too_small=None):
+    self.name = name
+    self.minimum = minimum
+    self._unit = f" ({unit})" if unit else ""
+    self._too_small = too_small or f"{name} minimo {minimum}"
+
+  def clean(self, value):
+    match = _INTEGER.fullmatch(value)
+    if match is None:
+      raise ValueError(f"{self.name} non valido: {value!r}{self._unit}")
+    number = int(match.group(1))
+    if number < self.minimum:
+      raise ValueError(self._too_small)
+    return number
+
+class DateTime:
+  """
+  A DD/MM/YYYY HH:MM date, as datetime.strptime(value, '%d/%m/%Y %H:%M') reads it.
+  """
+  def __init__(self, name):
+    self.name = name
+
+  def clean(self, value):
+    match = _DATE.fullmatch(value)
+    try:
+      if match is None:
+        raise ValueError
+      day, month, year, hour, minute = map(int, match.groups())
+      return datetime(year, month, day, hour, minute)
+    except ValueError:
+      raise ValueError(f"{self.name} non valida: {value!r} (formato DD/MM/YYYY HH:MM)")
+
+# Field schemas
+# Titles are stored unescaped: the conversations always did, and the import dedups on them
+TITLE = Text("titolo", 100, single_line=True, escaped=False)
+# Telegram captions are 1024 characters at most, and the date and location go in too
+DESCRIPTION = Text("descrizione", 1024 - 200)
+POST = Text("post", 1024 - 200)
+LOCATION = Text("location", 200, single_line=True)
+START_LOCATION = Text("partenza del transfer", 200, single_line=True)
+PRICE = Integer("prezzo", minimum=100, unit="in centesimi", too_small="prezzo minimo un euro (100 centesimi)")
+TRANSFER_PRICE = Integer("prezzo del transfer", minimum=100, unit="in centesimi", too_small="prezzo del transfer minimo un euro (100 centesimi)")
+# 0 = no limit
+CAPACITY = Integer("numero di biglietti")
+TRANSFER_CAPACITY = Integer("numero di posti sul transfer")
+DATE = DateTime("data")
+TRANSFER_TIME = DateTime("ora del transfer")
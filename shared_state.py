@@ -0,0 +1,82 @@
+"""
+State shared by the bot's worker processes (see cluster.py): named generation counters that a
+process bumps when it changes something the other processes keep in memory, e.g. the active
+events, so they know to reload it.
+
+LocalState keeps the counters in memory, for a single process. SQLiteState keeps them in a
+SQLite file (SHARED_STATE_DB), for processes on the same host, along with the per-user rate
+limits when RATE_LIMIT_SHARED is set. Another backend, e.g. Redis with INCR/GET, only needs
+bump() and generation(), plus rate_limit() for shared rate limits. Backends with blocking
+set are called off the event loop (database.run_shared).
+"""
+import os
+import sqlite3
+import threading
+import time
+
+SHARED_STATE_DB = os.getenv('SHARED_STATE_DB')
+
+class LocalState:
+  blocking = False
+
+  def __init__(self):
+    self._generations = {}
+
+  def bump(self, key):
+    self._generations[key] = self._generations.get(key, 0) + 1
+    return self._generations[key]
+
+  def generation(self, key):
+    return self._generations.get(key, 0)
+
+class SQLiteState:
+  """
+  Counters in a SQLite file. Both calls are a single statement, which SQLite applies atomically,
+  but wait up to the busy timeout while another process holds the write lock: they run on the
+  DB threads, like rate_limit().
+  """
+  blocking = True
+
+  def __init__(self, path):
+    self._conn = sqlite3.connect(path, timeout=1, isolation_level=None, check_same_thread=False)
+    self._conn.execute("PRAGMA journal_mode=WAL")
+    # Losing the counters on a power cut is harmless: every process restarts with empty caches
+    self._conn.execute("PRAGMA synchronous=OFF")
+    self._conn.execute("CREATE TABLE IF NOT EXISTS generations (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+    self._conn.execute("CREATE TABLE IF NOT EXISTS rate_limits (user_id INTEGER PRIMARY KEY, tat REAL NOT NULL)")
+    self._lock = threading.Lock()
+    # rate_limit() runs on the DB threads, with a connection of its own
+    self._limits = sqlite3.connect(path, timeout=1, isolation_level=None, check_same_thread=False)
+    self._limits_lock = threading.Lock()
+    self._limit_checks = 0
+
+  def bump(self, key):
+    with self._lock:
+      return self._conn.execute("""INSERT INTO generations (key, value) VALUES (?, 1)
+             ON CONFLICT(key) DO UPDATE SET value = value + 1 RETURNING value""", (key,)).fetchone()[0]
+
+  def generation(self, key):
+    with self._lock:
+      row = self._conn.execute("SELECT value FROM generations WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else 0
+
+  def rate_limit(self, user_id, step, period):
+    """
+    GCRA check and update in one UPSERT: charges step seconds to the user's bucket and
+    returns True, or returns False and charges nothing if that would exceed period.
+    Blocking (up to the busy timeout): call it off the event loop.
+    """
+    now = time.time()
+    with self._limits_lock:
+      c = self._limits.execute("""INSERT INTO rate_limits (user_id, tat) VALUES (:user_id, :now + :step)
+             ON CONFLICT(user_id) DO UPDATE SET tat = max(tat, :now) + :step
+             WHERE max(tat, :now) + :step - :now <= :period""",
+             {'user_id': user_id, 'now': now, 'step': step, 'period': period})
+      self._limit_checks += 1
+      if self._limit_checks % 10_000 == 0:
+        # A bucket that refilled completely is the same as no row at all
+        self._limits.execute("DELETE FROM rate_limits WHERE tat < ?", (now,))
+      return c.rowcount == 1
+
+def from_env():
+  return SQLiteState(SHARED_STATE_DB) if SHARED_STATE_DB else LocalState()
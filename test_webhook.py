@@ -0,0 +1,153 @@
+"""
+Webhook mode end to end: bot.py runs as in production (main() -> run_webhook) against
+loadtest's fake Bot API, and updates are posted to its webhook the way Telegram does.
+It runs twice: with concurrent updates, as by default, and with one update at a time.
+"""
+import asyncio
+import os
+import signal
+import socket
+import sys
+import time
+
+import pytest
+
+pytest.importorskip('tornado', reason="webhook mode needs python-telegram-bot[webhooks]")
+import httpx
+
+import loadtest
+
+SECRET = 'webhook-test-secret'
+QUEUE_SIZE = 5
+UPDATES_IN_FLIGHT = 8
+MAX_PENDING_PER_USER = 4
+# Time the fake API takes to answer a sendMessage, so that updates pile up in the queue
+SEND_DELAY = 0.1
+
+class SlowBotAPI(loadtest.FakeBotAPI):
+  def __init__(self):
+    super().__init__()
+    # (method, chat_id, text) of the calls answered, in order
+    self.log = []
+
+  async def _call(self, method, params):
+    if method == 'sendMessage':
+      await asyncio.sleep(SEND_DELAY)
+    result = await super()._call(method, params)
+    self.log.append((method, params.get('chat_id'), params.get('text')))
+    return result
+
+def _free_port():
+  with socket.socket() as sock:
+    sock.bind(('127.0.0.1', 0))
+    return sock.getsockname()[1]
+
+def _start(user_id, update_id):
+  text = '/start'
+  return {'update_id': update_id, 'message': {
+    'message_id': update_id, 'date': int(time.time()), 'text': text,
+    'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}],
+    'chat': {'id': user_id, 'type': 'private'},
+    'from': {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}'}}}
+
+def _payment(user_id, update_id):
+  payload = 'payment_for_event_1_01/01/2030 21:00_1'
+  sender = {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}'}
+  checkout = {'update_id': update_id, 'pre_checkout_query': {
+    'id': f'query-{update_id}', 'from': sender, 'currency': 'EUR', 'total_amount': 1500, 'invoice_payload': payload}}
+  paid = {'update_id': update_id + 1, 'message': {
+    'message_id': update_id + 1, 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'}, 'from': sender,
+    'successful_payment': {'currency': 'EUR', 'total_amount': 1500, 'invoice_payload': payload,
+                           'telegram_payment_charge_id': f'charge-{update_id}', 'provider_payment_charge_id': f'provider-{update_id}'}}}
+  return checkout, paid
+
+async def _until(condition, timeout):
+  deadline = time.monotonic() + timeout
+  while not condition():
+    if time.monotonic() > deadline:
+      raise AssertionError("timed out")
+    await asyncio.sleep(0.05)
+
+async def _scenario(workdir, concurrent):
+  api = SlowBotAPI()
+  api_port = await api.start()
+  webhook_port = _free_port()
+  env = dict(os.environ,
+             TOKEN_1=loadtest.TOKEN,
+             TELEGRAM_API_URL=f'http://127.0.0.1:{api_port}',
+             DB_PATH=os.path.join(workdir, 'webhook.db'),
+             WEBHOOK_URL=f'http://127.0.0.1:{webhook_port}/hook',
+             WEBHOOK_LISTEN='127.0.0.1',
+             WEBHOOK_PORT=str(webhook_port),
+             WEBHOOK_SECRET=SECRET,
+             UPDATE_QUEUE_SIZE=str(QUEUE_SIZE),
+             UPDATES_IN_FLIGHT=str(UPDATES_IN_FLIGHT),
+             MAX_PENDING_PER_USER=str(MAX_PENDING_PER_USER),
+             OUTBOUND_GLOBAL_RATE='100000', OUTBOUND_CHAT_RATE='100000', OUTBOUND_CHAT_BURST='1000')
+  env.pop('SHARED_STATE_DB', None)
+  if concurrent:
+    env.pop('CONCURRENT_UPDATES', None)
+  else:
+    env['CONCURRENT_UPDATES'] = '1'
+  with open(os.path.join(workdir, 'bot.log'), 'wb') as log:
+    bot = await asyncio.create_subprocess_exec(sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py'),
+                                               cwd=workdir, env=env, stdout=log, stderr=log)
+  try:
+    await _until(lambda: api.calls['setWebhook'], 30)
+    url = f'http://127.0.0.1:{webhook_port}/hook'
+    headers = {'X-Telegram-Bot-Api-Secret-Token': SECRET}
+    async with httpx.AsyncClient(timeout=30) as client:
+      # Wrong secret: refused, never processed
+      response = await client.post(url, json=_start(100, 1), headers={'X-Telegram-Bot-Api-Secret-Token': 'wrong'})
+      assert response.status_code == 403
+      # Right secret: processed
+      replied = api.expect(('chat', 101))
+      response = await client.post(url, json=_start(101, 2), headers=headers)
+      assert response.status_code == 200
+      await asyncio.wait_for(replied, 10)
+      assert 'Benvenuto' in api.messages[101]['text']
+      assert 100 not in api.messages
+
+      if concurrent:
+        # A user over MAX_PENDING_PER_USER has their updates dropped, but never a payment,
+        # and payments don't wait for the user's other updates
+        flood = range(3, 3 + 2 * MAX_PENDING_PER_USER)
+        responses = await asyncio.gather(*(client.post(url, json=_start(300, update_id), headers=headers) for update_id in flood))
+        assert all(response.status_code == 200 for response in responses)
+        checkout, paid = _payment(300, 100)
+        answered = api.expect(('precheckout', checkout['pre_checkout_query']['id']))
+        assert (await client.post(url, json=checkout, headers=headers)).status_code == 200
+        await asyncio.wait_for(answered, 10)
+        assert (await client.post(url, json=paid, headers=headers)).status_code == 200
+        await _until(lambda: any(method == 'sendMessage' and 'payment' in (text or '') for method, _, text in api.log), 10)
+        welcomes = lambda: [index for index, (method, chat_id, text) in enumerate(api.log) if chat_id == 300 and 'Benvenuto' in (text or '')]
+        # Confirmed while the user's flood was still being answered
+        assert len(welcomes()) < MAX_PENDING_PER_USER
+        await _until(lambda: len(welcomes()) >= MAX_PENDING_PER_USER, 10)
+        await asyncio.sleep(SEND_DELAY * 2)
+        assert len(welcomes()) < len(flood)
+
+      # A burst larger than the queue: the webhook holds its answers until there is room
+      users = range(200, 220)
+      responses = await asyncio.gather(*(
+        client.post(url, json=_start(user_id, 200 + index), headers=headers)
+        for index, user_id in enumerate(users)))
+      assert all(response.status_code == 200 for response in responses)
+      answered = sum(user_id in api.messages for user_id in users)
+      # Accepted but unanswered updates are in the queue, or being processed
+      assert len(users) - answered <= QUEUE_SIZE + (UPDATES_IN_FLIGHT if concurrent else 1)
+      assert answered < len(users)
+
+    # Shutdown drains the queue: every accepted update is answered before the process exits
+    bot.send_signal(signal.SIGTERM)
+    assert await asyncio.wait_for(bot.wait(), 30) == 0
+    assert all(user_id in api.messages for user_id in users)
+  finally:
+    if bot.returncode is None:
+      bot.kill()
+      await bot.wait()
+    api.close()
+
+@pytest.mark.parametrize('concurrent', [True, False], ids=['concurrent', 'sequential'])
+def test_webhook(tmp_path, concurrent):
+  asyncio.run(_scenario(str(tmp_path), concurrent))